@@ -1,10 +1,14 @@
 import os
+import re
 import gzip
 import sys
 import glob
 import logging
 import collections
 import time
+import functools
+import multiprocessing
+import asyncio
 
 from optparse import OptionParser
 from threading import Thread
@@ -18,6 +22,14 @@ NORMAL_ERR_RATE = 0.01
 RECONNECT_TIMEOUT = 0.5
 RECONNECT_ATTEMPT_COUNT = 5
 MAX_THREADS = 5
+CHUNK_QUEUE_FACTOR = 4
+BATCH_SIZE = 500
+BATCH_WINDOW = 1.0
+BACKEND_MEMCACHE = 'memcache'
+BACKEND_ASYNCIO = 'asyncio'
+ASYNC_CONNECTIONS = 4
+ASYNC_MAX_IN_FLIGHT = 100
+MEMC_KEY_RE = re.compile(rb'^[^\x00-\x20\x7f]{1,250}$')
 AppsInstalled = collections.namedtuple("AppsInstalled", ["dev_type", "dev_id", "lat", "lon", "apps"])
 
 
@@ -41,9 +53,15 @@ class FileInfo:
     def set_run_status(self):
         self.__status = 'run'
 
+    def is_failed_status(self):
+        return self.__status == 'failed'
+
     def set_finished_status(self):
         self.__status = 'finished'
 
+    def set_failed_status(self):
+        self.__status = 'failed'
+
 
 class MemcachedConnectionError(Exception):
     pass
@@ -77,11 +95,7 @@ class MemcachedLoader:
             raise MemcachedConnectionError
 
     def load(self, appsinstalled, reconnect=True):
-        ua = appsinstalled_pb2.UserApps()
-        ua.lat = appsinstalled.lat
-        ua.lon = appsinstalled.lon
-        key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
-        ua.apps.extend(appsinstalled.apps)
+        key, ua = make_user_apps(appsinstalled)
         packed = ua.SerializeToString()
         try:
             if self.__dry_run:
@@ -98,6 +112,282 @@ class MemcachedLoader:
                     logging.exception("Cannot write to memc %s: %s" % (self.__address, e))
             return False
 
+    def load_multi(self, items, reconnect=True):
+        """
+        Set packed values by one set_multi request, keys failed in the batch are retried one by one
+        :param items: dict of key -> packed UserApps
+        :return: number of keys which weren't stored
+        """
+        if self.__dry_run:
+            for key in items:
+                logging.debug("%s - %s -> %s bytes" % (self.__address, key, len(items[key])))
+            return 0
+
+        try:
+            failed = self.__client.set_multi(items)
+        except Exception as e:
+            if reconnect:
+                try:
+                    self.__reconnect()
+                    return self.load_multi(items, False)
+                except MemcachedConnectionError:
+                    pass
+            logging.exception("Cannot write to memc %s: %s" % (self.__address, e))
+            return len(items)
+
+        errors = 0
+        for key in failed:
+            try:
+                stored = self.__client.set(key, items[key])
+            except Exception as e:
+                logging.error("Cannot write %s to memc %s: %s" % (key, self.__address, e))
+                stored = False
+            if not stored:
+                errors += 1
+        return errors
+
+
+class MemcachedBatch:
+    """
+    Buffer of packed records of one device type, it's flushed by load_multi when it has batch_size
+    records or its first record is older than batch_window seconds
+    """
+
+    def __init__(self, memc_loader, batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.memc_loader = memc_loader
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.items = {}
+        self.started = None
+        self.processed = 0
+        self.errors = 0
+
+    def add(self, key, packed):
+        # the same key twice in one set_multi would be counted once
+        if key in self.items:
+            self.flush()
+        if not self.items:
+            self.started = time.monotonic()
+        self.items[key] = packed
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def is_expired(self, now):
+        return bool(self.items) and now - self.started >= self.batch_window
+
+    def flush(self):
+        if not self.items:
+            return
+
+        errors = self.memc_loader.load_multi(self.items)
+        self.processed += len(self.items) - errors
+        self.errors += errors
+        self.items = {}
+
+
+class AsyncMemcachedConnection:
+    """
+    Connection speaking memcached text protocol, set commands are pipelined: they are written without waiting
+    for responses, responses come in the same order and are matched with pending futures by reader task
+    """
+
+    def __init__(self, host, port, max_in_flight):
+        self.host = host
+        self.port = port
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.connect_lock = asyncio.Lock()
+        self.pending = collections.deque()
+        self.writer = None
+        self.reader_task = None
+        self.dead_until = 0
+
+    async def connect(self):
+        # sets waiting for connect_lock while server is down aren't delayed by one more reconnect round
+        if time.monotonic() < self.dead_until:
+            raise MemcachedConnectionError
+
+        attempt = 0
+        while attempt < RECONNECT_ATTEMPT_COUNT:
+            if attempt > 0:
+                await asyncio.sleep(RECONNECT_TIMEOUT)
+
+            try:
+                reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as ex:
+                logging.info("Cannot connect to memc %s:%s: %s" % (self.host, self.port, ex))
+                attempt += 1
+            else:
+                self.reader_task = asyncio.ensure_future(self.read_responses(reader, self.writer))
+                return
+
+        self.dead_until = time.monotonic() + RECONNECT_TIMEOUT * RECONNECT_ATTEMPT_COUNT
+        raise MemcachedConnectionError
+
+    async def read_responses(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b"\r\n"):
+                    raise ConnectionError("Connection is closed")
+
+                line = line[:-2]
+                future = self.pending.popleft()
+                if not future.done():
+                    future.set_result(line == b"STORED")
+                if line == b"ERROR" or line.startswith(b"CLIENT_ERROR"):
+                    # the rest of command can be read as the next one, so responses are out of sync
+                    raise ConnectionError("Unexpected response: %s" % line.decode('utf-8', 'replace'))
+        except Exception as e:
+            self.close(writer, e)
+
+    def close(self, writer, error):
+        if writer is not self.writer:
+            return
+
+        self.writer = None
+        writer.close()
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(str(error)))
+
+    async def set(self, key, value):
+        async with self.in_flight:
+            if self.writer is None:
+                async with self.connect_lock:
+                    if self.writer is None:
+                        await self.connect()
+
+            future = asyncio.get_running_loop().create_future()
+            # number of written commands is bounded by in_flight, so drain isn't needed
+            self.writer.write(b"set %s 0 0 %d\r\n%s\r\n" % (key, len(value), value))
+            self.pending.append(future)
+            return await future
+
+
+class AsyncMemcachedClient:
+
+    def __init__(self, address, connections, max_in_flight):
+        host, port = address.rsplit(":", 1)
+        self.connections = [AsyncMemcachedConnection(host, int(port), max_in_flight) for _ in range(connections)]
+        self.next_connection = 0
+
+    def get_connection(self):
+        connection = self.connections[self.next_connection]
+        self.next_connection = (self.next_connection + 1) % len(self.connections)
+        return connection
+
+    async def set(self, key, value):
+        key = key.encode('utf-8')
+        if not MEMC_KEY_RE.match(key):
+            logging.error("Invalid memc key: %s" % key)
+            return False
+
+        try:
+            return await self.get_connection().set(key, value)
+        except ConnectionError:
+            pass
+        # command is retried once, connection is reopened like MemcachedLoader.__reconnect does
+        try:
+            return await self.get_connection().set(key, value)
+        except ConnectionError:
+            raise MemcachedConnectionError
+
+    async def close(self):
+        for connection in self.connections:
+            if connection.writer is not None:
+                connection.close(connection.writer, "Client is closed")
+            if connection.reader_task is not None:
+                await connection.reader_task
+
+
+class AsyncMemcachedLoader:
+    """
+    Loader with the same interface as MemcachedLoader, sets are sent by AsyncMemcachedClient
+    in event loop running in other thread, so one loader can be used by several threads
+    """
+
+    def __init__(self, address, loop, dry_run=False, connections=ASYNC_CONNECTIONS,
+                 max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        self.__address = address
+        self.__loop = loop
+        self.__dry_run = dry_run
+        # asyncio primitives are made in thread of the loop
+        self.__client = self.__run(self.__make_client(connections, max_in_flight))
+
+    def __run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop).result()
+
+    async def __make_client(self, connections, max_in_flight):
+        return AsyncMemcachedClient(self.__address, connections, max_in_flight)
+
+    async def __set(self, key, value):
+        try:
+            return await self.__client.set(key, value)
+        except MemcachedConnectionError:
+            logging.error("Cannot write %s to memc %s" % (key, self.__address))
+            return False
+
+    async def __set_multi(self, items):
+        results = await asyncio.gather(*(self.__set(key, items[key]) for key in items))
+        return results.count(False)
+
+    def load(self, appsinstalled):
+        key, packed = pack_appsinstalled(appsinstalled)
+        return self.load_multi({key: packed}) == 0
+
+    def load_multi(self, items):
+        if self.__dry_run:
+            for key in items:
+                logging.debug("%s - %s -> %s bytes" % (self.__address, key, len(items[key])))
+            return 0
+
+        return self.__run(self.__set_multi(items))
+
+    def close(self):
+        self.__run(self.__client.close())
+
+
+def start_event_loop():
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def make_memc_loaders(memc_loaders_conf, dry_run, loop=None, connections=ASYNC_CONNECTIONS,
+                      max_in_flight=ASYNC_MAX_IN_FLIGHT):
+    """
+    :param loop: event loop of AsyncMemcachedLoader, MemcachedLoader is used if it's None
+    :return: dict of device type -> loader
+    """
+    if loop is None:
+        return {key: MemcachedLoader(memc_loaders_conf[key], dry_run) for key in memc_loaders_conf.keys()}
+    return {key: AsyncMemcachedLoader(memc_loaders_conf[key], loop, dry_run, connections, max_in_flight)
+            for key in memc_loaders_conf.keys()}
+
+
+def close_memc_loaders(memc_loaders, loop):
+    if loop is None:
+        return
+
+    for memc_loader in memc_loaders.values():
+        memc_loader.close()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def make_user_apps(appsinstalled):
+    ua = appsinstalled_pb2.UserApps()
+    ua.lat = appsinstalled.lat
+    ua.lon = appsinstalled.lon
+    key = "%s:%s" % (appsinstalled.dev_type, appsinstalled.dev_id)
+    ua.apps.extend(appsinstalled.apps)
+    return key, ua
+
+
+def pack_appsinstalled(appsinstalled):
+    key, ua = make_user_apps(appsinstalled)
+    return key, ua.SerializeToString()
+
 
 def dot_rename(path):
     head, fn = os.path.split(path)
@@ -151,9 +441,10 @@ def parse_appsinstalled_utf8(line):
     return AppsInstalled(dev_type, dev_id, lat, lon, apps)
 
 
-def reader_handler(filename: str, memc_loaders: dict, output_queue: Queue):
+def reader_handler(filename: str, memc_loaders: dict, output_queue: Queue, batch_size=1, batch_window=BATCH_WINDOW):
     errors = 0
     processed = 0
+    batches = {}
 
     logging.info("Starting file handling: {}".format(filename))
     fd = gzip.open(filename)
@@ -179,6 +470,19 @@ def reader_handler(filename: str, memc_loaders: dict, output_queue: Queue):
             logging.error("Unknown device type: {}".format(appsinstalled.dev_type))
             continue
 
+        if batch_size > 1:
+            batch = batches.get(appsinstalled.dev_type)
+            if batch is None:
+                batch = MemcachedBatch(memc_loader, batch_size, batch_window)
+                batches[appsinstalled.dev_type] = batch
+            batch.add(*pack_appsinstalled(appsinstalled))
+
+            now = time.monotonic()
+            for batch in batches.values():
+                if batch.is_expired(now):
+                    batch.flush()
+            continue
+
         try:
             memc_loader.load(appsinstalled)
         except MemcachedConnectionError:
@@ -187,9 +491,75 @@ def reader_handler(filename: str, memc_loaders: dict, output_queue: Queue):
             processed += 1
 
     fd.close()
+    for batch in batches.values():
+        batch.flush()
+        processed += batch.processed
+        errors += batch.errors
     output_queue.put((filename, processed, errors))
 
 
+class ChunkSender:
+    """
+    Stand-in of MemcachedLoader in packer process: batches of packed records are put to chunk queue
+    and loaded to memcached by I/O threads of the main process
+    """
+
+    def __init__(self, filename, dev_type, chunk_queue):
+        self.filename = filename
+        self.dev_type = dev_type
+        self.chunk_queue = chunk_queue
+        self.chunks = 0
+
+    def load(self, appsinstalled):
+        self.load_multi(dict([pack_appsinstalled(appsinstalled)]))
+        return True
+
+    def load_multi(self, items):
+        self.chunk_queue.put((self.filename, self.dev_type, items))
+        self.chunks += 1
+        return 0
+
+
+packer_chunk_queue = None
+
+
+def init_packer(chunk_queue):
+    global packer_chunk_queue
+    packer_chunk_queue = chunk_queue
+
+
+def packer_handler(filename, dev_types, batch_size, batch_window):
+    """
+    Decompress, parse and pack file in pool process
+    :return: ('read', filename, number of chunks, number of errors)
+    """
+    senders = {dev_type: ChunkSender(filename, dev_type, packer_chunk_queue) for dev_type in dev_types}
+    output_queue = Queue()
+    reader_handler(filename, senders, output_queue, batch_size, batch_window)
+    _, _, errors = output_queue.get_nowait()
+    return 'read', filename, sum(sender.chunks for sender in senders.values()), errors
+
+
+def packer_error(filename, results_queue, error):
+    logging.error("Cannot read %s: %s" % (filename, error))
+    results_queue.put(('failed', filename, 0, 0))
+
+
+def loader_handler(memc_loaders, chunk_queue, results_queue):
+    while True:
+        chunk = chunk_queue.get()
+        if chunk is None:
+            break
+
+        filename, dev_type, items = chunk
+        try:
+            errors = memc_loaders[dev_type].load_multi(items)
+        except Exception as e:
+            logging.exception("Cannot load chunk of %s: %s" % (filename, e))
+            errors = len(items)
+        results_queue.put(('loaded', filename, len(items) - errors, errors))
+
+
 def find_files(pattern):
     result = collections.OrderedDict()
     for filename in glob.iglob(pattern):
@@ -220,12 +590,16 @@ def handle_processed_files(files):
     keys = list(files.keys())
     for key in keys:
         fileinfo = files[key]
-        if not fileinfo.is_finished_status():
+        if not fileinfo.is_finished_status() and not fileinfo.is_failed_status():
             break
 
         del files[key]
 
-        err_rate = float(fileinfo.errors) / fileinfo.processed
+        if fileinfo.is_failed_status():
+            logging.error("%s failed load, it's left for the next run" % fileinfo.filename)
+            continue
+
+        err_rate = float(fileinfo.errors) / fileinfo.processed if fileinfo.processed else 1.0
         if err_rate < NORMAL_ERR_RATE:
             logging.info("Acceptable error rate (%s) for (%s). Successfull load" % (err_rate, fileinfo.filename))
         else:
@@ -233,22 +607,92 @@ def handle_processed_files(files):
         dot_rename(fileinfo.filename)
 
 
-def main(memc_loaders_conf, pattern, dry_run):
+def main_pool(memc_loaders_conf, pattern, dry_run, workers, io_threads, batch_size, batch_window,
+              backend=BACKEND_MEMCACHE, connections=ASYNC_CONNECTIONS, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+    """
+    Files are decompressed, parsed and packed by pool of workers processes, packed batches
+    are sent to memcached by io_threads threads of the main process
+    """
+    files = find_files(pattern)
+    chunks_read = {}
+    chunks_loaded = collections.Counter()
+    chunk_queue = multiprocessing.Queue(workers * CHUNK_QUEUE_FACTOR)
+    results_queue = Queue()
+    # pool is forked before I/O and event loop threads are started
+    pool = multiprocessing.Pool(workers, initializer=init_packer, initargs=(chunk_queue,))
+    loop = start_event_loop() if backend == BACKEND_ASYNCIO else None
+    # every I/O thread has its own connections, asyncio loaders are shared
+    memc_loaders = make_memc_loaders(memc_loaders_conf, dry_run, loop, connections, max_in_flight)
+    threads = []
+    for _ in range(io_threads):
+        thread_loaders = memc_loaders if loop is not None else make_memc_loaders(memc_loaders_conf, dry_run)
+        threads.append(Thread(target=loader_handler, args=(thread_loaders, chunk_queue, results_queue)))
+    for thread in threads:
+        thread.start()
+
+    try:
+        with pool:
+            for filename in files:
+                files[filename].set_run_status()
+                pool.apply_async(packer_handler, (filename, list(memc_loaders_conf), batch_size, batch_window),
+                                 callback=results_queue.put,
+                                 error_callback=functools.partial(packer_error, filename, results_queue))
+
+            while len(files) > 0:
+                kind, filename, count, errors = results_queue.get()
+                fileinfo = files.get(filename)
+                if fileinfo is None:
+                    continue
+
+                if kind == 'loaded':
+                    chunks_loaded[filename] += 1
+                    fileinfo.processed += count
+                    fileinfo.errors += errors
+                elif kind == 'read':
+                    chunks_read[filename] = count
+                    fileinfo.errors += errors
+                else:
+                    fileinfo.set_failed_status()
+
+                if chunks_read.get(filename) == chunks_loaded[filename] and fileinfo.is_run_status():
+                    fileinfo.set_finished_status()
+                handle_processed_files(files)
+    finally:
+        for _ in threads:
+            chunk_queue.put(None)
+        for thread in threads:
+            thread.join()
+        close_memc_loaders(memc_loaders, loop)
+
+
+def main(memc_loaders_conf, pattern, dry_run, batch_size=1, batch_window=BATCH_WINDOW, workers=0,
+         io_threads=MAX_THREADS, backend=BACKEND_MEMCACHE, connections=ASYNC_CONNECTIONS,
+         max_in_flight=ASYNC_MAX_IN_FLIGHT):
+    if workers > 0:
+        return main_pool(memc_loaders_conf, pattern, dry_run, workers, io_threads, batch_size, batch_window,
+                         backend, connections, max_in_flight)
+
     readers_queue = Queue()
     available_threads = MAX_THREADS
-    memc_loaders = {key: MemcachedLoader(memc_loaders_conf[key], dry_run) for key in memc_loaders_conf.keys()}
+    loop = start_event_loop() if backend == BACKEND_ASYNCIO else None
+    memc_loaders = make_memc_loaders(memc_loaders_conf, dry_run, loop, connections, max_in_flight)
+    handler_func = functools.partial(reader_handler, batch_size=batch_size, batch_window=batch_window)
 
     files = find_files(pattern)
-    while len(files) > 0:
-        available_threads = start_file_readers(reader_handler, available_threads, files, memc_loaders, readers_queue)
+    try:
+        while len(files) > 0:
+            available_threads = start_file_readers(handler_func, available_threads, files, memc_loaders,
+                                                   readers_queue)
 
-        message = readers_queue.get()
-        processed_filename, processed, errors = message
-        files[processed_filename].set_finished_status()
-        files[processed_filename].errors = errors
-        files[processed_filename].processed = processed
+            message = readers_queue.get()
+            processed_filename, processed, errors = message
+            files[processed_filename].set_finished_status()
+            files[processed_filename].errors = errors
+            files[processed_filename].processed = processed
 
-        handle_processed_files(files)
+            handle_processed_files(files)
+    finally:
+        close_memc_loaders(memc_loaders, loop)
 
 
 if __name__ == '__main__':
@@ -261,6 +705,21 @@ if __name__ == '__main__':
     op.add_option("--gaid", action="store", default="127.0.0.1:33014")
     op.add_option("--adid", action="store", default="127.0.0.1:33015")
     op.add_option("--dvid", action="store", default="127.0.0.1:33016")
+    op.add_option("--batch-size", action="store", type="int", default=BATCH_SIZE,
+                  help="records of one device type sent by one set_multi, 1 to send them one by one")
+    op.add_option("--batch-window", action="store", type="float", default=BATCH_WINDOW,
+                  help="max seconds a record waits in batch")
+    op.add_option("--workers", action="store", type="int", default=0,
+                  help="processes which decompress, parse and pack files, 0 to do it in threads")
+    op.add_option("--io-threads", action="store", type="int", default=MAX_THREADS,
+                  help="threads which send packed records to memcached if --workers is set")
+    op.add_option("--backend", action="store", type="choice", choices=[BACKEND_MEMCACHE, BACKEND_ASYNCIO],
+                  default=BACKEND_MEMCACHE,
+                  help="memcached client: python-memcache or asyncio client with pipelined sets")
+    op.add_option("--connections", action="store", type="int", default=ASYNC_CONNECTIONS,
+                  help="connections to every memcached server of asyncio backend")
+    op.add_option("--max-in-flight", action="store", type="int", default=ASYNC_MAX_IN_FLIGHT,
+                  help="max set commands waiting for response on one connection of asyncio backend")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO if not opts.dry else logging.DEBUG,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
@@ -277,7 +736,8 @@ if __name__ == '__main__':
 
     logging.info("Memc loader started with options: %s" % opts)
     try:
-        main(memc_servers, opts.pattern, opts.dry)
+        main(memc_servers, opts.pattern, opts.dry, opts.batch_size, opts.batch_window, opts.workers,
+             opts.io_threads, opts.backend, opts.connections, opts.max_in_flight)
     except Exception as e:
         logging.exception("Unexpected error: %s" % e)
         sys.exit(1)
@@ -10,6 +10,7 @@ import memc_load
 import collections
 import memcache
 import subprocess
+import asyncio
 
 
 class TestUtils(unittest.TestCase):
@@ -230,6 +231,218 @@ class TestMemcLoad(unittest.TestCase):
         print(message)
 
 
+class TestMemcachedBatch(unittest.TestCase):
+
+    @mock.patch("memcache.Client")
+    def test_load_multi__retry_failed(self, client_class):
+        client = client_class.return_value
+        client.set_multi.return_value = ['a', 'b']
+        client.set.side_effect = [True, 0]
+
+        loader = memc_load.MemcachedLoader('127.0.0.1:8000')
+        errors = loader.load_multi({'a': b'1', 'b': b'2', 'c': b'3'})
+
+        self.assertEqual(errors, 1)
+        client.set_multi.assert_called_once_with({'a': b'1', 'b': b'2', 'c': b'3'})
+        self.assertEqual(client.set.call_args_list, [mock.call('a', b'1'), mock.call('b', b'2')])
+
+    @mock.patch("memcache.Client")
+    def test_load_multi__reconnect(self, client_class):
+        client_class.return_value.set_multi.side_effect = Exception()
+
+        loader = memc_load.MemcachedLoader('127.0.0.1:8000')
+        errors = loader.load_multi({'a': b'1', 'b': b'2'})
+
+        self.assertEqual(errors, 2)
+        self.assertEqual(client_class.call_count, 2)
+
+    def test_batch__size_and_duplicate_keys(self):
+        memc_mock = mock.Mock()
+        memc_mock.load_multi.side_effect = [0, 1, 0]
+
+        batch = memc_load.MemcachedBatch(memc_mock, batch_size=2, batch_window=60)
+        batch.add('a', b'1')
+        batch.add('b', b'2')
+        batch.add('c', b'3')
+        batch.add('c', b'4')
+        batch.flush()
+
+        self.assertEqual(memc_mock.load_multi.call_args_list, [
+            mock.call({'a': b'1', 'b': b'2'}),
+            mock.call({'c': b'3'}),
+            mock.call({'c': b'4'}),
+        ])
+        self.assertEqual(batch.processed, 3)
+        self.assertEqual(batch.errors, 1)
+
+    def test_batch__window(self):
+        batch = memc_load.MemcachedBatch(mock.Mock(), batch_size=10, batch_window=1.0)
+        self.assertFalse(batch.is_expired(time.monotonic()))
+
+        batch.add('a', b'1')
+        self.assertFalse(batch.is_expired(batch.started + 0.5))
+        self.assertTrue(batch.is_expired(batch.started + 1.0))
+
+    @mock.patch("memcache.Client")
+    def test_reader_handler__batch(self, client_class):
+        client = client_class.return_value
+        client.set_multi.side_effect = [[], ['dev_a:3'], []]
+        client.set.return_value = 0
+
+        _, filename = tempfile.mkstemp()
+        fd = gzip.open(filename, 'wb')
+        for dev_id in range(5):
+            fd.write(b'dev_a\t%d\t1\t1\t1\n' % dev_id)
+        fd.write(b'dev_b\t1\t1\t1\t1\n')
+        fd.close()
+
+        reader_queue = queue.Queue()
+        memc_load.reader_handler(filename, {'dev_a': memc_load.MemcachedLoader('127.0.0.1:8000')}, reader_queue,
+                                 batch_size=2)
+        os.remove(filename)
+
+        self.assertEqual(client.set_multi.call_count, 3)
+        self.assertEqual(reader_queue.get_nowait(), (filename, 4, 2))
+
+
+class TestMainPool(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch('memc_load.dot_rename')
+        self.dot_rename = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_main_pool(self):
+        tmp_dir = tempfile.mkdtemp()
+        for idx in range(3):
+            fd = gzip.open(os.path.join(tmp_dir, '%d.tsv.gz' % idx), 'wb')
+            for dev_id in range(100):
+                fd.write(b'idfa\t%d\t1\t1\t1,2\n' % dev_id)
+                fd.write(b'gaid\t%d\t1\t1\t3\n' % dev_id)
+            fd.write(b'xxxx\t1\t1\t1\t1\n')
+            fd.close()
+
+        loaded = collections.Counter()
+
+        def load_multi(items):
+            loaded.update(items.keys())
+            return int('gaid:7' in items)
+
+        finished = {}
+        handle_processed_files = memc_load.handle_processed_files
+
+        def handle_files(files):
+            for fileinfo in files.values():
+                if fileinfo.is_finished_status():
+                    finished[os.path.basename(fileinfo.filename)] = (fileinfo.processed, fileinfo.errors)
+            handle_processed_files(files)
+
+        with mock.patch.object(memc_load.MemcachedLoader, 'load_multi', side_effect=load_multi), \
+                mock.patch('memc_load.handle_processed_files', side_effect=handle_files):
+            memc_load.main({'idfa': 'a', 'gaid': 'b'}, os.path.join(tmp_dir, '*.tsv.gz'), True,
+                           batch_size=16, workers=2, io_threads=2)
+
+        for idx in range(3):
+            os.remove(os.path.join(tmp_dir, '%d.tsv.gz' % idx))
+        os.rmdir(tmp_dir)
+
+        self.assertEqual(finished, {'%d.tsv.gz' % idx: (199, 2) for idx in range(3)})
+        self.assertEqual(self.dot_rename.call_count, 3)
+        self.assertEqual(len(loaded), 200)
+        self.assertEqual(set(loaded.values()), {3})
+
+
+class FakeMemcached:
+
+    def __init__(self, drop_after=None):
+        self.data = {}
+        self.commands = 0
+        self.connections = 0
+        self.drop_after = drop_after
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            _, key, _, _, size = line.split()
+            value = await reader.readexactly(int(size) + 2)
+            self.commands += 1
+            if self.commands == self.drop_after:
+                break
+            self.data[key.decode()] = value[:-2]
+            writer.write(b'STORED\r\n')
+        writer.close()
+
+
+class TestAsyncMemcachedLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = memc_load.start_event_loop()
+        self.addCleanup(self.stop_loop)
+
+    def stop_loop(self):
+        # let server handlers see closed connections
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def start_server(self, fake):
+        server = asyncio.run_coroutine_threadsafe(asyncio.start_server(fake.handle, '127.0.0.1', 0), self.loop).result()
+        self.addCleanup(self.loop.call_soon_threadsafe, server.close)
+        return '127.0.0.1:%d' % server.sockets[0].getsockname()[1]
+
+    def make_loader(self, address):
+        loader = memc_load.AsyncMemcachedLoader(address, self.loop, connections=2, max_in_flight=3)
+        self.addCleanup(loader.close)
+        return loader
+
+    def test_load_multi(self):
+        fake = FakeMemcached()
+        loader = self.make_loader(self.start_server(fake))
+        items = {'idfa:%d' % idx: b'value\r\n%d' % idx for idx in range(50)}
+
+        self.assertEqual(loader.load_multi(items), 0)
+        self.assertEqual(fake.data, items)
+        self.assertEqual(fake.connections, 2)
+
+    def test_load(self):
+        fake = FakeMemcached()
+        loader = self.make_loader(self.start_server(fake))
+
+        self.assertTrue(loader.load(memc_load.AppsInstalled('idfa', 'abc', 1.0, 2.0, [1, 2])))
+        self.assertEqual(list(fake.data), ['idfa:abc'])
+
+    def test_reconnect(self):
+        fake = FakeMemcached(drop_after=10)
+        loader = self.make_loader(self.start_server(fake))
+        items = {'idfa:%d' % idx: b'%d' % idx for idx in range(50)}
+
+        self.assertEqual(loader.load_multi(items), 0)
+        self.assertEqual(fake.data, items)
+        self.assertEqual(fake.connections, 3)
+
+    def test_invalid_key(self):
+        fake = FakeMemcached()
+        loader = self.make_loader(self.start_server(fake))
+
+        self.assertEqual(loader.load_multi({'idfa:a b': b'1', 'idfa:c': b'2'}), 1)
+        self.assertEqual(fake.data, {'idfa:c': b'2'})
+
+    def test_unsuccess_connect(self):
+        loader = self.make_loader('127.0.0.1:1')
+        items = {'idfa:%d' % idx: b'%d' % idx for idx in range(50)}
+
+        start = time.monotonic()
+        self.assertEqual(loader.load_multi(items), 50)
+        # one reconnect round per connection, not per key
+        self.assertLess(time.monotonic() - start, memc_load.RECONNECT_TIMEOUT * memc_load.RECONNECT_ATTEMPT_COUNT)
+
+    def test_dry_run(self):
+        loader = memc_load.AsyncMemcachedLoader('127.0.0.1:1', self.loop, dry_run=True)
+        self.assertEqual(loader.load_multi({'idfa:a': b'1'}), 0)
+
+
 class TestMemcachedLoader(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Benchmark of log_analyzer pipeline functions on synthetic logs.
+
+Every case is run several times, the best time is reported. Results
+can be saved as baseline and compared with later runs, the run fails
+if any case is slower than baseline by more than threshold. Baseline
+is valid only on the same machine and with the same log parameters.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+import log_analyzer as logan
+from log_generator import write_log, get_log_name
+
+BENCH_DATE = datetime(2017, 6, 30)
+
+
+def get_log_path(data_dir, params, is_gzip):
+    """
+    Get path of synthetic log, every set of parameters has its own dir
+    :param data_dir: directory with generated logs
+    :param params: log parameters
+    :param is_gzip: is gzipped
+    :return: log file path
+    """
+    params_dir = '{lines}-{urls}-{skew}-{malformed}-{seed}'.format(**params)
+    return os.path.join(data_dir, params_dir,
+                        get_log_name(BENCH_DATE, is_gzip))
+
+
+def prepare_log(data_dir, params, is_gzip):
+    """
+    Generate synthetic log if it's missing
+    :return: log file path
+    """
+    log_path = get_log_path(data_dir, params, is_gzip)
+    if not os.path.exists(log_path):
+        print('Generating {}'.format(log_path))
+        tmp_path = log_path + '.tmp'
+        write_log(tmp_path, params['lines'], is_gzip,
+                  url_count=params['urls'], skew=params['skew'],
+                  malformed_ratio=params['malformed'], date=BENCH_DATE,
+                  seed=params['seed'])
+        os.rename(tmp_path, log_path)
+    return log_path
+
+
+def measure(func, repeat, setup=None):
+    """
+    Get best time of function
+    :param func: function(setup result)
+    :param repeat: number of runs
+    :param setup: function making argument of func, it isn't timed
+    :return: seconds
+    """
+    best = None
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def bench_log(log_path, is_gzip, repeat, workers, report_dir):
+    """
+    Time pipeline functions on log file
+    :param log_path: Log file path
+    :param is_gzip: is gzipped
+    :param repeat: number of runs
+    :param workers: number of processes for parallel case
+    :param report_dir: directory for reports
+    :return: dict of case name -> seconds
+    """
+    fmt = 'gz' if is_gzip else 'plain'
+    results = {}
+
+    if is_gzip:
+        readers = [('gzip_reader', logan.GZIP_READER_TEXT),
+                   ('gzip_reader', logan.GZIP_READER_ZLIB)]
+    else:
+        readers = [('plain_reader', logan.PLAIN_READER_TEXT),
+                   ('plain_reader', logan.PLAIN_READER_MMAP)]
+
+    for option, reader in readers:
+        name = '{}/read_log_file/{}'.format(fmt, reader)
+        kwargs = {option: reader}
+        results[name] = measure(
+            lambda _: consume(logan.read_log_file(log_path, is_gzip,
+                                                  **kwargs)),
+            repeat)
+
+    requests = list(logan.read_log_file(log_path, is_gzip))
+    results[fmt + '/collect_log_stream'] = measure(
+        lambda _: logan.collect_log_stream(requests), repeat)
+
+    stats = logan.collect_log_stream(requests)
+    results[fmt + '/build_parsed_data'] = measure(
+        lambda _: logan.build_parsed_data(stats, 1.0),
+        repeat, setup=lambda: logan.collect_log_stream(requests))
+
+    results[fmt + '/process_data'] = measure(
+        lambda parsed: logan.process_data(parsed, 1000),
+        repeat,
+        setup=lambda: logan.build_parsed_data(
+            logan.collect_log_stream(requests), 1.0))
+
+    data = logan.process_data(logan.build_parsed_data(stats, 1.0), 1000)
+    report_path = os.path.join(report_dir, 'report-{}.html'.format(fmt))
+    results[fmt + '/write_report'] = measure(
+        lambda _: logan.write_report(data, report_path), repeat)
+
+    if not is_gzip and workers > 1:
+        name = '{}/process_log_file_parallel/{}'.format(fmt, workers)
+        results[name] = measure(
+            lambda _: logan.process_log_file_parallel(log_path, 1.0,
+                                                      workers),
+            repeat)
+
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compare results with baseline
+    :param results: dict of case name -> seconds
+    :param baseline: dict of case name -> seconds
+    :param threshold: allowed slowdown, 0.1 is 10%
+    :return: list of (name, seconds, baseline seconds, ratio, regressed)
+    """
+    comparison = []
+    for name in sorted(results):
+        seconds = results[name]
+        base_seconds = baseline.get(name)
+        if not base_seconds:
+            comparison.append((name, seconds, None, None, False))
+            continue
+        ratio = seconds / base_seconds
+        comparison.append((name, seconds, base_seconds, ratio,
+                           ratio > 1.0 + threshold))
+    return comparison
+
+
+def main():
+    argp = argparse.ArgumentParser(description="log_analyzer benchmark")
+    argp.add_argument('--data-dir', default='bench_data',
+                      help='Directory with generated logs')
+    argp.add_argument('--lines', type=int, default=200000,
+                      help='Number of lines of generated log')
+    argp.add_argument('--urls', type=int, default=10000,
+                      help='Number of distinct urls')
+    argp.add_argument('--skew', type=float, default=1.1,
+                      help='Zipf exponent of url popularity')
+    argp.add_argument('--malformed', type=float, default=0.01,
+                      help='Part of lines which can\'t be parsed')
+    argp.add_argument('--seed', type=int, default=0,
+                      help='Random seed')
+    argp.add_argument('--repeat', type=int, default=3,
+                      help='Number of runs, best one is reported')
+    argp.add_argument('--workers', type=int, default=4,
+                      help='Processes for parallel case, 1 to skip it')
+    argp.add_argument('--baseline', default='bench_baseline.json',
+                      help='Baseline results file')
+    argp.add_argument('--save-baseline', action='store_true',
+                      help='Save results as baseline instead of comparing')
+    argp.add_argument('--threshold', type=float, default=0.1,
+                      help='Allowed slowdown against baseline, 0.1 is 10%%')
+    args = argp.parse_args()
+
+    logging.disable(logging.INFO)
+
+    params = {'lines': args.lines, 'urls': args.urls, 'skew': args.skew,
+              'malformed': args.malformed, 'seed': args.seed}
+
+    results = {}
+    report_dir = tempfile.mkdtemp()
+    try:
+        for is_gzip in (False, True):
+            log_path = prepare_log(args.data_dir, params, is_gzip)
+            results.update(bench_log(log_path, is_gzip, args.repeat,
+                                     args.workers, report_dir))
+    finally:
+        shutil.rmtree(report_dir)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'params': params, 'results': results},
+                      baseline_file, indent=2, sort_keys=True)
+        for name in sorted(results):
+            print('{:<45} {:>9.3f} s'.format(name, results[name]))
+        print('Baseline saved: {}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        for name in sorted(results):
+            print('{:<45} {:>9.3f} s'.format(name, results[name]))
+        print('No baseline: {}'.format(args.baseline))
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['params'] != params:
+        print('Baseline was made with other log parameters: {}'
+              .format(baseline['params']))
+        return 2
+
+    regressed = False
+    for name, seconds, base_seconds, ratio, is_regressed in \
+            compare_results(results, baseline['results'], args.threshold):
+        if base_seconds is None:
+            print('{:<45} {:>9.3f} s  (new)'.format(name, seconds))
+            continue
+        print('{:<45} {:>9.3f} s  {:>9.3f} s  x{:.2f}{}'
+              .format(name, seconds, base_seconds, ratio,
+                      '  REGRESSION' if is_regressed else ''))
+        regressed = regressed or is_regressed
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
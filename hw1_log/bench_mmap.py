@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark of plain log readers: throughput and peak RSS.
+Every reader runs in its own process, so peak RSS isn't shared.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+import log_analyzer as logan
+from bench_parser import make_synthetic_lines
+
+READERS = [logan.PLAIN_READER_TEXT, logan.PLAIN_READER_MMAP]
+
+
+def generate_log(log_path, size_mb):
+    """
+    Write synthetic plain log of given size
+    :param log_path: Log file path
+    :param size_mb: size in megabytes
+    """
+    chunk = ''.join(make_synthetic_lines(10000)).encode('utf-8')
+    size = size_mb << 20
+    with open(log_path, 'wb') as log_file:
+        written = 0
+        while written < size:
+            log_file.write(chunk)
+            written += len(chunk)
+
+
+def run_reader(log_path, reader):
+    """
+    Read log file, print json with results
+    :param log_path: Log file path
+    :param reader: read_log_file plain reader
+    """
+    start = time.perf_counter()
+    lines = 0
+    for _ in logan.read_log_file(log_path, False, plain_reader=reader):
+        lines += 1
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'lines': lines, 'seconds': seconds,
+                      'maxrss_mb': maxrss / 1024.0}))
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Plain log reader benchmark")
+    argp.add_argument('--log', default='bench-nginx-access-ui.log',
+                      help='Log file, generated if missing')
+    argp.add_argument('--size-mb', type=int, default=2048,
+                      help='Size of generated log file')
+    argp.add_argument('--run', choices=READERS,
+                      help='Run only one reader in this process')
+    args = argp.parse_args()
+
+    if args.run:
+        run_reader(args.log, args.run)
+        return
+
+    if not os.path.exists(args.log):
+        print('Generating {} MB log: {}'.format(args.size_mb, args.log))
+        generate_log(args.log, args.size_mb)
+
+    size_mb = os.path.getsize(args.log) / float(1 << 20)
+    for reader in READERS:
+        output = subprocess.check_output([sys.executable, __file__,
+                                          '--log', args.log,
+                                          '--run', reader])
+        result = json.loads(output.decode('utf-8'))
+        print('{:<6} {:>10.0f} lines/sec {:>8.1f} MB/sec '
+              'peak RSS {:>8.1f} MB'
+              .format(reader,
+                      result['lines'] / result['seconds'],
+                      size_mb / result['seconds'],
+                      result['maxrss_mb']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of log line parsers on synthetic log
+"""
+import random
+import argparse
+import timeit
+
+import log_analyzer as logan
+
+LOG_LINE_TEMPLATE = '{ip} -  - [29/Jun/2017:03:50:23 +0300] ' \
+                    '"GET {url} HTTP/1.1" 200 {size} "-" "{agent}" "-" ' \
+                    '"1498697422-2118016444-4708-9752774" ' \
+                    '"712e90144abee9" {time:.3f}\n'
+
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 7.0; SM-G930F Build/NRD90M; wv) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 '
+    'Chrome/59.0.3071.125 Mobile Safari/537.36 '
+    '[FB_IAB/FB4A;FBAV/133.0.0.23.68;] (compatible; Googlebot/2.1; '
+    '+http://www.google.com/bot.html) python-requests/2.13.0',
+]
+
+# log_format of LOG_LINE_TEMPLATE for compiled parser
+DEFAULT_LOG_FORMAT = '$remote_addr $remote_user  $http_x_real_ip ' \
+                     '[$time_local] "$request" $status $body_bytes_sent ' \
+                     '"$http_referer" "$http_user_agent" ' \
+                     '"$http_x_forwarded_for" "$http_X_REQUEST_ID" ' \
+                     '"$http_X_RB_USER" $request_time'
+
+
+def make_synthetic_lines(count, seed=0):
+    """
+    Make lines of default nginx log format
+    :param count: number of lines
+    :param seed: random seed
+    :return: list of lines
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        lines.append(LOG_LINE_TEMPLATE.format(
+            ip='.'.join(str(rnd.randint(1, 254)) for _ in range(4)),
+            url='/api/v2/banner/{}'.format(rnd.randint(1, 100000)),
+            size=rnd.randint(100, 100000),
+            agent=rnd.choice(USER_AGENTS),
+            time=rnd.expovariate(5)))
+    return lines
+
+
+def bench(parse_func, lines, repeat):
+    """
+    Get best lines/sec of parse function
+    :param parse_func: parser
+    :param lines: log lines
+    :param repeat: number of runs
+    :return: lines per second
+    """
+    timer = timeit.Timer(lambda: [parse_func(line) for line in lines])
+    return len(lines) / min(timer.repeat(repeat=repeat, number=1))
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Log line parser benchmark")
+    argp.add_argument('--lines', type=int, default=100000,
+                      help='Number of synthetic lines')
+    argp.add_argument('--repeat', type=int, default=3,
+                      help='Number of runs, best one is reported')
+    args = argp.parse_args()
+
+    lines = make_synthetic_lines(args.lines)
+    log_format = logan.compile_log_format(DEFAULT_LOG_FORMAT)
+    parsers = [('regex', logan.parse_log_line_regex),
+               ('split', logan.split_log_line),
+               ('parse_log_line', logan.parse_log_line),
+               ('log_format', log_format.parse_line)]
+
+    byte_lines = [line.encode('utf-8') for line in lines]
+    block = b''.join(byte_lines)
+    results = [(name, bench(parse_func, lines, args.repeat))
+               for name, parse_func in parsers]
+    results.append(('split_bytes', bench(logan.split_log_line_bytes,
+                                         byte_lines, args.repeat)))
+    results.append(('parse_log_block', bench(
+        lambda block: list(logan.parse_log_block(block)), [block],
+        args.repeat) * len(lines)))
+    results.append(('log_format_block', bench(
+        lambda block: list(logan.parse_log_block(block, log_format=(
+            DEFAULT_LOG_FORMAT))), [block], args.repeat) * len(lines)))
+
+    base_speed = results[0][1]
+    for name, speed in results:
+        print('{:<16} {:>12.0f} lines/sec  x{:.2f}'
+              .format(name, speed, speed / base_speed))
+
+
+if __name__ == "__main__":
+    main()
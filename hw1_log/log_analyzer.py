@@ -1,26 +1,166 @@
 #!/usr/bin/env python3
 import os
 import re
+import sys
 import json
 import gzip
+import zlib
+import mmap
+import math
+import bisect
+import time
+import random
 import argparse
 import logging
 import shutil
 import uuid
-from datetime import datetime
+import copy
+import pickle
+import struct
+import resource
+import functools
+import itertools
+import contextlib
+import subprocess
+import multiprocessing
+from array import array
+from datetime import datetime, timezone
 from string import Template
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+from sketches import KllSketch, SpaceSaving
 
 config = {
     "REPORT_SIZE": 1000,
     "REPORT_DIR": "./reports",
     "LOG_DIR": "./log",
     "ERROR_THRESHOLD": 0.6,
-    "LOG_FILE": None
+    "ERROR_EARLY_ABORT": False,
+    "LOG_FILE": None,
+    "WORKERS": 1,
+    "AGGREGATION": "exact",
+    "SKETCH_K": 200,
+    "INCREMENTAL": False,
+    "BACKFILL_WORKERS": 4,
+    "URL_NORMALIZATION": False,
+    "URL_RULES": None,
+    "URL_CACHE_SIZE": 100000,
+    "HEAVY_HITTERS": False,
+    "HEAVY_HITTERS_FACTOR": 4,
+    "AGGREGATE_CACHE": False,
+    "ENGINE": "python",
+    "GZIP_READER": "zlib",
+    "PLAIN_READER": "mmap",
+    "METRICS": False,
+    "METRICS_PROMETHEUS": None,
+    "LOG_FORMAT": None,
+    "TIME_BUCKET": None,
+    "SAMPLE_RATE": None,
+    "SAMPLE_MODE": "blocks",
+    "VHOSTS": [],
+    "BATCH_WORKERS": 4,
+    "BATCH_SUMMARY": None,
+    "REPORT_PAGE_SIZE": None,
+    "FOLLOW_LOG": None,
+    "FOLLOW_WINDOWS": [5, 15, 60],
+    "FOLLOW_INTERVAL": 60,
+    "GZIP_INDEX": False,
+    "GZIP_INDEX_SPAN": 16
 }
 
-RequestInfo = namedtuple('RequestInfo', ['url', 'time'])
-ParsedData = namedtuple('ParsedData', ['data', 'total_time', 'total_count'])
+AGGREGATION_EXACT = 'exact'
+AGGREGATION_SKETCH = 'sketch'
+SKETCH_PERCENTILES = (90, 95, 99)
+
+# error rate is first checked after this number of lines, then after
+# twice as many lines and so on
+ERROR_CHECK_LINES = 10000
+# probability to abort while error rate of the whole log is below
+# threshold, if errors are spread over log evenly
+ERROR_CHECK_DELTA = 1e-6
+
+ENGINE_PYTHON = 'python'
+ENGINE_NUMPY = 'numpy'
+
+GZIP_READER_TEXT = 'text'
+GZIP_READER_ZLIB = 'zlib'
+GZIP_READER_PIGZ = 'pigz'
+GZIP_BLOCK_SIZE = 1 << 20
+
+# checkpoints of gzip index: starts of gzip members or zran access points
+GZIP_INDEX_MEMBERS = 'members'
+GZIP_INDEX_ZRAN = 'zran'
+
+PLAIN_READER_TEXT = 'text'
+PLAIN_READER_MMAP = 'mmap'
+MMAP_WINDOW_SIZE = 16 << 20
+
+# variables of nginx log_format which contain url, the first one
+# present in format is used
+LOG_FORMAT_URL_VARIABLES = ('request', 'request_uri', 'uri')
+LOG_FORMAT_TIME_VARIABLE = 'request_time'
+LOG_FORMAT_TIME_LOCAL_VARIABLE = 'time_local'
+
+# size of quantile sketch of every time bucket of url
+TIMELINE_SKETCH_K = 32
+TIME_LOCAL_MONTHS = {month: idx + 1 for idx, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+
+# index and pages of report are JSONP scripts which call these functions
+# of the template, so they are loaded by <script> tags from file:// too
+REPORT_INDEX_NAME = 'index.js'
+REPORT_INDEX_CALLBACK = 'reportIndex'
+REPORT_PAGE_CALLBACK = 'reportPage'
+
+FOLLOW_REPORT_NAME = 'report-live.html'
+# seconds between checks of followed log file
+FOLLOW_POLL_INTERVAL = 1.0
+# size of quantile sketch of url in every minute of follow mode
+FOLLOW_SKETCH_K = 32
+# statistics of every window in follow mode report
+FOLLOW_COLUMNS = ('count', 'time_sum', 'time_avg', 'time_med', 'time_p95')
+
+SAMPLE_LINES = 'lines'
+SAMPLE_BLOCKS = 'blocks'
+SAMPLE_BLOCK_SIZE = 1 << 20
+# normal quantile of 95% confidence interval of sampled estimates
+SAMPLE_Z = 1.96
+# sampling readers yield it after every sampled line or block
+SAMPLE_CLUSTER_END = object()
+
+# [regex, replacement] pairs, applied to url one by one
+DEFAULT_URL_RULES = [
+    [r'\?.*', '?{query}'],
+    [r'(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+     r'[0-9a-fA-F]{12}(?=[/?]|$)', '{uuid}'],
+    [r'(?<=/)\d+(?=[/?]|$)', '{id}'],
+    [r'(?<=/)[0-9a-fA-F]{16,}(?=[/?]|$)', '{hash}'],
+]
+
+# time_local is set only if readers are asked for it
+RequestInfo = namedtuple('RequestInfo', ['url', 'time', 'time_local'],
+                         defaults=(None,))
+ParsedData = namedtuple('ParsedData', ['data', 'total_time', 'total_count',
+                                       'timelines', 'sample'],
+                        defaults=(None, None))
+LogStats = namedtuple('LogStats', ['data', 'total_count', 'invalid_count',
+                                   'timelines', 'sample'],
+                      defaults=(None, None))
+# sample of population clusters (lines or blocks) and url -> [sum of
+# squared counts, sum of squared time sums] of sampled clusters
+SampleStats = namedtuple('SampleStats', ['population', 'clusters',
+                                         'moments'])
 LogFileShortInfo = namedtuple('LogFileShortInfo', ['name', 'date', 'is_gzip'])
 
 log_line_regex = re.compile(r'[^\"]+'
@@ -30,6 +170,21 @@ log_line_regex = re.compile(r'[^\"]+'
                             r'(?:.|\s)+\s'
                             r'(?P<time>\d+\.\d+)')
 
+# default log format lines of the whole block, only lines which
+# log_line_regex parses the same way are matched, url is ascii
+log_block_regex = re.compile(rb'^[^"\n]+"\w+ (?P<url>[!#-~]+) [^"\n]+"'
+                             rb'[^\n]+ (?P<time>[0-9]+\.[0-9]+)$',
+                             re.MULTILINE)
+
+# the same with time_local, the first square brackets before request
+log_block_time_regex = re.compile(rb'^[^"\n\[]*\[(?P<time_local>[^\]"\n]*)\]'
+                                  rb'[^"\n]*"\w+ (?P<url>[!#-~]+) [^"\n]+"'
+                                  rb'[^\n]+ (?P<time>[0-9]+\.[0-9]+)$',
+                                  re.MULTILINE)
+
+# nginx log_format variable: $name or ${name}
+log_format_variable_regex = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
 log_filename_regex = re.compile(r'nginx-access-ui\.log-'
                                 r'(?P<date>\d{8})(?P<ext>(?:\.gz)?)$')
 
@@ -46,32 +201,265 @@ def make_path(filepath):
         os.makedirs(dirname)
 
 
-def write_report(data, report_path):
+def get_cpu_time():
     """
-    Generate report
-    :param data: data for report
-    :param report_path: report file path
-    :return: success flag
+    CPU time of process and its finished children, e.g. pool workers
+    :return: seconds
     """
-    logging.info("Report generation")
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of process or its largest finished child since
+    start, it's a high-water mark of the whole run, not of one stage
+    :return: bytes
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on linux
+    return max(own, children) * 1024
+
 
+class Telemetry:
+    """
+    Wall time, CPU time, RSS high-water mark and counters of analysis stages
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def get_stage(self, name):
+        """
+        Get metrics of stage, they are summed if stage is run several times
+        :param name: stage name
+        :return: dict of metrics
+        """
+        if name not in self.stages:
+            self.stages[name] = {'wall_time': 0.0, 'cpu_time': 0.0}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure code block as stage, counters can be added to yielded dict
+        :param name: stage name
+        """
+        metrics = self.get_stage(name)
+        wall = time.perf_counter()
+        cpu = get_cpu_time()
+        try:
+            yield metrics
+        finally:
+            metrics['wall_time'] += time.perf_counter() - wall
+            metrics['cpu_time'] += get_cpu_time() - cpu
+            # cumulative, stage gets the peak of the run up to its end
+            metrics['rss_high_water'] = get_peak_rss()
+
+    def timed_iter(self, name, iterable, outer):
+        """
+        Measure time spent inside iterator which is consumed by outer
+        stage. Only wall time is measured per item, CPU time is split
+        between stages in proportion to wall time when outer stage ends,
+        and time of iterator is excluded from outer stage.
+        :param name: stage name of iterator
+        :param iterable: iterable
+        :param outer: stage name of consumer
+        :return: iterator
+        """
+        metrics = self.get_stage(name)
+        outer_metrics = self.get_stage(outer)
+        outer_wall = outer_metrics['wall_time']
+        outer_cpu = outer_metrics['cpu_time']
+
+        iterator = iter(iterable)
+        perf_counter = time.perf_counter
+        wall = 0.0
+        with self.stage(outer):
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    wall += perf_counter() - start
+                    break
+                wall += perf_counter() - start
+                yield item
+
+        total_wall = outer_metrics['wall_time'] - outer_wall
+        total_cpu = outer_metrics['cpu_time'] - outer_cpu
+        cpu = total_cpu * wall / total_wall if total_wall > 0 else 0.0
+        metrics['wall_time'] += wall
+        metrics['cpu_time'] += cpu
+        metrics['rss_high_water'] = outer_metrics['rss_high_water']
+        outer_metrics['wall_time'] -= wall
+        outer_metrics['cpu_time'] -= cpu
+
+    def report(self):
+        """
+        :return: dict of stage metrics with lines per second
+        """
+        stages = {}
+        for name, metrics in self.stages.items():
+            metrics = dict(metrics)
+            wall_time = metrics['wall_time']
+            if 'lines' in metrics and wall_time > 0:
+                metrics['lines_per_sec'] = metrics['lines'] / wall_time
+            stages[name] = metrics
+        return stages
+
+    def write_json(self, metrics_path, **labels):
+        """
+        Write metrics to json file, file is replaced atomically
+        :param metrics_path: target file
+        :param labels: additional fields, e.g. log file name
+        """
+        metrics = dict(labels, stages=self.report())
+        write_file_atomic(metrics_path, json.dumps(metrics, indent=2))
+
+    def write_prometheus(self, metrics_path, **labels):
+        """
+        Write metrics in Prometheus text format, e.g. for node exporter
+        textfile collector, file is replaced atomically
+        :param metrics_path: target file
+        :param labels: labels of every metric
+        """
+        names = [
+            ('wall_time', 'stage_wall_seconds', 'Wall time of stage'),
+            ('cpu_time', 'stage_cpu_seconds', 'CPU time of stage'),
+            ('rss_high_water', 'stage_rss_high_water_bytes',
+             'Peak RSS of run since start, measured at the end of stage'),
+            ('lines_per_sec', 'stage_lines_per_second',
+             'Parsed lines per second'),
+            ('distinct_urls', 'stage_distinct_urls', 'Number of urls'),
+        ]
+        stages = self.report()
+        lines = []
+        for key, name, help_text in names:
+            name = 'log_analyzer_' + name
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for stage, metrics in stages.items():
+                if key not in metrics:
+                    continue
+                stage_labels = dict(labels, stage=stage)
+                label_str = ','.join('{}="{}"'.format(label, value)
+                                     for label, value
+                                     in sorted(stage_labels.items()))
+                lines.append('{}{{{}}} {}'.format(name, label_str,
+                                                  metrics[key]))
+        write_file_atomic(metrics_path, '\n'.join(lines) + '\n')
+
+
+def write_file_atomic(file_path, content):
+    """
+    Write text file through temporary file and move
+    :param file_path: target file
+    :param content: text
+    """
+    make_path(file_path)
+
+    tmp_path = file_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp_path, 'w') as target:
+        target.write(content)
+
+    shutil.move(tmp_path, file_path)
+
+
+def get_template_path():
+    """
+    :return: report template file path
+    """
     template_name = 'report.html'
     data_dir = 'data'
 
-    template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                                 data_dir,
-                                 template_name)
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        data_dir,
+                        template_name)
+
+
+@functools.lru_cache(maxsize=None)
+def load_template(template_path):
+    """
+    Read and compile report template once per process, pool workers
+    forked after loading inherit it
+    :param template_path: template file path
+    :return: Template
+    """
     if not os.path.exists(template_path):
         raise Exception('No template file for report')
 
-    make_path(report_path)
-
     with open(template_path) as template_file:
-        read_template = template_file.read()
-        template = Template(read_template)
+        return Template(template_file.read())
+
+
+def write_report_pages(data, pages_dir, page_size):
+    """
+    Write rows of report as JSONP pages of page_size rows and index of
+    pages. Every page is encoded incrementally, so the whole table is
+    never held as one string. Directory is replaced as a whole.
+    :param data: sorted data for report
+    :param pages_dir: directory of pages
+    :param page_size: number of rows in page
+    :return: number of pages
+    """
+    make_path(pages_dir)
+    tmp_dir = pages_dir + '.' + uuid.uuid4().hex + '.tmp'
+    os.mkdir(tmp_dir)
+
+    encoder = json.JSONEncoder()
+    pages = []
+    for start in range(0, len(data), page_size):
+        page_name = 'page-{:05d}.js'.format(len(pages))
+        with open(os.path.join(tmp_dir, page_name), 'w') as target:
+            target.write(REPORT_PAGE_CALLBACK + '(')
+            target.writelines(encoder.iterencode(
+                data[start:start + page_size]))
+            target.write(');\n')
+        pages.append(page_name)
+
+    index = {'rows': len(data), 'page_size': page_size, 'pages': pages}
+    with open(os.path.join(tmp_dir, REPORT_INDEX_NAME), 'w') as target:
+        target.write('{}({});\n'.format(REPORT_INDEX_CALLBACK,
+                                        json.dumps(index)))
+
+    old_dir = None
+    if os.path.exists(pages_dir):
+        old_dir = pages_dir + '.' + uuid.uuid4().hex + '.old'
+        os.rename(pages_dir, old_dir)
+    os.rename(tmp_dir, pages_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir)
+    return len(pages)
+
+
+def write_report(data, report_path, page_size=None):
+    """
+    Generate report
+    :param data: data for report
+    :param report_path: report file path
+    :param page_size: if set, rows are written to JSONP pages in directory
+                      near the report and loaded by report on scroll
+    :return: success flag
+    """
+    logging.info("Report generation")
+
+    template = load_template(get_template_path())
+    make_path(report_path)
 
-    json_data = json.dumps(data)
-    report = template.safe_substitute(table_json=json_data)
+    if page_size is None:
+        report = template.safe_substitute(table_json=json.dumps(data),
+                                          report_pages='null')
+    else:
+        pages_dir = os.path.splitext(report_path)[0]
+        page_count = write_report_pages(data, pages_dir, page_size)
+        logging.info("Report pages written: {} pages in {}"
+                     .format(page_count, pages_dir))
+        # pages are loaded relative to the report
+        report = template.safe_substitute(
+            table_json='[]',
+            report_pages=json.dumps(os.path.basename(pages_dir)))
 
     tmp_report = report_path + '.' + uuid.uuid4().hex + '.tmp'
     with open(tmp_report, 'w') as target:
@@ -81,9 +469,9 @@ def write_report(data, report_path):
     logging.info("Success: report generated: {}".format(report_path))
 
 
-def parse_log_line(log_line):
+def parse_log_line_regex(log_line):
     """
-    Parse log line
+    Parse log line with log_line_regex
     :param log_line: text string
     :return: RequestInfo
     """
@@ -93,44 +481,1327 @@ def parse_log_line(log_line):
         return RequestInfo(url, time)
 
 
-def read_log_file(log_path, is_gzip):
+def split_log_line(log_line):
+    """
+    Parse log line of default nginx format without regex: request is
+    the first quoted field, request time is the last field of line.
+    Accepts only lines which log_line_regex parses the same way.
+    :param log_line: text string
+    :return: RequestInfo or None if line can't be split
+    """
+    req_start = log_line.find('"')
+    if req_start < 1:
+        return
+    req_end = log_line.find('"', req_start + 1)
+    if req_end < 0:
+        return
+
+    line_end = len(log_line)
+    if log_line.endswith('\n'):
+        line_end -= 1
+    time_start = log_line.rfind(' ', req_end + 2, line_end)
+    if time_start < 0:
+        return
+
+    time = log_line[time_start + 1:line_end]
+    int_part, dot, frac_part = time.partition('.')
+    if not (int_part.isdecimal() and frac_part.isdecimal()):
+        return
+
+    request = log_line[req_start + 1:req_end].split(' ', 2)
+    if len(request) != 3:
+        return
+    method, url, protocol = request
+    if not (method.isalnum() and url.isprintable() and url and protocol):
+        return
+
+    return RequestInfo(url, float(time))
+
+
+def parse_log_line(log_line):
+    """
+    Parse log line, split_log_line with fallback to regex
+    :param log_line: text string
+    :return: RequestInfo
+    """
+    request = split_log_line(log_line)
+    if request is None:
+        request = parse_log_line_regex(log_line)
+    return request
+
+
+def split_log_line_bytes(log_line):
+    """
+    Parse log line of default nginx format given as bytes, the same as
+    split_log_line, but only url is decoded
+    :param log_line: bytes string
+    :return: RequestInfo or None if line can't be split
+    """
+    req_start = log_line.find(b'"')
+    if req_start < 1:
+        return
+    req_end = log_line.find(b'"', req_start + 1)
+    if req_end < 0:
+        return
+
+    line_end = len(log_line)
+    if log_line.endswith(b'\n'):
+        line_end -= 1
+    time_start = log_line.rfind(b' ', req_end + 2, line_end)
+    if time_start < 0:
+        return
+
+    time = log_line[time_start + 1:line_end]
+    int_part, dot, frac_part = time.partition(b'.')
+    if not (int_part.isdigit() and frac_part.isdigit()):
+        return
+
+    request = log_line[req_start + 1:req_end].split(b' ', 2)
+    if len(request) != 3:
+        return
+    method, url, protocol = request
+    if not (method.isalnum() and url and protocol):
+        return
+
+    url = url.decode('utf-8', errors='replace')
+    if not url.isprintable():
+        return
+
+    return RequestInfo(url, float(time))
+
+
+def parse_log_line_bytes(log_line):
+    """
+    Parse log line given as bytes, split_log_line_bytes with fallback
+    to regex on decoded line
+    :param log_line: bytes string
+    :return: RequestInfo
+    """
+    request = split_log_line_bytes(log_line)
+    if request is None:
+        request = parse_log_line_regex(log_line.decode('utf-8',
+                                                       errors='replace'))
+    return request
+
+
+def get_time_local(log_line):
+    """
+    Get $time_local of default format line: text in the first square
+    brackets before request
+    :param log_line: text or bytes string
+    :return: text string or None
+    """
+    if isinstance(log_line, bytes):
+        log_line = log_line.decode('ascii', errors='replace')
+
+    req_start = log_line.find('"')
+    if req_start < 0:
+        req_start = len(log_line)
+    start = log_line.find('[', 0, req_start)
+    if start < 0:
+        return
+    end = log_line.find(']', start + 1, req_start)
+    if end < 0:
+        return
+    return log_line[start + 1:end]
+
+
+def parse_log_line_time(log_line):
+    """
+    Parse log line with time_local
+    :param log_line: text string
+    :return: RequestInfo
+    """
+    request = parse_log_line(log_line)
+    if request is not None:
+        request = RequestInfo(request.url, request.time,
+                              get_time_local(log_line))
+    return request
+
+
+def parse_log_line_bytes_time(log_line):
+    """
+    Parse log line given as bytes with time_local
+    :param log_line: bytes string
+    :return: RequestInfo
+    """
+    request = parse_log_line_bytes(log_line)
+    if request is not None:
+        request = RequestInfo(request.url, request.time,
+                              get_time_local(log_line))
+    return request
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_time_local_day(day, zone):
+    """
+    Get unix time of midnight
+    :param day: 'dd/Mon/yyyy'
+    :param zone: '+hhmm'
+    :return: unix time
+    """
+    midnight = datetime(int(day[7:11]), TIME_LOCAL_MONTHS[day[3:6]],
+                        int(day[0:2]), tzinfo=timezone.utc)
+    offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+    if zone[0] == '-':
+        offset = -offset
+    return int(midnight.timestamp()) - offset
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time_local(time_local):
+    """
+    Parse $time_local, e.g. '29/Jun/2017:03:50:23 +0300', without strptime:
+    midnight is computed once per day, time of day is sliced. Lines of log
+    are ordered by time, so most of calls are cache hits.
+    :param time_local: text string
+    :return: unix time or None if time_local is invalid
+    """
+    if (time_local is None or len(time_local) != 26 or
+            time_local[11] != ':' or time_local[20] != ' '):
+        return
+    try:
+        return (parse_time_local_day(time_local[:11], time_local[21:]) +
+                int(time_local[12:14]) * 3600 +
+                int(time_local[15:17]) * 60 +
+                int(time_local[18:20]))
+    except (KeyError, ValueError):
+        return
+
+
+class LogFormat:
+    """
+    Parser of lines of nginx log_format, compiled once per format.
+
+    Format is compiled into a regex and into a generated split function,
+    which locates url and request time by literals around them with
+    str.find and falls back to the regex for lines it can't split.
+    nginx escapes '"' in variable values, so quotes of format literals
+    are the same quotes in line: the k-th quote is found from the nearest
+    end of line and fields before it don't need to be scanned. Like
+    split_log_line, split function checks only literals around url and
+    request time, other variables and literals are checked by the regex
+    of lines it can't split. If time_local is set, $time_local is parsed
+    too.
+    """
+
+    # patterns of used variables: str regex and ascii bytes block regex
+    patterns = {
+        'request': (r'\w+ (?P<url>[^\s"]+) [^"\n]+',
+                    r'[A-Za-z0-9]+ (?P<url>[!#-~]+) [^"\n]+'),
+        'request_uri': (r'(?P<url>[^\s"]+)', r'(?P<url>[!#-~]+)'),
+        'uri': (r'(?P<url>[^\s"]+)', r'(?P<url>[!#-~]+)'),
+        'request_time': (r'(?P<time>\d+\.\d+)',
+                         r'(?P<time>[0-9]+\.[0-9]+)'),
+    }
+
+    def __init__(self, log_format, time_local=False):
+        """
+        :param log_format: nginx log_format string, e.g.
+                           '$remote_addr [$time_local] "$request" ...'
+        :param time_local: parse $time_local into RequestInfo.time_local
+        """
+        self.log_format = log_format
+        # literals[i] is before variables[i], the last literal is after
+        # the last variable
+        self.literals = []
+        self.variables = []
+        pos = 0
+        for match in log_format_variable_regex.finditer(log_format):
+            self.literals.append(log_format[pos:match.start()])
+            self.variables.append(match.group(1) or match.group(2))
+            pos = match.end()
+        self.literals.append(log_format[pos:])
+
+        self.url_index = None
+        for name in LOG_FORMAT_URL_VARIABLES:
+            if name in self.variables:
+                self.url_index = self.variables.index(name)
+                break
+        if self.url_index is None:
+            raise Exception("No url variable in log format: {}"
+                            .format(', '.join(LOG_FORMAT_URL_VARIABLES)))
+        if LOG_FORMAT_TIME_VARIABLE not in self.variables:
+            raise Exception("No ${} variable in log format"
+                            .format(LOG_FORMAT_TIME_VARIABLE))
+        self.time_index = self.variables.index(LOG_FORMAT_TIME_VARIABLE)
+
+        self.time_local_index = None
+        if time_local:
+            if LOG_FORMAT_TIME_LOCAL_VARIABLE not in self.variables:
+                raise Exception("No ${} variable in log format"
+                                .format(LOG_FORMAT_TIME_LOCAL_VARIABLE))
+            self.time_local_index = self.variables.index(
+                LOG_FORMAT_TIME_LOCAL_VARIABLE)
+
+        self.regex = re.compile(self._make_pattern(0))
+        block_pattern = self._make_split_pattern() or self._make_pattern(1)
+        self.block_regex = re.compile(block_pattern.encode('ascii'),
+                                      re.MULTILINE)
+        self.parse_line = self._compile_split(bytes_line=False)
+        self.parse_line_bytes = self._compile_split(bytes_line=True)
+
+    def _make_pattern(self, kind):
+        """
+        :param kind: 0 - str regex of line, 1 - bytes regex of block
+        :return: regex pattern
+        """
+        parts = ['^']
+        for idx, name in enumerate(self.variables):
+            literal = self.literals[idx]
+            next_literal = self.literals[idx + 1]
+            parts.append(re.escape(literal))
+            if idx == self.time_local_index:
+                parts.append('(?P<time_local>')
+            if idx in (self.url_index, self.time_index):
+                parts.append(self.patterns[name][kind])
+            elif next_literal.startswith('"') or \
+                    not next_literal and idx == len(self.variables) - 1:
+                # value can't contain quote, no backtracking is needed
+                parts.append(r'[^"\n]*')
+            elif kind == 1:
+                # value ends before the first char of the next literal,
+                # lines with this char in value are parsed one by one
+                parts.append(r'[^{}"\n]*'.format(re.escape(next_literal[0])))
+            else:
+                parts.append(r'[^"\n]*?')
+            if idx == self.time_local_index:
+                parts.append(')')
+        parts.append(re.escape(self.literals[-1]))
+        parts.append('$')
+        return ''.join(parts)
+
+    def _make_split_pattern(self):
+        """
+        Block regex which checks only what split function checks, so it
+        is as fast as log_block_regex. It's made if url is found by the
+        first quote or the start of line and request time is the last
+        variable after the last quote, e.g. '... "$request" ... $request_time'
+        :return: bytes regex pattern or None
+        """
+        if self.time_local_index is not None:
+            return None
+
+        url_index, time_index = self.url_index, self.time_index
+        before_url = self.literals[url_index]
+        after_url = self.literals[url_index + 1]
+        before_time = self.literals[time_index]
+        after_time = self.literals[-1]
+        if (time_index != len(self.variables) - 1 or
+                url_index > time_index or '"' in after_time or
+                '"' not in before_time or after_url[:1] not in (' ', '"')):
+            return None
+
+        if url_index == 0:
+            prefix = '^' + re.escape(before_url)
+        elif (before_url.count('"') == 1 and
+              '"' not in ''.join(self.literals[:url_index])):
+            quote = before_url.index('"')
+            prefix = r'^[^"\n]*' + re.escape(before_url[quote:])
+        else:
+            return None
+
+        if url_index + 1 == time_index:
+            middle = re.escape(after_url)
+        else:
+            middle = (re.escape(after_url) + r'[^\n]*' +
+                      re.escape(before_time[before_time.rindex('"'):]))
+
+        return (prefix + self.patterns[self.variables[url_index]][1] +
+                middle + self.patterns[LOG_FORMAT_TIME_VARIABLE][1] +
+                re.escape(after_time) + '$')
+
+    def parse_line_regex(self, log_line):
+        """
+        Parse log line with format regex
+        :param log_line: text string
+        :return: RequestInfo
+        """
+        match = self.regex.match(log_line)
+        if match:
+            if self.time_local_index is not None:
+                return RequestInfo(match.group('url'),
+                                   float(match.group('time')),
+                                   match.group('time_local'))
+            return RequestInfo(match.group('url'),
+                               float(match.group('time')))
+
+    def parse_line_bytes_regex(self, log_line):
+        """
+        Parse log line given as bytes with format regex
+        :param log_line: bytes string
+        :return: RequestInfo
+        """
+        return self.parse_line_regex(log_line.decode('utf-8',
+                                                     errors='replace'))
+
+    def _compile_split(self, bytes_line):
+        """
+        Generate split function for str or bytes lines
+        :return: function(log_line) -> RequestInfo or None
+        """
+        fallback = (self.parse_line_bytes_regex if bytes_line
+                    else self.parse_line_regex)
+
+        if bytes_line:
+            def lit(text):
+                return repr(text.encode('utf-8'))
+            is_digits = 'isdigit'
+        else:
+            lit = repr
+            # isdigit accepts digits which float() doesn't
+            is_digits = 'isdecimal'
+
+        # global indexes of quotes of every literal
+        quotes = []
+        quote_count = 0
+        for literal in self.literals:
+            quotes.append(quote_count)
+            quote_count += literal.count('"')
+
+        code = []
+        known = set()
+        used_quotes = set()
+
+        def quote_pos(k):
+            # position of k-th quote from the nearest end of line
+            name = 'q{}'.format(k)
+            if name in known:
+                return name
+            used_quotes.add(k)
+            if k < quote_count - k:
+                start = '0' if k == 0 else quote_pos(k - 1) + ' + 1'
+                code.append('{} = line.find({}, {})'
+                            .format(name, lit('"'), start))
+            else:
+                end = 'n' if k == quote_count - 1 else \
+                    quote_pos(k + 1)
+                code.append('{} = line.rfind({}, 0, {})'
+                            .format(name, lit('"'), end))
+            code.append('if {} < 0: return fallback(line)'.format(name))
+            known.add(name)
+            return name
+
+        def start_pos(idx):
+            name = 's{}'.format(idx)
+            if name in known:
+                return name
+            literal = self.literals[idx]
+            if '"' in literal:
+                offset = literal.rindex('"')
+                suffix = literal[offset:]
+                quote = quote_pos(quotes[idx] + literal.count('"') - 1)
+                if len(suffix) > 1:
+                    code.append('if not line.startswith({}, {}): '
+                                'return fallback(line)'
+                                .format(lit(suffix), quote))
+                code.append('{} = {} + {}'.format(name, quote, len(suffix)))
+            elif idx == 0:
+                if literal:
+                    code.append('if not line.startswith({}): '
+                                'return fallback(line)'.format(lit(literal)))
+                code.append('{} = {}'.format(name, len(literal)))
+            else:
+                code.append('{} = {} + {}'.format(name, end_pos(idx - 1),
+                                                  len(literal)))
+            known.add(name)
+            return name
+
+        def end_pos(idx):
+            name = 'e{}'.format(idx)
+            if name in known:
+                return name
+            literal = self.literals[idx + 1]
+            start = start_pos(idx)
+            if idx == len(self.variables) - 1:
+                if literal:
+                    code.append('if not line.endswith({}, {}, n): '
+                                'return fallback(line)'
+                                .format(lit(literal), start))
+                code.append('{} = n - {}'.format(name, len(literal))
+                            if literal else '{} = n'.format(name))
+            else:
+                code.append('{} = line.find({}, {})'
+                            .format(name, lit(literal), start))
+                code.append('if {} < 0: return fallback(line)'.format(name))
+            known.add(name)
+            return name
+
+        # adjacent variables can't be split by literal
+        for idx in (self.url_index, self.time_index, self.time_local_index):
+            if idx is None:
+                continue
+            if not self.literals[idx + 1] and \
+                    idx != len(self.variables) - 1:
+                return fallback
+
+        code.append('n = len(line)')
+        code.append('if line.endswith({}): n -= 1'.format(lit('\n')))
+
+        url_name = self.variables[self.url_index]
+        code.append('url = line[{}:{}]'.format(
+            start_pos(self.url_index), end_pos(self.url_index)))
+        if url_name == 'request':
+            code.append('request = url.split({}, 2)'.format(lit(' ')))
+            code.append('if len(request) != 3: return fallback(line)')
+            code.append('method, url, protocol = request')
+            code.append('if not (method.isalnum() and url and protocol): '
+                        'return fallback(line)')
+        else:
+            code.append('if not url or {} in url: return fallback(line)'
+                        .format(lit(' ')))
+        if bytes_line:
+            code.append("url = url.decode('utf-8', errors='replace')")
+        code.append('if not url.isprintable(): return fallback(line)')
+
+        code.append('time = line[{}:{}]'.format(
+            start_pos(self.time_index), end_pos(self.time_index)))
+        code.append('int_part, dot, frac_part = time.partition({})'
+                    .format(lit('.')))
+        code.append('if not (int_part.{0}() and frac_part.{0}()): '
+                    'return fallback(line)'.format(is_digits))
+        if self.time_local_index is None:
+            code.append('return RequestInfo(url, float(time))')
+        else:
+            code.append('time_local = line[{}:{}]'.format(
+                start_pos(self.time_local_index),
+                end_pos(self.time_local_index)))
+            if bytes_line:
+                code.append("time_local = time_local.decode("
+                            "'ascii', errors='replace')")
+            code.append('return RequestInfo(url, float(time), time_local)')
+
+        # the first and the last quotes are found directly, inner quotes
+        # are counted, so the number of quotes must match format
+        if used_quotes - {0, quote_count - 1}:
+            code.insert(0, 'if line.count({}) != {}: return fallback(line)'
+                        .format(lit('"'), quote_count))
+
+        source = 'def split_line(line):\n' + \
+            ''.join('    {}\n'.format(line) for line in code)
+        namespace = {'fallback': fallback, 'RequestInfo': RequestInfo}
+        exec(source, namespace)
+        split_line = namespace['split_line']
+        split_line.source = source
+        return split_line
+
+
+@functools.lru_cache(maxsize=None)
+def compile_log_format(log_format, time_local=False):
+    """
+    Get LogFormat, every format is compiled once per process
+    :param log_format: nginx log_format string
+    :param time_local: parse $time_local too
+    :return: LogFormat
+    """
+    return LogFormat(log_format, time_local)
+
+
+def read_gzip_blocks(log_path, block_size=GZIP_BLOCK_SIZE, offset=0):
+    """
+    Decompress gzip file by large blocks, multi-member files are supported
+    :param log_path: Log file path
+    :param block_size: size of compressed block
+    :param offset: offset of gzip member to start from
+    :return: iterator of decompressed blocks
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_read = False
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(offset)
+        while True:
+            block = log_file.read(block_size)
+            if not block:
+                break
+
+            while block:
+                member_read = True
+                chunk = decompressor.decompress(block)
+                if chunk:
+                    yield chunk
+
+                block = b''
+                if decompressor.eof:
+                    block = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_read = False
+
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+    check_gzip_end(decompressor, member_read)
+
+
+def check_gzip_end(decompressor, member_read):
+    """
+    Raise error on truncated gzip file like gzip module does
+    :param decompressor: decompressor of the last gzip member
+    :param member_read: flag if any data of the last member was read
+    """
+    if member_read and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream "
+                       "marker was reached")
+
+
+def read_pigz_blocks(log_path, block_size=GZIP_BLOCK_SIZE):
+    """
+    Decompress gzip file with external pigz process
+    :param log_path: Log file path
+    :param block_size: size of decompressed block
+    :return: iterator of decompressed blocks
+    """
+    with subprocess.Popen(['pigz', '-dc', log_path],
+                          stdout=subprocess.PIPE) as pigz:
+        while True:
+            chunk = pigz.stdout.read(block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    if pigz.returncode != 0:
+        raise Exception("pigz failed with code {}".format(pigz.returncode))
+
+
+def split_blocks(blocks):
+    """
+    Regroup stream of blocks into blocks of complete lines
+    :param blocks: iterator of bytes
+    :return: iterator of bytes, every block ends with line end
+    """
+    tail = b''
+    for block in blocks:
+        line_end = block.rfind(b'\n') + 1
+        if line_end == 0:
+            tail += block
+            continue
+
+        yield tail + block[:line_end]
+        tail = block[line_end:]
+
+    if tail:
+        yield tail
+
+
+def split_block_lines(blocks):
+    """
+    Split blocks of complete lines into lines, lines are split only on \\n
+    :param blocks: iterator of bytes
+    :return: iterator of lines without line ends
+    """
+    for block in blocks:
+        log_lines = block.split(b'\n')
+        if not log_lines[-1]:
+            log_lines.pop()
+        yield from log_lines
+
+
+def parse_log_block(block, start=0, end=None, log_format=None,
+                    time_local=False):
+    """
+    Parse block of complete lines: lines matched by log_block_regex are
+    parsed at once, other lines are parsed with parse_log_line_bytes.
+    Block isn't copied, only urls of matched lines and skipped lines are.
+    :param block: bytes or buffer, e.g. mmap
+    :param start: offset of the first line
+    :param end: offset after the last line, end of block by default
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return: iterator of RequestInfo or None, one per line
+    """
+    if end is None:
+        end = len(block)
+
+    block_regex = log_block_regex
+    parse_line = parse_log_line_bytes
+    if time_local:
+        block_regex = log_block_time_regex
+        parse_line = parse_log_line_bytes_time
+    if log_format is not None:
+        compiled_format = compile_log_format(log_format, time_local)
+        block_regex = compiled_format.block_regex
+        parse_line = compiled_format.parse_line_bytes
+
+    pos = start
+    for match in block_regex.finditer(block, start, end):
+        match_start = match.start()
+        if match_start > pos:
+            # skipped lines, the last item is empty string after line end
+            for log_line in block[pos:match_start].split(b'\n')[:-1]:
+                yield parse_line(log_line)
+
+        if time_local:
+            yield RequestInfo(match.group('url').decode('ascii'),
+                              float(match.group('time')),
+                              match.group('time_local').decode(
+                                  'ascii', errors='replace'))
+        else:
+            yield RequestInfo(match.group('url').decode('ascii'),
+                              float(match.group('time')))
+        pos = match.end() + 1
+
+    if pos < end:
+        log_lines = block[pos:end].split(b'\n')
+        if not log_lines[-1]:
+            log_lines.pop()
+        for log_line in log_lines:
+            yield parse_line(log_line)
+
+
+def read_log_mmap(log_path, start=0, end=None,
+                  window_size=MMAP_WINDOW_SIZE, log_format=None,
+                  time_local=False):
+    """
+    Parse plain log file mapped to memory. File is parsed by windows
+    of complete lines, pages of parsed windows are released, so resident
+    memory doesn't grow with file size.
+    :param log_path: Log file path
+    :param start: offset of the first line
+    :param end: offset after the last line, file size by default
+    :param window_size: size of window
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return: iterator of RequestInfo or None, one per line
+    """
+    with open(log_path, 'rb') as log_file:
+        if end is None:
+            end = os.fstat(log_file.fileno()).st_size
+        if start >= end:
+            return
+
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+
+            pos = start
+            while pos < end:
+                window_end = end
+                if pos + window_size < end:
+                    window_end = buf.rfind(b'\n', pos, pos + window_size) + 1
+                    if window_end == 0:
+                        window_end = buf.find(b'\n', pos + window_size,
+                                              end) + 1 or end
+
+                yield from parse_log_block(buf, pos, window_end, log_format,
+                                           time_local)
+
+                page_start = pos - pos % mmap.PAGESIZE
+                page_end = window_end - window_end % mmap.PAGESIZE
+                if hasattr(mmap, 'MADV_DONTNEED') and page_end > page_start:
+                    buf.madvise(mmap.MADV_DONTNEED, page_start,
+                                page_end - page_start)
+                pos = window_end
+
+
+def read_log_file(log_path, is_gzip, gzip_reader=GZIP_READER_TEXT,
+                  plain_reader=PLAIN_READER_TEXT, log_format=None,
+                  time_local=False, sample=None):
     """
     Real log file, yield line by line
     :param log_path: Log file path
     :param is_gzip: Is gzipped:
+    :param gzip_reader: 'text' - decode lines with gzip module,
+                        'zlib' - decompress large blocks and parse bytes,
+                        'pigz' - the same with external pigz if available
+    :param plain_reader: 'text' - decode lines of file,
+                         'mmap' - parse file mapped to memory as bytes
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :param sample: LogSample, read only sample of lines if set
     :return:
     """
+    if sample is not None:
+        yield from read_log_sample(log_path, is_gzip, sample, gzip_reader,
+                                   log_format, time_local)
+        return
+
+    if not is_gzip and plain_reader == PLAIN_READER_MMAP:
+        yield from read_log_mmap(log_path, log_format=log_format,
+                                 time_local=time_local)
+        return
+
+    if is_gzip and gzip_reader != GZIP_READER_TEXT:
+        if gzip_reader == GZIP_READER_PIGZ and shutil.which('pigz'):
+            blocks = read_pigz_blocks(log_path)
+        else:
+            blocks = read_gzip_blocks(log_path)
+
+        for block in split_blocks(blocks):
+            yield from parse_log_block(block, log_format=log_format,
+                                       time_local=time_local)
+        return
+
+    parse_line = parse_log_line_time if time_local else parse_log_line
+    if log_format is not None:
+        parse_line = compile_log_format(log_format, time_local).parse_line
+
     open_func = gzip.open if is_gzip else open
     for log_line in open_func(log_path, mode='rt', encoding='utf-8'):
-        yield parse_log_line(log_line)
+        yield parse_line(log_line)
 
 
-def process_log_stream(stream, threshold):
+def split_log_file(log_path, shard_count, start=0, end=None):
     """
-    Parse log stream
+    Split plain log file into byte ranges, every range starts on a line start
+    :param log_path: Log file path
+    :param shard_count: desired number of shards
+    :param start: offset of the first line
+    :param end: offset after the last line, file size by default
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(log_path) if end is None else end
+    bounds = [start]
+    with open(log_path, 'rb') as log_file:
+        for idx in range(1, shard_count):
+            pos = start + (size - start) * idx // shard_count
+            if pos <= bounds[-1]:
+                continue
+
+            # the line that covers pos - 1 belongs to the previous shard
+            log_file.seek(pos - 1)
+            log_file.readline()
+            pos = log_file.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def read_log_shard(log_path, start, end, log_format=None, time_local=False):
+    """
+    Read byte range of plain log file, yield line by line
+    :param log_path: Log file path
+    :param start: offset of the first line
+    :param end: offset after the last line
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return:
+    """
+    return read_log_mmap(log_path, start, end, log_format=log_format,
+                         time_local=time_local)
+
+
+class LogSample:
+    """
+    Uniform random sample of log lines: every step-th line from random
+    offset ('lines') or random blocks of plain log file ('blocks').
+    Sampling readers yield SAMPLE_CLUSTER_END after every sampled line or
+    block and set population, the number of lines or blocks of log.
+    """
+
+    __slots__ = ('rate', 'mode', 'step', 'block_size', 'rnd', 'population')
+
+    def __init__(self, rate, mode=SAMPLE_LINES, block_size=SAMPLE_BLOCK_SIZE,
+                 seed=None):
+        """
+        :param rate: part of lines to read, in (0, 1]
+        :param mode: 'lines' or 'blocks'
+        :param block_size: size of block in 'blocks' mode
+        :param seed: random seed
+        """
+        if not 0 < rate <= 1:
+            raise Exception("Sample rate must be in (0, 1]: {}".format(rate))
+        if mode not in (SAMPLE_LINES, SAMPLE_BLOCKS):
+            raise Exception("Unknown sample mode: {}".format(mode))
+        self.rate = rate
+        self.mode = mode
+        self.step = max(int(round(1.0 / rate)), 1)
+        self.block_size = block_size
+        self.rnd = random.Random(seed)
+        self.population = 0
+
+
+def sample_log_lines(log_lines, sample, parse_line):
+    """
+    Parse every sample.step-th line from random offset
+    :param log_lines: iterator of lines
+    :param sample: LogSample
+    :param parse_line: line parser
+    :return: iterator of RequestInfo or None and SAMPLE_CLUSTER_END
+    """
+    counter = itertools.count()
+    # zip stops on the end of lines before taking the next number,
+    # so the next number is the number of lines
+    numbered_lines = zip(log_lines, counter)
+    offset = sample.rnd.randrange(sample.step)
+    for log_line, _ in itertools.islice(numbered_lines, offset, None,
+                                        sample.step):
+        yield parse_line(log_line)
+        yield SAMPLE_CLUSTER_END
+    sample.population = next(counter)
+
+
+def get_line_start(buf, pos, size):
+    """
+    Get start of the first line which starts at pos or after it
+    :param buf: bytes or buffer
+    :param pos: offset
+    :param size: size of buffer
+    :return: offset of line start or size
+    """
+    if pos <= 0:
+        return 0
+    if pos >= size:
+        return size
+    return buf.find(b'\n', pos - 1, size) + 1 or size
+
+
+def read_log_sample_blocks(log_path, sample, log_format=None,
+                           time_local=False):
+    """
+    Parse random blocks of plain log file, a line belongs to the block
+    where it starts
+    :param log_path: Log file path
+    :param sample: LogSample
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return: iterator of RequestInfo or None and SAMPLE_CLUSTER_END
+    """
+    with open(log_path, 'rb') as log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        block_size = sample.block_size
+        block_count = -(-size // block_size)
+        sample.population = block_count
+        if block_count == 0:
+            return
+
+        sample_size = max(int(round(block_count * sample.rate)), 1)
+        blocks = sorted(sample.rnd.sample(range(block_count), sample_size))
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for idx in blocks:
+                start = get_line_start(buf, idx * block_size, size)
+                end = get_line_start(buf, (idx + 1) * block_size, size)
+                if start < end:
+                    yield from parse_log_block(buf, start, end, log_format,
+                                               time_local)
+                yield SAMPLE_CLUSTER_END
+
+
+def read_log_sample(log_path, is_gzip, sample, gzip_reader=GZIP_READER_TEXT,
+                    log_format=None, time_local=False):
+    """
+    Read uniform random sample of log file lines, lines are parsed as bytes
+    :param log_path: Log file path
+    :param is_gzip: Is gzipped, gzipped log can't be sampled by blocks
+    :param sample: LogSample
+    :param gzip_reader: read_log_file gzip reader
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return: iterator of RequestInfo or None and SAMPLE_CLUSTER_END
+    """
+    if sample.mode == SAMPLE_BLOCKS:
+        if not is_gzip:
+            yield from read_log_sample_blocks(log_path, sample, log_format,
+                                              time_local)
+            return
+        logging.info("Gzip log can't be sampled by blocks, sampling lines")
+
+    parse_line = parse_log_line_bytes_time if time_local else \
+        parse_log_line_bytes
+    if log_format is not None:
+        parse_line = compile_log_format(log_format,
+                                        time_local).parse_line_bytes
+
+    with contextlib.ExitStack() as stack:
+        if is_gzip and gzip_reader != GZIP_READER_TEXT:
+            if gzip_reader == GZIP_READER_PIGZ and shutil.which('pigz'):
+                blocks = read_pigz_blocks(log_path)
+            else:
+                blocks = read_gzip_blocks(log_path)
+            log_lines = split_block_lines(split_blocks(blocks))
+        else:
+            open_func = gzip.open if is_gzip else open
+            log_lines = stack.enter_context(open_func(log_path, 'rb'))
+        yield from sample_log_lines(log_lines, sample, parse_line)
+
+
+class UrlNormalizer:
+    """
+    Replace ids, hashes and query strings of url with placeholders
+    """
+
+    def __init__(self, rules=None, cache_size=100000):
+        """
+        :param rules: list of [regex, replacement], DEFAULT_URL_RULES if None
+        :param cache_size: size of LRU cache of normalized urls
+        """
+        if rules is None:
+            rules = DEFAULT_URL_RULES
+        self.rules = [(re.compile(pattern), replacement)
+                      for pattern, replacement in rules]
+        self.normalize = functools.lru_cache(maxsize=cache_size)(
+            self._normalize)
+
+    def _normalize(self, url):
+        for regex, replacement in self.rules:
+            url = regex.sub(replacement, url)
+        return url
+
+
+class UrlTimes(dict):
+    """
+    Request times of urls: url -> array('d'). Times are kept unboxed,
+    8 bytes per request, url keys are interned when url is added.
+    """
+
+    __slots__ = ('make_times',)
+
+    def __init__(self, make_times):
+        super().__init__()
+        self.make_times = make_times
+
+    def __missing__(self, url):
+        times = self[sys.intern(url)] = self.make_times()
+        return times
+
+
+class UrlTimelines:
+    """
+    Request times of urls by time buckets: url -> {bucket start: sketch}.
+    Only `capacity` urls with the largest time sum are tracked in
+    SpaceSaving summary, every bucket keeps fixed size KllSketch, so
+    memory is bounded by capacity * number of buckets * sketch size.
+    Timeline of url has only requests since the url is tracked.
+    """
+
+    __slots__ = ('step', 'urls')
+
+    def __init__(self, step, capacity):
+        """
+        :param step: bucket size in seconds
+        :param capacity: max number of tracked urls
+        """
+        self.step = step
+        self.urls = SpaceSaving(capacity, dict)
+
+    def add(self, url, time, time_local):
+        """
+        :param url: url
+        :param time: request time
+        :param time_local: $time_local, request isn't added if invalid
+        """
+        timestamp = parse_time_local(time_local)
+        if timestamp is None:
+            return
+        buckets = self.urls.update(url, time)
+        bucket = timestamp - timestamp % self.step
+        sketch = buckets.get(bucket)
+        if sketch is None:
+            sketch = buckets[bucket] = KllSketch(TIMELINE_SKETCH_K)
+        sketch.update(time)
+
+    def merge(self, other):
+        """
+        :param other: UrlTimelines with the same step
+        :return: self
+        """
+        self.urls.merge(other.urls, merge_timeline_buckets)
+        return self
+
+    def bounds(self):
+        """
+        :return: (start of the first bucket, number of buckets) of all urls
+        """
+        buckets = set()
+        for _, _, _, url_buckets in self.urls.items():
+            buckets.update(url_buckets)
+        if not buckets:
+            return None, 0
+        start = min(buckets)
+        return start, (max(buckets) - start) // self.step + 1
+
+    def report(self, url, start):
+        """
+        :param url: url
+        :param start: start of the first bucket of report
+        :return: list of [bucket index, count, time_sum, time_med,
+                 time_p95] of non empty buckets, empty if url isn't tracked
+        """
+        counter = self.urls.counters.get(url)
+        rows = []
+        if counter is None:
+            return rows
+        for bucket, sketch in sorted(counter[2].items()):
+            rows.append([(bucket - start) // self.step, sketch.count,
+                         round(sketch.total, 3),
+                         round(sketch.quantile(0.5), 3),
+                         round(sketch.quantile(0.95), 3)])
+        return rows
+
+
+def merge_timeline_buckets(buckets, other_buckets):
+    """
+    Merge timeline of url
+    :param buckets: dict of bucket start -> KllSketch
+    :param other_buckets: the same
+    :return: merged buckets
+    """
+    for bucket, sketch in other_buckets.items():
+        if bucket in buckets:
+            buckets[bucket].merge(sketch)
+        else:
+            buckets[bucket] = KllSketch(sketch.k).merge(sketch)
+    return buckets
+
+
+class SampleMoments(dict):
+    """
+    Sums of squared counts and time sums of urls in sampled clusters:
+    url -> [sum of count ** 2, sum of time_sum ** 2]. They give variance
+    of totals scaled from sample.
+    """
+
+    __slots__ = ('clusters', 'counts', 'sums')
+
+    def __init__(self):
+        super().__init__()
+        self.clusters = 0
+        self.counts = {}
+        self.sums = {}
+
+    def add(self, url, time):
+        self.counts[url] = self.counts.get(url, 0) + 1
+        self.sums[url] = self.sums.get(url, 0.0) + time
+
+    def end_cluster(self):
+        self.clusters += 1
+        sums = self.sums
+        for url, count in self.counts.items():
+            moments = self.get(url)
+            if moments is None:
+                moments = self[sys.intern(url)] = [0, 0.0]
+            moments[0] += count * count
+            moments[1] += sums[url] * sums[url]
+        self.counts.clear()
+        sums.clear()
+
+    def split_clusters(self, stream):
+        """
+        :param stream: log stream with SAMPLE_CLUSTER_END after clusters
+        :return: log stream without SAMPLE_CLUSTER_END
+        """
+        for request in stream:
+            if request is SAMPLE_CLUSTER_END:
+                self.end_cluster()
+            else:
+                yield request
+
+
+class UrlColumns:
+    """
+    Request times of all urls in two flat arrays: url ids and times.
+    Url id is the index of url in order of first appearance.
+    """
+
+    __slots__ = ('url_ids', 'ids', 'times')
+
+    def __init__(self):
+        self.url_ids = {}
+        self.ids = array('q')
+        self.times = array('d')
+
+    def __len__(self):
+        return len(self.url_ids)
+
+    def urls(self):
+        return list(self.url_ids)
+
+    def add(self, url, time):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[sys.intern(url)] = len(self.url_ids)
+        self.ids.append(url_id)
+        self.times.append(time)
+
+    def merge(self, other):
+        """
+        Append requests of other columns, url ids of other are remapped
+        :param other: UrlColumns
+        :return: self
+        """
+        remap = np.array([self.url_ids.setdefault(url, len(self.url_ids))
+                          for url in other.url_ids], dtype=np.int64)
+        other_ids = np.frombuffer(other.ids, dtype=np.int64)
+        self.ids.frombytes(remap[other_ids].tobytes())
+        self.times.extend(other.times)
+        return self
+
+
+def collect_log_stream(stream, aggregation=AGGREGATION_EXACT, sketch_k=200,
+                       url_rules=None, url_cache_size=100000,
+                       heavy_hitters=None, engine=ENGINE_PYTHON,
+                       error_threshold=None, time_bucket=None,
+                       timeline_urls=4000, sample=None):
+    """
+    Group request times by url
     :param stream: log stream
-    :param threshold: error threshold
-    :return: parsed log info
+    :param aggregation: 'exact' keeps all times in array('d'),
+                        'sketch' keeps KllSketch
+    :param sketch_k: size parameter of sketch
+    :param url_rules: UrlNormalizer rules, urls are not normalized if None
+    :param url_cache_size: size of UrlNormalizer cache
+    :param heavy_hitters: if set, track only this number of urls with
+                          the largest time sum in SpaceSaving summary
+    :param engine: 'python' or 'numpy', numpy engine collects UrlColumns
+                   and supports only exact aggregation
+    :param error_threshold: if set, abort as soon as part of unparsed
+                            lines is above it with high confidence
+    :param time_bucket: if set, collect UrlTimelines with buckets of this
+                        number of seconds, stream must have time_local
+    :param timeline_urls: max number of urls with timelines
+    :param sample: LogSample of sampling reader of stream
+    :return: LogStats, partial aggregate which can be merged
     """
-    logging.info("Trying to parse nginx log stream")
-    data = defaultdict(lambda: {'time_sum': 0.0, 'times': []})
+    if aggregation == AGGREGATION_SKETCH:
+        make_times = functools.partial(KllSketch, sketch_k)
+        add_time = KllSketch.update
+    elif aggregation == AGGREGATION_EXACT:
+        make_times = functools.partial(array, 'd')
+        add_time = array.append
+    else:
+        raise Exception("Unknown aggregation: {}".format(aggregation))
+
+    if engine == ENGINE_NUMPY:
+        if np is None:
+            raise Exception("NumPy engine requires numpy package")
+        if aggregation != AGGREGATION_EXACT or heavy_hitters is not None:
+            raise Exception("NumPy engine supports only exact aggregation")
+
+        data = UrlColumns()
+        add_request = data.add
+    elif engine != ENGINE_PYTHON:
+        raise Exception("Unknown engine: {}".format(engine))
+    elif heavy_hitters is not None:
+        data = SpaceSaving(heavy_hitters, make_times)
+
+        def add_request(url, time):
+            add_time(data.update(url, time), time)
+    else:
+        data = UrlTimes(make_times)
+
+        def add_request(url, time):
+            add_time(data[url], time)
+
+    normalize = None
+    if url_rules is not None:
+        normalize = UrlNormalizer(url_rules, url_cache_size).normalize
+
+    moments = None
+    if sample is not None:
+        moments = SampleMoments()
+        stream = moments.split_clusters(stream)
+        add_collected = add_request
+
+        def add_request(url, time):
+            add_collected(url, time)
+            moments.add(url, time)
+
+    timelines = None
+    add_timeline = None
+    if time_bucket is not None:
+        timelines = UrlTimelines(time_bucket, timeline_urls)
+        add_timeline = timelines.add
 
     invalid_count = 0
     total_count = 0
-    total_time = 0
+    # total_count is never 0 in loop, so 0 disables the check
+    next_check = ERROR_CHECK_LINES if error_threshold is not None else 0
+    check_delta = ERROR_CHECK_DELTA / 2
 
     for request in stream:
 
         total_count += 1
+        if total_count == next_check:
+            check_error_rate(total_count, invalid_count, error_threshold,
+                             check_delta)
+            next_check *= 2
+            check_delta /= 2
+
         if request is None:
             invalid_count += 1
+        elif add_timeline is not None:
+            url = request.url if normalize is None else \
+                normalize(request.url)
+            add_request(url, request.time)
+            add_timeline(url, request.time, request.time_local)
+        elif normalize is None:
+            add_request(request.url, request.time)
         else:
-            url_data = data[request.url]
-            url_data['url'] = request.url
-            url_data['time_sum'] += request.time
-            url_data['times'].append(request.time)
-            total_time += request.time
+            add_request(normalize(request.url), request.time)
+
+    if isinstance(data, UrlTimes):
+        data = dict(data)
+    sample_stats = None
+    if sample is not None:
+        sample_stats = SampleStats(sample.population, moments.clusters,
+                                   dict(moments))
+    return LogStats(data, total_count, invalid_count, timelines,
+                    sample_stats)
+
+
+def merge_url_times(times, other_times):
+    """
+    Merge request times of url
+    :param times: array of times or KllSketch
+    :param other_times: the same type as times
+    :return: merged times
+    """
+    if isinstance(times, KllSketch):
+        return times.merge(other_times)
+
+    times.extend(other_times)
+    return times
 
+
+def merge_log_stats(stats_list):
+    """
+    Merge partial aggregates, order of urls and times is kept
+    :param stats_list: iterable of LogStats
+    :return: LogStats
+    """
+    data = None
+    timelines = None
+    total_count = 0
+    invalid_count = 0
+
+    for stats in stats_list:
+        total_count += stats.total_count
+        invalid_count += stats.invalid_count
+        if stats.timelines is not None:
+            if timelines is None:
+                timelines = stats.timelines
+            else:
+                timelines.merge(stats.timelines)
+        if not stats.data:
+            continue
+
+        if data is None:
+            data = stats.data
+        elif isinstance(data, SpaceSaving):
+            data.merge(stats.data, merge_url_times)
+        elif isinstance(data, UrlColumns):
+            data.merge(stats.data)
+        else:
+            for url, times in stats.data.items():
+                url_times = data.get(url)
+                if url_times is None:
+                    data[sys.intern(url)] = times
+                else:
+                    merge_url_times(url_times, times)
+
+    if data is None:
+        data = {}
+    return LogStats(data, total_count, invalid_count, timelines)
+
+
+def check_error_threshold(total_count, invalid_count, threshold):
+    """
+    Raise exception if part of unparsed lines is above threshold
+    :param total_count: number of lines
+    :param invalid_count: number of unparsed lines
+    :param threshold: error threshold
+    """
     if invalid_count / total_count > threshold:
         raise Exception("Couldn't parse log stream, too much errors")
 
@@ -142,7 +1813,806 @@ def process_log_stream(stream, threshold):
 
     logging.info(msg)
 
-    return ParsedData(list(data.values()), total_time, valid_count)
+
+def check_error_rate(total_count, invalid_count, threshold, delta):
+    """
+    Raise exception if error rate of the whole log is above threshold
+    with probability at least 1 - delta. Lines read so far are treated
+    as a random sample, by Hoeffding inequality true error rate is at
+    least observed rate - sqrt(ln(1 / delta) / (2 * total_count)).
+    :param total_count: number of lines read
+    :param invalid_count: number of unparsed lines read
+    :param threshold: error threshold
+    :param delta: probability of wrong abort
+    """
+    error_rate = invalid_count / total_count
+    margin = math.sqrt(math.log(1.0 / delta) / (2.0 * total_count))
+    if error_rate - margin > threshold:
+        logging.error("Error rate is {:.3f} after {} lines, threshold {}"
+                      .format(error_rate, total_count, threshold))
+        raise Exception("Couldn't parse log stream, too much errors")
+
+
+def make_url_data(url, times):
+    """
+    Make url data for process_data
+    :param url: url
+    :param times: array of times or KllSketch
+    :return: dict
+    """
+    if isinstance(times, KllSketch):
+        return {'url': url, 'time_sum': times.total, 'sketch': times}
+
+    # fsum does not depend on summation order, so sharded and
+    # single process runs give equal results
+    return {'url': url, 'time_sum': math.fsum(times), 'times': times}
+
+
+def build_parsed_data(stats, threshold):
+    """
+    Check error threshold and convert aggregate to ParsedData
+    :param stats: LogStats
+    :param threshold: error threshold
+    :return: parsed log info
+    """
+    invalid_count = stats.invalid_count
+    total_count = stats.total_count
+    check_error_threshold(total_count, invalid_count, threshold)
+
+    if isinstance(stats.data, SpaceSaving):
+        data = []
+        for url, estimate, error, times in stats.data.items():
+            url_data = make_url_data(url, times)
+            url_data['time_sum'] = estimate
+            url_data['time_sum_error'] = error
+            data.append(url_data)
+        total_time = stats.data.total
+    elif isinstance(stats.data, UrlColumns):
+        data = stats.data
+        total_time = math.fsum(data.times)
+    else:
+        data = [make_url_data(url, times)
+                for url, times in stats.data.items()]
+        total_time = math.fsum(url_data['time_sum'] for url_data in data)
+
+    return ParsedData(data, total_time, total_count - invalid_count,
+                      stats.timelines, stats.sample)
+
+
+def process_log_stream(stream, threshold, **options):
+    """
+    Parse log stream
+    :param stream: log stream
+    :param threshold: error threshold
+    :param options: collect_log_stream options
+    :return: parsed log info
+    """
+    logging.info("Trying to parse nginx log stream")
+    stats = collect_log_stream(stream, error_threshold=threshold, **options)
+    return build_parsed_data(stats, threshold)
+
+
+def process_log_shard(shard):
+    """
+    Pool worker, collect aggregate for a part of log file
+    :param shard: tuple (log path, start offset, end offset, options)
+    :return: LogStats
+    """
+    log_path, start, end, options = shard
+    options = dict(options)
+    log_format = options.pop('log_format', None)
+    time_local = options.get('time_bucket') is not None
+    return collect_log_stream(read_log_shard(log_path, start, end,
+                                             log_format, time_local),
+                              **options)
+
+
+def collect_log_range(log_path, start, end, workers, **options):
+    """
+    Collect aggregate for byte range of plain log file
+    :param log_path: Log file path
+    :param start: offset of the first line
+    :param end: offset after the last line
+    :param workers: number of processes
+    :param options: collect_log_stream options and log_format
+    :return: LogStats
+    """
+    if workers <= 1:
+        return process_log_shard((log_path, start, end, options))
+
+    shards = [(log_path, shard_start, shard_end, options)
+              for shard_start, shard_end
+              in split_log_file(log_path, workers, start, end)]
+    with multiprocessing.Pool(workers) as pool:
+        return merge_log_stats(pool.imap(process_log_shard, shards))
+
+
+def process_log_file_parallel(log_path, threshold, workers, **options):
+    """
+    Parse plain log file with a pool of processes
+    :param log_path: Log file path
+    :param threshold: error threshold
+    :param workers: number of processes
+    :param options: collect_log_stream options and log_format
+    :return: parsed log info
+    """
+    logging.info("Trying to parse nginx log file with {} workers"
+                 .format(workers))
+
+    stats = collect_log_range(log_path, 0, os.path.getsize(log_path),
+                              workers, **options)
+    return build_parsed_data(stats, threshold)
+
+
+def find_gzip_members(log_path, span, block_size=GZIP_BLOCK_SIZE):
+    """
+    Find starts of gzip members at least span bytes of uncompressed data
+    apart, decompression can be started from any of them
+    :param log_path: Log file path
+    :param span: minimal uncompressed distance between members
+    :param block_size: size of compressed block
+    :return: (list of [compressed offset, uncompressed offset, flag if
+             uncompressed offset is a line start], uncompressed size)
+    """
+    points = [[0, 0, True]]
+    size = 0
+    last_byte = b'\n'
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member_read = False
+    with open(log_path, 'rb') as log_file:
+        file_size = os.fstat(log_file.fileno()).st_size
+        block_end = 0
+        while True:
+            block = log_file.read(block_size)
+            if not block:
+                break
+            block_end += len(block)
+
+            while block:
+                member_read = True
+                chunk = decompressor.decompress(block)
+                if chunk:
+                    size += len(chunk)
+                    last_byte = chunk[-1:]
+
+                block = b''
+                if decompressor.eof:
+                    block = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    member_read = False
+                    member_start = block_end - len(block)
+                    if (member_start < file_size and
+                            size - points[-1][1] >= span):
+                        points.append([member_start, size,
+                                       last_byte == b'\n'])
+
+    size += len(decompressor.flush())
+    check_gzip_end(decompressor, member_read)
+    return points, size
+
+
+def build_gzip_index(log_path, index_path, span):
+    """
+    Make index of gzip log file for parallel decompression in one pass
+    and save it to json file, zran index of indexed_gzip is saved to
+    index_path + '.zran'. With indexed_gzip decompression can be started
+    near any offset, access points with 32 KB window are made every span
+    bytes. zlib module can't restore decompressor inside of deflate
+    stream, so without indexed_gzip checkpoints are starts of gzip
+    members, e.g. of concatenated gzip files or of `pigz --independent`.
+    :param log_path: Log file path
+    :param index_path: index file path
+    :param span: distance between checkpoints of uncompressed data
+    :return: index dict
+    """
+    logging.info("Building gzip index: {}".format(index_path))
+    index = {'source': get_source_info(log_path), 'span': span}
+    if indexed_gzip is not None:
+        zran_path = index_path + '.zran'
+        make_path(zran_path)
+        tmp_zran = zran_path + '.' + uuid.uuid4().hex + '.tmp'
+        with indexed_gzip.IndexedGzipFile(log_path,
+                                          spacing=span) as gz_file:
+            gz_file.build_full_index()
+            gz_file.export_index(tmp_zran)
+            size = gz_file.seek(0, os.SEEK_END)
+        shutil.move(tmp_zran, zran_path)
+        index.update(backend=GZIP_INDEX_ZRAN, size=size, points=[])
+    else:
+        points, size = find_gzip_members(log_path, span)
+        index.update(backend=GZIP_INDEX_MEMBERS, size=size, points=points)
+
+    write_file_atomic(index_path, json.dumps(index))
+    return index
+
+
+def load_gzip_index(index_path, log_path, span):
+    """
+    Load gzip index saved by build_gzip_index
+    :param index_path: index file path
+    :param log_path: Log file path
+    :param span: distance between checkpoints
+    :return: index dict, None if index is missing or outdated
+    """
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    if index['source'] != get_source_info(log_path) or index['span'] != span:
+        logging.info("Outdated gzip index: {}".format(index_path))
+        return None
+    if index['backend'] == GZIP_INDEX_ZRAN and (
+            indexed_gzip is None or not os.path.exists(index_path + '.zran')):
+        logging.info("Gzip index requires indexed_gzip: {}"
+                     .format(index_path))
+        return None
+    return index
+
+
+def get_gzip_index(log_path, index_path, span):
+    """
+    Load gzip index or build it if it's missing or outdated
+    :param log_path: Log file path
+    :param index_path: index file path
+    :param span: distance between checkpoints
+    :return: index dict with 'path' of index file
+    """
+    index = load_gzip_index(index_path, log_path, span)
+    if index is None:
+        index = build_gzip_index(log_path, index_path, span)
+    index['path'] = index_path
+    return index
+
+
+def split_gzip_index(index, shard_count):
+    """
+    Split uncompressed data of gzip log into ranges starting on checkpoints
+    :param index: gzip index
+    :param shard_count: desired number of shards
+    :return: list of (start, end, member checkpoint or None)
+    """
+    size = index['size']
+    if index['backend'] == GZIP_INDEX_ZRAN:
+        bounds = sorted(set(size * idx // shard_count
+                            for idx in range(shard_count)))
+        return [(start, end, None)
+                for start, end in zip(bounds, bounds[1:] + [size])
+                if start < end]
+
+    points = index['points']
+    offsets = [point[1] for point in points]
+    chosen = [0]
+    for idx in range(1, shard_count):
+        target = size * idx // shard_count
+        pos = bisect.bisect_left(offsets, target)
+        # the nearest checkpoint to target
+        if pos == len(offsets) or (
+                pos > 0 and target - offsets[pos - 1] < offsets[pos] - target):
+            pos -= 1
+        if pos > chosen[-1]:
+            chosen.append(pos)
+
+    ends = [offsets[pos] for pos in chosen[1:]] + [size]
+    return [(offsets[pos], end, points[pos])
+            for pos, end in zip(chosen, ends) if offsets[pos] < end]
+
+
+def read_zran_blocks(log_path, zran_path, offset, block_size=GZIP_BLOCK_SIZE):
+    """
+    Decompress gzip file from uncompressed offset with zran index
+    :param log_path: Log file path
+    :param zran_path: index exported by indexed_gzip
+    :param offset: uncompressed offset
+    :param block_size: size of decompressed block
+    :return: iterator of decompressed blocks
+    """
+    with indexed_gzip.IndexedGzipFile(log_path,
+                                      index_file=zran_path) as gz_file:
+        gz_file.seek(offset)
+        while True:
+            chunk = gz_file.read(block_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def trim_line_range(blocks, pos, skip, end):
+    """
+    Cut lines which start before end from stream of data
+    :param blocks: iterator of bytes
+    :param pos: offset of the first byte of blocks
+    :param skip: drop data through the first line end, it's a part of
+                 line started before
+    :param end: offset, the last line starts before it
+    :return: iterator of bytes
+    """
+    finishing = False
+    for block in blocks:
+        if finishing:
+            line_end = block.find(b'\n')
+            if line_end < 0:
+                yield block
+                continue
+            yield block[:line_end + 1]
+            return
+
+        block_pos = pos
+        pos += len(block)
+        start = 0
+        if skip:
+            line_end = block.find(b'\n')
+            if line_end < 0:
+                continue
+            start = line_end + 1
+            skip = False
+        if block_pos + start >= end:
+            return
+        if pos < end:
+            yield block[start:]
+            continue
+
+        # the last line ends on the first line end after end - 1
+        line_end = block.find(b'\n', end - 1 - block_pos)
+        if line_end >= 0:
+            yield block[start:line_end + 1]
+            return
+        yield block[start:]
+        finishing = True
+
+
+def read_gzip_shard(log_path, index, start, end, point, log_format=None,
+                    time_local=False):
+    """
+    Parse lines of gzip log which start in range of uncompressed data
+    :param log_path: Log file path
+    :param index: gzip index
+    :param start: uncompressed offset of the range
+    :param end: uncompressed offset after the range
+    :param point: member checkpoint of start, None for zran index
+    :param log_format: nginx log_format, default format if None
+    :param time_local: set RequestInfo.time_local
+    :return: iterator of RequestInfo or None, one per line
+    """
+    if index['backend'] == GZIP_INDEX_ZRAN:
+        # the byte before start tells if start is a line start
+        pos = max(start - 1, 0)
+        blocks = read_zran_blocks(log_path, index['path'] + '.zran', pos)
+        skip = start > 0
+    else:
+        offset, pos, is_line_start = point
+        blocks = read_gzip_blocks(log_path, offset=offset)
+        skip = not is_line_start
+
+    for block in split_blocks(trim_line_range(blocks, pos, skip, end)):
+        yield from parse_log_block(block, log_format=log_format,
+                                   time_local=time_local)
+
+
+def process_gzip_shard(shard):
+    """
+    Pool worker, collect aggregate for a range of gzip log file
+    :param shard: tuple (log path, gzip index, start, end, checkpoint,
+                  options)
+    :return: LogStats
+    """
+    log_path, index, start, end, point, options = shard
+    options = dict(options)
+    log_format = options.pop('log_format', None)
+    time_local = options.get('time_bucket') is not None
+    return collect_log_stream(read_gzip_shard(log_path, index, start, end,
+                                              point, log_format, time_local),
+                              **options)
+
+
+def collect_gzip_shards(log_path, index, workers, **options):
+    """
+    Collect aggregate of gzip log file with a pool of processes
+    :param log_path: Log file path
+    :param index: gzip index
+    :param workers: number of processes
+    :param options: collect_log_stream options and log_format
+    :return: LogStats
+    """
+    shards = [(log_path, index, start, end, point, options)
+              for start, end, point in split_gzip_index(index, workers)]
+    logging.info("Gzip log is split into {} shards".format(len(shards)))
+    if len(shards) <= 1:
+        return merge_log_stats(map(process_gzip_shard, shards))
+
+    with multiprocessing.Pool(min(workers, len(shards))) as pool:
+        return merge_log_stats(pool.imap(process_gzip_shard, shards))
+
+
+def find_last_line_end(log_path, start, end, block_size=65536):
+    """
+    Find offset after the last complete line in byte range
+    :param log_path: Log file path
+    :param start: range start
+    :param end: range end
+    :param block_size: size of block read from the end of range
+    :return: offset, start if range has no complete lines
+    """
+    with open(log_path, 'rb') as log_file:
+        pos = end
+        while pos > start:
+            block_start = max(start, pos - block_size)
+            log_file.seek(block_start)
+            block = log_file.read(pos - block_start)
+            idx = block.rfind(b'\n')
+            if idx >= 0:
+                return block_start + idx + 1
+            pos = block_start
+
+    return start
+
+
+def load_state(state_path):
+    """
+    Load state of incremental analysis
+    :param state_path: state file path
+    :return: state dict or None
+    """
+    if not os.path.exists(state_path):
+        return None
+
+    with open(state_path, 'rb') as state_file:
+        return pickle.load(state_file)
+
+
+def save_state(state, state_path):
+    """
+    Save state of incremental analysis, file is replaced atomically
+    :param state: state dict
+    :param state_path: state file path
+    """
+    make_path(state_path)
+
+    tmp_state = state_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp_state, 'wb') as target:
+        pickle.dump(state, target, protocol=pickle.HIGHEST_PROTOCOL)
+
+    shutil.move(tmp_state, state_path)
+
+
+def process_log_file_incremental(log_path, state_path, threshold, workers,
+                                 **options):
+    """
+    Parse lines appended to plain log file since the previous run.
+    State file keeps inode of log file, offset after the last parsed line
+    and aggregate of parsed lines. State is reset if log file was replaced
+    or truncated, or collect options were changed.
+    :param log_path: Log file path
+    :param state_path: state file path
+    :param threshold: error threshold
+    :param workers: number of processes
+    :param options: collect_log_stream options and log_format
+    :return: parsed log info, None if there are no lines yet
+    """
+    stat = os.stat(log_path)
+    state = load_state(state_path)
+    if (state is None or state['inode'] != stat.st_ino or
+            state['offset'] > stat.st_size or state['options'] != options):
+        logging.info("No valid state, parsing log file from the start")
+        state = {'inode': stat.st_ino,
+                 'offset': 0,
+                 'options': options,
+                 'data': {},
+                 'total_count': 0,
+                 'invalid_count': 0}
+
+    start = state['offset']
+    end = find_last_line_end(log_path, start, stat.st_size)
+    logging.info("Trying to parse nginx log file from {} to {} byte"
+                 .format(start, end))
+
+    new_stats = collect_log_range(log_path, start, end, workers, **options)
+    old_stats = LogStats(state['data'], state['total_count'],
+                         state['invalid_count'], state.get('timelines'))
+    stats = merge_log_stats([old_stats, new_stats])
+
+    state.update(offset=end, data=stats.data,
+                 total_count=stats.total_count,
+                 invalid_count=stats.invalid_count,
+                 timelines=stats.timelines)
+    save_state(state, state_path)
+
+    if stats.total_count == 0:
+        logging.info("No lines in log file yet")
+        return None
+
+    return build_parsed_data(stats, threshold)
+
+
+AGGREGATE_CACHE_MAGIC = b'LOGAGG1\n'
+
+
+def is_cacheable(options):
+    """
+    Check if aggregate of collect options can be saved to cache
+    :param options: collect_log_stream options
+    :return: bool
+    """
+    return (options.get('aggregation', AGGREGATION_EXACT) == AGGREGATION_EXACT
+            and options.get('heavy_hitters') is None
+            and options.get('engine', ENGINE_PYTHON) == ENGINE_PYTHON
+            and options.get('time_bucket') is None)
+
+
+def get_source_info(log_path):
+    """
+    Get info used for aggregate cache invalidation
+    :param log_path: Log file path
+    :return: dict
+    """
+    stat = os.stat(log_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def save_aggregate_cache(stats, cache_path, log_path, options):
+    """
+    Save exact aggregate to binary file: magic, length of json header,
+    json header, url table (utf-8 urls separated by new line), array of
+    request counts, array of time sums and array of sorted request times
+    of all urls. File is replaced atomically.
+    :param stats: LogStats with arrays of times
+    :param cache_path: cache file path
+    :param log_path: source log file path
+    :param options: collect_log_stream options
+    """
+    logging.info("Saving aggregate cache: {}".format(cache_path))
+
+    counts = array('Q')
+    sums = array('d')
+    times = array('d')
+    for url_times in stats.data.values():
+        url_times = sorted(url_times)
+        counts.append(len(url_times))
+        sums.append(math.fsum(url_times))
+        times.extend(url_times)
+
+    url_table = '\n'.join(stats.data).encode('utf-8')
+    header = {
+        'source': get_source_info(log_path),
+        'options': options,
+        'byteorder': sys.byteorder,
+        'total_count': stats.total_count,
+        'invalid_count': stats.invalid_count,
+        'url_count': len(counts),
+        'time_count': len(times),
+        'url_table_size': len(url_table),
+    }
+    header = json.dumps(header).encode('utf-8')
+
+    make_path(cache_path)
+    tmp_cache = cache_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp_cache, 'wb') as target:
+        target.write(AGGREGATE_CACHE_MAGIC)
+        target.write(struct.pack('<I', len(header)))
+        target.write(header)
+        target.write(url_table)
+        counts.tofile(target)
+        sums.tofile(target)
+        times.tofile(target)
+
+    shutil.move(tmp_cache, cache_path)
+
+
+def load_aggregate_cache(cache_path, log_path, threshold, options):
+    """
+    Load aggregate cache saved by save_aggregate_cache. Times of url are
+    memoryview slices of one array, so loading doesn't depend on
+    number of requests.
+    :param cache_path: cache file path
+    :param log_path: source log file path
+    :param threshold: error threshold
+    :param options: collect_log_stream options
+    :return: parsed log info, None if cache is missing or outdated
+    """
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'rb') as cache_file:
+        magic = cache_file.read(len(AGGREGATE_CACHE_MAGIC))
+        if magic != AGGREGATE_CACHE_MAGIC:
+            logging.info("Invalid aggregate cache: {}".format(cache_path))
+            return None
+
+        header_size, = struct.unpack('<I', cache_file.read(4))
+        header = json.loads(cache_file.read(header_size).decode('utf-8'))
+        # options are compared in json form, e.g. tuples become lists
+        options = json.loads(json.dumps(options))
+        if (header['source'] != get_source_info(log_path) or
+                header['options'] != options):
+            logging.info("Outdated aggregate cache: {}".format(cache_path))
+            return None
+
+        logging.info("Loading aggregate cache: {}".format(cache_path))
+        url_table = cache_file.read(header['url_table_size'])
+        urls = url_table.decode('utf-8').split('\n')
+        counts = array('Q')
+        counts.fromfile(cache_file, header['url_count'])
+        sums = array('d')
+        sums.fromfile(cache_file, header['url_count'])
+        times = array('d')
+        times.fromfile(cache_file, header['time_count'])
+
+    if header['byteorder'] != sys.byteorder:
+        counts.byteswap()
+        sums.byteswap()
+        times.byteswap()
+
+    total_count = header['total_count']
+    invalid_count = header['invalid_count']
+    check_error_threshold(total_count, invalid_count, threshold)
+
+    data = []
+    times = memoryview(times)
+    start = 0
+    for url, count, time_sum in zip(urls, counts, sums):
+        data.append({'url': url, 'time_sum': time_sum,
+                     'times': times[start:start + count]})
+        start += count
+
+    return ParsedData(data, math.fsum(sums), total_count - invalid_count)
+
+
+def process_columns(parsed_data, report_size):
+    """
+    Process url data collected by numpy engine, statistics of all urls
+    are computed at once on arrays sorted by url id and time
+    :param parsed_data: parsed log data with UrlColumns
+    :param report_size: size of output data
+    :return: processed data
+    """
+    total_count = parsed_data.total_count
+    total_time = parsed_data.total_time
+    columns = parsed_data.data
+    if not columns:
+        return []
+
+    ids = np.frombuffer(columns.ids, dtype=np.int64)
+    times = np.frombuffer(columns.times, dtype=np.float64)
+    order = np.lexsort((times, ids))
+    ids = ids[order]
+    times = times[order]
+
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    counts = np.diff(np.r_[starts, len(ids)])
+    sums = np.add.reduceat(times, starts)
+
+    # reduceat rounds differently from fsum of python engine, so urls
+    # which can be near the last reported one are ranked by fsum,
+    # error of sum of n nonnegative times is below n * eps * sum
+    errors = sums * counts * np.finfo(np.float64).eps
+    if 0 < report_size < len(sums):
+        last = np.argpartition(-sums, report_size - 1)[report_size - 1]
+        top = np.flatnonzero(sums + errors >= sums[last] - errors[last])
+    else:
+        top = np.arange(len(sums))
+    exact_sums = np.array([math.fsum(times[start:start + count])
+                           for start, count in zip(starts[top], counts[top])])
+
+    # stable sort keeps order of first appearance for equal sums
+    ranks = np.argsort(-exact_sums, kind='stable')[:report_size]
+    top = top[ranks]
+    exact_sums = exact_sums[ranks]
+    starts = starts[top]
+    counts = counts[top]
+    url_ids = ids[starts]
+
+    ends = starts + counts
+    centers = starts + counts // 2
+    medians = np.where(counts % 2 == 1, times[centers],
+                       (times[centers] + times[centers - 1]) / 2.0)
+    maxs = times[ends - 1]
+    percentiles = {}
+    for perc in SKETCH_PERCENTILES:
+        ranks = np.ceil(counts * perc / 100.0).astype(np.int64)
+        percentiles[perc] = times[starts + np.maximum(ranks, 1) - 1]
+
+    urls = columns.urls()
+    data = []
+    for idx, url_id in enumerate(url_ids):
+        start, end = int(starts[idx]), int(ends[idx])
+        count = end - start
+        time_sum = float(exact_sums[idx])
+        time_data = {
+            'url': urls[url_id],
+            'count': count,
+            'count_perc': round(count * 100 / total_count, 3),
+            'time_sum': time_sum,
+            'time_perc': round(time_sum * 100 / total_time, 3),
+            'time_avg': round(time_sum / count, 3),
+            'time_max': round(float(maxs[idx]), 3),
+            'time_med': round(float(medians[idx]), 3),
+        }
+        for perc in SKETCH_PERCENTILES:
+            value = float(percentiles[perc][idx])
+            time_data['time_p{}'.format(perc)] = round(value, 3)
+        data.append(time_data)
+
+    return data
+
+
+def add_timelines(data, timelines):
+    """
+    Add timeline of every reported url
+    :param data: processed data
+    :param timelines: UrlTimelines or None
+    :return: data
+    """
+    if timelines is None:
+        return data
+
+    start, size = timelines.bounds()
+    for time_data in data:
+        time_data['timeline'] = {
+            'start': start,
+            'step': timelines.step,
+            'size': size,
+            'buckets': timelines.report(time_data['url'], start),
+        }
+    return data
+
+
+def estimate_total(total, total_sq, population, clusters):
+    """
+    Estimate total of population from simple random sample of clusters
+    :param total: sum of values of sampled clusters
+    :param total_sq: sum of squared values of sampled clusters
+    :param population: number of clusters in population
+    :param clusters: number of sampled clusters
+    :return: (estimate, half-width of 95% confidence interval, None if
+             there are less than 2 clusters)
+    """
+    estimate = total * population / clusters
+    if clusters < 2:
+        return estimate, None
+
+    variance = (total_sq - total * total / clusters) / (clusters - 1)
+    error = population * math.sqrt(max(variance, 0.0) / clusters *
+                                   (1.0 - clusters / population))
+    return estimate, SAMPLE_Z * error
+
+
+def add_sample_errors(data, sample):
+    """
+    Scale counts and time sums of sample up to the whole log and add
+    their 95% confidence intervals, percents of sample are kept
+    :param data: processed data
+    :param sample: SampleStats or None
+    :return: data
+    """
+    if sample is None or sample.clusters == 0:
+        return data
+
+    for time_data in data:
+        count_sq, time_sq = sample.moments.get(time_data['url'], (0, 0.0))
+        count, count_ci = estimate_total(time_data['count'], count_sq,
+                                         sample.population, sample.clusters)
+        time_sum, time_sum_ci = estimate_total(time_data['time_sum'],
+                                               time_sq, sample.population,
+                                               sample.clusters)
+        time_data['count'] = int(round(count))
+        time_data['time_sum'] = time_sum
+        time_data['count_ci'] = None
+        time_data['time_sum_ci'] = None
+        if count_ci is not None:
+            time_data['count_ci'] = int(math.ceil(count_ci))
+            time_data['time_sum_ci'] = round(time_sum_ci, 3)
+    return data
+
+
+def round_time_sums(data):
+    """
+    Round time sums, they are kept exact until sums of sample are scaled
+    :param data: processed data
+    :return: data
+    """
+    for time_data in data:
+        time_data['time_sum'] = round(time_data['time_sum'], 3)
+    return data
 
 
 def process_data(parsed_data, report_size):
@@ -155,6 +2625,14 @@ def process_data(parsed_data, report_size):
 
     logging.info("Processing url data")
 
+    if isinstance(parsed_data.data, UrlColumns):
+        data = process_columns(parsed_data, report_size)
+        add_timelines(data, parsed_data.timelines)
+        add_sample_errors(data, parsed_data.sample)
+        round_time_sums(data)
+        logging.info("Success: url data successfully processed")
+        return data
+
     total_count = parsed_data.total_count
     total_time = parsed_data.total_time
     data = parsed_data.data
@@ -163,20 +2641,34 @@ def process_data(parsed_data, report_size):
     data = data[:min(report_size, len(data))]
 
     for time_data in data:
-        time_data['times'].sort()
-        sorted_times = time_data['times']
-
-        count = len(sorted_times)
-        center_idx = count // 2
-        if count % 2 == 0:
-            time_med = sorted_times[center_idx]
-            time_med += sorted_times[center_idx - 1]
-            time_med = time_med / 2.0
+        # only requests since url is tracked by SpaceSaving are counted
+        time_sum_error = time_data.pop('time_sum_error', None)
+        if time_sum_error is not None:
+            time_data['approx'] = time_sum_error > 0
+
+        sketch = time_data.pop('sketch', None)
+        if sketch is not None:
+            count = sketch.count
+            time_med = sketch.quantile(0.5)
+            time_max = sketch.max
+            for perc in SKETCH_PERCENTILES:
+                value = sketch.quantile(perc / 100.0)
+                time_data['time_p{}'.format(perc)] = round(value, 3)
         else:
-            time_med = sorted_times[center_idx]
+            sorted_times = sorted(time_data.pop('times'))
+
+            count = len(sorted_times)
+            center_idx = count // 2
+            if count % 2 == 0:
+                time_med = sorted_times[center_idx]
+                time_med += sorted_times[center_idx - 1]
+                time_med = time_med / 2.0
+            else:
+                time_med = sorted_times[center_idx]
 
-        time_max = sorted_times[-1]
-        time_avg = time_data['time_sum'] / count
+            time_max = sorted_times[-1]
+
+        time_avg = (time_data['time_sum'] - (time_sum_error or 0.0)) / count
 
         time_data['count'] = count
         time_data['count_perc'] = round(count * 100 / total_count, 3)
@@ -187,10 +2679,10 @@ def process_data(parsed_data, report_size):
         time_data['time_max'] = round(time_max, 3)
         time_data['time_avg'] = round(time_avg, 3)
         time_data['time_med'] = round(time_med, 3)
-        time_data['time_sum'] = round(time_data['time_sum'], 3)
-
-        del time_data['times']
 
+    add_timelines(data, parsed_data.timelines)
+    add_sample_errors(data, parsed_data.sample)
+    round_time_sums(data)
     logging.info("Success: url data successfully processed")
     return data
 
@@ -209,33 +2701,38 @@ def parse_date(date_str):
     return date
 
 
-def find_last_log_from_list(log_dir_iter):
+def find_logs_from_list(log_dir_iter):
     """
-    Find last log file
-    :param regex: compiled filename regex
+    Find all log files, one file for every date
     :param log_dir_iter: listdir iterator
-    :return: filename
+    :return: list of LogFileShortInfo sorted by date
     """
-    res_match = None
-    res_date = None
+    logs = {}
 
     for file in log_dir_iter:
         match = log_filename_regex.match(file)
         if match:
             cur_date = parse_date(match.group('date'))
-            if cur_date is None:
+            if cur_date is None or cur_date in logs:
                 continue
 
-            if res_date is None or cur_date > res_date:
-                res_date = cur_date
-                res_match = match
+            is_gzip = match.group('ext') == '.gz'
+            logs[cur_date] = LogFileShortInfo(file, cur_date, is_gzip)
 
-    if res_match is None:
+    return [logs[date] for date in sorted(logs)]
+
+
+def find_last_log_from_list(log_dir_iter):
+    """
+    Find last log file
+    :param log_dir_iter: listdir iterator
+    :return: filename
+    """
+    logs = find_logs_from_list(log_dir_iter)
+    if not logs:
         return None
 
-    name = res_match.string
-    is_gzip = res_match.group('ext') == '.gz'
-    return LogFileShortInfo(name, res_date, is_gzip)
+    return logs[-1]
 
 
 def find_last_log(log_dir):
@@ -256,29 +2753,630 @@ def find_last_log(log_dir):
     return file_info
 
 
-def main(cfg):
+def collect_options(cfg):
+    """
+    Get collect_log_stream options and log_format from configuration,
+    aggregate depends on all of them
+    :param cfg: configuration
+    :return: dict of options
+    """
+    url_rules = None
+    if cfg['URL_NORMALIZATION']:
+        url_rules = cfg['URL_RULES'] or DEFAULT_URL_RULES
+
+    heavy_hitters = None
+    if cfg['HEAVY_HITTERS']:
+        heavy_hitters = cfg['REPORT_SIZE'] * cfg['HEAVY_HITTERS_FACTOR']
+
+    timeline_urls = None
+    if cfg['TIME_BUCKET'] is not None:
+        timeline_urls = cfg['REPORT_SIZE'] * cfg['HEAVY_HITTERS_FACTOR']
+
+    return {
+        'aggregation': cfg['AGGREGATION'],
+        'sketch_k': cfg['SKETCH_K'],
+        'url_rules': url_rules,
+        'url_cache_size': cfg['URL_CACHE_SIZE'],
+        'heavy_hitters': heavy_hitters,
+        'engine': cfg['ENGINE'],
+        'log_format': cfg['LOG_FORMAT'],
+        'time_bucket': cfg['TIME_BUCKET'],
+        'timeline_urls': timeline_urls,
+    }
+
+
+def get_report_path(report_dir, log_info):
+    """
+    Get report path for log file
+    :param report_dir: directory of reports
+    :param log_info: LogFileShortInfo
+    :return: report file path
+    """
+    report_name = log_info.date.strftime("report-%Y.%m.%d.html")
+    return os.path.join(report_dir, report_name)
+
+
+def find_unreported_logs(log_dir, report_dir):
+    """
+    Find log files without report
+    :param log_dir: directory of log files
+    :param report_dir: directory of reports
+    :return: list of LogFileShortInfo sorted by date
+    """
+    logging.info("Trying to find nginx log files without reports")
+
+    logs = [log_info for log_info in find_logs_from_list(os.listdir(log_dir))
+            if not os.path.exists(get_report_path(report_dir, log_info))]
+
+    logging.info("Found {} nginx log files without reports"
+                 .format(len(logs)))
+    return logs
+
+
+def collect_log_file(log_path, is_gzip, workers,
+                     gzip_reader=GZIP_READER_TEXT,
+                     plain_reader=PLAIN_READER_TEXT, telemetry=None,
+                     log_format=None, sample=None, gzip_index=None,
+                     **options):
+    """
+    Collect aggregate of log file
+    :param log_path: Log file path
+    :param is_gzip: Is gzipped
+    :param workers: number of processes for plain log
+    :param gzip_reader: read_log_file gzip reader
+    :param plain_reader: read_log_file plain reader
+    :param telemetry: Telemetry, stages are measured if set
+    :param log_format: nginx log_format, default format if None
+    :param sample: LogSample, only sample of lines is read in one process
+    :param gzip_index: (index file path, span of checkpoints), gzip log
+                       is parsed by workers if set, index is loaded or
+                       built by get_gzip_index
+    :param options: collect_log_stream options, including error_threshold
+    :return: LogStats
+    """
+    stage = 'process_log_stream'
+    if workers > 1 and is_gzip and gzip_index is not None and sample is None:
+        logging.info("Trying to parse gzip log file with {} workers"
+                     .format(workers))
+        with contextlib.ExitStack() as stack:
+            if telemetry is not None:
+                stack.enter_context(telemetry.stage('build_gzip_index'))
+            index = get_gzip_index(log_path, *gzip_index)
+        with contextlib.ExitStack() as stack:
+            if telemetry is not None:
+                stack.enter_context(telemetry.stage(stage))
+            stats = collect_gzip_shards(log_path, index, workers,
+                                        log_format=log_format, **options)
+    elif workers > 1 and not is_gzip and sample is None:
+        logging.info("Trying to parse nginx log file with {} workers"
+                     .format(workers))
+        # workers read and aggregate lines, stages can't be separated
+        with contextlib.ExitStack() as stack:
+            if telemetry is not None:
+                stack.enter_context(telemetry.stage(stage))
+            stats = collect_log_range(log_path, 0,
+                                      os.path.getsize(log_path),
+                                      workers, log_format=log_format,
+                                      **options)
+    else:
+        logging.info("Trying to parse nginx log stream")
+        time_local = options.get('time_bucket') is not None
+        log_stream = read_log_file(log_path, is_gzip, gzip_reader,
+                                   plain_reader, log_format, time_local,
+                                   sample)
+        if telemetry is not None:
+            log_stream = telemetry.timed_iter('read_log_file', log_stream,
+                                              stage)
+        stats = collect_log_stream(log_stream, sample=sample, **options)
+        if telemetry is not None:
+            telemetry.get_stage('read_log_file')['lines'] = stats.total_count
+
+    if telemetry is not None:
+        metrics = telemetry.get_stage(stage)
+        metrics['lines'] = stats.total_count
+        metrics['distinct_urls'] = len(stats.data)
+    return stats
+
+
+def analyze_log(cfg, log_info, incremental=False, telemetry=None):
+    """
+    Process log file and write report
+    :param cfg: configuration
+    :param log_info: LogFileShortInfo
+    :param incremental: parse only lines appended since the previous run
+    :param telemetry: Telemetry of run, e.g. with log search stage
+    :return: report file path, None if there is no report
+    """
+    if telemetry is None:
+        telemetry = Telemetry()
+
+    report_path = get_report_path(cfg['REPORT_DIR'], log_info)
+    report_base = os.path.splitext(report_path)[0]
+    log_filepath = os.path.join(cfg['LOG_DIR'], log_info.name)
+    options = collect_options(cfg)
+    workers = cfg['WORKERS']
+
+    sample = None
+    if cfg['SAMPLE_RATE'] is not None:
+        sample = LogSample(cfg['SAMPLE_RATE'], cfg['SAMPLE_MODE'])
+        logging.info("Sampling {} of log by {}".format(cfg['SAMPLE_RATE'],
+                                                       cfg['SAMPLE_MODE']))
+
+    gzip_index = None
+    if workers > 1 and log_info.is_gzip:
+        if cfg['GZIP_INDEX'] and sample is None:
+            gzip_index = (report_base + '.gzidx',
+                          cfg['GZIP_INDEX_SPAN'] << 20)
+        else:
+            logging.info("Gzip log can't be split, parsing in one process")
+            workers = 1
+
+    threshold = cfg['ERROR_THRESHOLD']
+    readers = {'gzip_reader': cfg['GZIP_READER'],
+               'plain_reader': cfg['PLAIN_READER'],
+               # per line timing isn't free, measure only if it's written
+               'telemetry': telemetry if cfg['METRICS'] else None,
+               # isn't a part of options, it doesn't change the aggregate
+               'error_threshold':
+                   threshold if cfg['ERROR_EARLY_ABORT'] else None,
+               'sample': sample,
+               'gzip_index': gzip_index}
+
+    if incremental and sample is None:
+        state_path = report_base + '.state'
+        with telemetry.stage('process_log_stream'):
+            data = process_log_file_incremental(log_filepath, state_path,
+                                                threshold, workers, **options)
+        if data is None:
+            return None
+    elif cfg['AGGREGATE_CACHE'] and is_cacheable(options) and sample is None:
+        cache_path = report_base + '.agg'
+        with telemetry.stage('load_aggregate_cache'):
+            data = load_aggregate_cache(cache_path, log_filepath, threshold,
+                                        options)
+        if data is None:
+            stats = collect_log_file(log_filepath, log_info.is_gzip, workers,
+                                     **dict(readers, **options))
+            with telemetry.stage('save_aggregate_cache'):
+                save_aggregate_cache(stats, cache_path, log_filepath, options)
+            data = build_parsed_data(stats, threshold)
+    else:
+        stats = collect_log_file(log_filepath, log_info.is_gzip, workers,
+                                 **dict(readers, **options))
+        data = build_parsed_data(stats, threshold)
+
+    with telemetry.stage('process_data') as metrics:
+        metrics['distinct_urls'] = len(data.data)
+        data = process_data(data, cfg['REPORT_SIZE'])
+
+    with telemetry.stage('write_report'):
+        write_report(data, report_path, cfg['REPORT_PAGE_SIZE'])
+
+    if cfg['METRICS']:
+        labels = {'log': log_info.name}
+        telemetry.write_json(report_base + '.metrics.json', **labels)
+        if cfg['METRICS_PROMETHEUS']:
+            telemetry.write_prometheus(cfg['METRICS_PROMETHEUS'], **labels)
+
+    return report_path
+
+
+def backfill_job(job):
+    """
+    Pool worker, analyze one log file
+    :param job: tuple (configuration, LogFileShortInfo)
+    :return: tuple (log file name, success flag)
+    """
+    cfg, log_info = job
+    try:
+        analyze_log(cfg, log_info)
+    except Exception:
+        logging.exception("Couldn't analyze {}".format(log_info.name))
+        return log_info.name, False
+
+    return log_info.name, True
+
+
+def backfill(cfg):
+    """
+    Analyze every log file without report with a pool of processes
+    :param cfg: configuration
+    :return: list of (log file name, success flag)
+    """
+    logs = find_unreported_logs(cfg['LOG_DIR'], cfg['REPORT_DIR'])
+    if not logs:
+        return []
+
+    # log files are parsed concurrently, so every one gets a single process
+    job_cfg = dict(cfg, WORKERS=1)
+    jobs = [(job_cfg, log_info) for log_info in logs]
+    workers = min(cfg['BACKFILL_WORKERS'], len(jobs))
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(backfill_job, jobs, chunksize=1)
+
+    failed = [name for name, success in results if not success]
+    logging.info("Backfill finished: {} reports generated, {} failed"
+                 .format(len(results) - len(failed), len(failed)))
+    return results
+
+
+class LogFollower:
+    """
+    Read lines appended to log file. File is reopened from the start if
+    path points to other inode (log was rotated, rest of the old file
+    is read first) or file was truncated.
+    """
+
+    def __init__(self, log_path, from_end=True, block_size=MMAP_WINDOW_SIZE):
+        """
+        :param log_path: Log file path
+        :param from_end: skip lines which are in file already
+        :param block_size: maximum size of data read at once
+        """
+        self.log_path = log_path
+        self.block_size = block_size
+        self.log_file = None
+        self.inode = None
+        self.tail = b''
+        self._open(from_end)
+
+    def _open(self, from_end=False):
+        try:
+            log_file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            return
+        self.log_file = log_file
+        self.inode = os.fstat(log_file.fileno()).st_ino
+        self.tail = b''
+        if from_end:
+            log_file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def read(self):
+        """
+        Read new complete lines
+        :return: bytes of lines, empty if there are no new lines
+        """
+        if self.log_file is None:
+            self._open()
+            if self.log_file is None:
+                return b''
+
+        data = self.log_file.read(self.block_size)
+        if not data:
+            try:
+                stat = os.stat(self.log_path)
+            except FileNotFoundError:
+                # rotated, new file isn't created yet
+                return b''
+            if stat.st_ino != self.inode:
+                logging.info("Log file was rotated: {}".format(self.log_path))
+                # the last line of rotated file may have no line end
+                data = self.tail + b'\n' if self.tail else b''
+                self.close()
+                self._open()
+                return data
+            if stat.st_size < self.log_file.tell():
+                logging.info("Log file was truncated: {}"
+                             .format(self.log_path))
+                self.log_file.seek(0)
+                self.tail = b''
+            return b''
+
+        data = self.tail + data
+        line_end = data.rfind(b'\n') + 1
+        self.tail = data[line_end:]
+        return data[:line_end]
+
+
+class RollingStats:
+    """
+    Per url aggregates of the last minutes of log. Every minute has its own
+    SpaceSaving summary of urls with KllSketch of request times, so memory
+    depends only on summary capacity and the longest window. Requests are
+    put into minutes by $time_local.
+    """
+
+    def __init__(self, windows, capacity, sketch_k=FOLLOW_SKETCH_K):
+        """
+        :param windows: window sizes in minutes, e.g. [5, 15, 60]
+        :param capacity: number of urls tracked in every minute
+        :param sketch_k: size of quantile sketch
+        """
+        self.windows = sorted(windows)
+        self.capacity = capacity
+        self.make_times = functools.partial(KllSketch, sketch_k)
+        # minute -> [SpaceSaving, number of lines, number of invalid lines]
+        self.minutes = {}
+
+    def _get_minute(self, minute):
+        counters = self.minutes.get(minute)
+        if counters is None:
+            counters = [SpaceSaving(self.capacity, self.make_times), 0, 0]
+            self.minutes[minute] = counters
+        return counters
+
+    def add(self, url, time, timestamp):
+        """
+        :param url: url
+        :param time: request time
+        :param timestamp: unix time of request
+        """
+        counters = self._get_minute(int(timestamp // 60))
+        counters[0].update(url, time).update(time)
+        counters[1] += 1
+
+    def add_invalid(self, timestamp):
+        counters = self._get_minute(int(timestamp // 60))
+        counters[1] += 1
+        counters[2] += 1
+
+    def expire(self, now):
+        """
+        Drop minutes which are older than the longest window
+        :param now: unix time
+        """
+        first = int(now // 60) - self.windows[-1] + 1
+        for minute in [minute for minute in self.minutes if minute < first]:
+            del self.minutes[minute]
+
+    def report(self, now, report_size):
+        """
+        Get top urls of the longest window with statistics of every window.
+        Minutes are merged from the latest one, the summary is processed
+        when the merged minutes make a window.
+        :param now: unix time
+        :param report_size: number of urls
+        :return: list of rows, keys of window statistics have suffixes,
+                 e.g. count_5m
+        """
+        last = int(now // 60)
+        merged = None
+        total_count = invalid_count = 0
+        windows = []
+        for offset in range(self.windows[-1]):
+            counters = self.minutes.get(last - offset)
+            if counters is not None:
+                # minutes stay unchanged: merge copies values of other summary
+                if merged is None:
+                    merged = copy.deepcopy(counters[0])
+                else:
+                    merged.merge(counters[0], merge_url_times)
+                total_count += counters[1]
+                invalid_count += counters[2]
+
+            if offset + 1 not in self.windows:
+                continue
+            rows = {}
+            if merged is not None and total_count > invalid_count:
+                parsed = build_parsed_data(LogStats(merged, total_count,
+                                                    invalid_count), 1.0)
+                rows = {row['url']: row
+                        for row in process_data(parsed, report_size)}
+            windows.append((offset + 1, rows))
+
+        data = []
+        for url in windows[-1][1]:
+            row = {'url': url}
+            for minutes, rows in windows:
+                window_row = rows.get(url, {})
+                for column in FOLLOW_COLUMNS:
+                    row['{}_{}m'.format(column, minutes)] = \
+                        window_row.get(column)
+                if window_row.get('approx'):
+                    row['approx'] = True
+            data.append(row)
+        return data
+
+
+def follow(cfg, cycles=None):
+    """
+    Tail log file and rewrite live report with rolling window statistics
+    every FOLLOW_INTERVAL seconds. FOLLOW_LOG is followed if set, the last
+    log file of LOG_DIR otherwise.
+    :param cfg: configuration
+    :param cycles: number of poll cycles, infinite if None
+    """
+    report_path = os.path.join(cfg['REPORT_DIR'], FOLLOW_REPORT_NAME)
+    options = collect_options(cfg)
+    normalize = None
+    if options['url_rules'] is not None:
+        normalize = UrlNormalizer(options['url_rules'],
+                                  options['url_cache_size']).normalize
+    stats = RollingStats(cfg['FOLLOW_WINDOWS'],
+                         cfg['REPORT_SIZE'] * cfg['HEAVY_HITTERS_FACTOR'])
+
+    def get_log_path():
+        if cfg['FOLLOW_LOG'] is not None:
+            return cfg['FOLLOW_LOG']
+        log_info = find_last_log(cfg['LOG_DIR'])
+        if log_info is None or log_info.is_gzip:
+            return None
+        return os.path.join(cfg['LOG_DIR'], log_info.name)
+
+    follower = None
+    last_report = time.time()
+    cycle = 0
+    try:
+        while cycles is None or cycle < cycles:
+            cycle += 1
+            if follower is None:
+                log_path = get_log_path()
+                if log_path is not None:
+                    logging.info("Following {}".format(log_path))
+                    follower = LogFollower(log_path)
+
+            block = follower.read() if follower is not None else b''
+            while block:
+                now = time.time()
+                for request in parse_log_block(block,
+                                               log_format=cfg['LOG_FORMAT'],
+                                               time_local=True):
+                    if request is None:
+                        stats.add_invalid(now)
+                        continue
+                    url = request.url if normalize is None else \
+                        normalize(request.url)
+                    timestamp = parse_time_local(request.time_local)
+                    if timestamp is None or timestamp > now:
+                        timestamp = now
+                    stats.add(url, request.time, timestamp)
+                block = follower.read()
+
+            now = time.time()
+            if now - last_report >= cfg['FOLLOW_INTERVAL']:
+                stats.expire(now)
+                write_report(stats.report(now, cfg['REPORT_SIZE']),
+                             report_path, cfg['REPORT_PAGE_SIZE'])
+                last_report = now
+
+                log_path = get_log_path()
+                if follower is not None and \
+                        log_path not in (None, follower.log_path):
+                    # newer log file, the rest of the current one is read
+                    # as of rotated file
+                    logging.info("Following {}".format(log_path))
+                    follower.log_path = log_path
+            elif cycles is None or cycle < cycles:
+                time.sleep(FOLLOW_POLL_INTERVAL)
+    finally:
+        if follower is not None:
+            follower.close()
+
+
+def get_vhosts(cfg):
+    """
+    Get configuration of every vhost of batch mode
+    :param cfg: configuration with VHOSTS, list of dicts with LOG_DIR,
+                REPORT_DIR, optional NAME and other options of vhost
+    :return: list of (vhost name, configuration)
+    """
+    vhosts = []
+    for vhost in cfg['VHOSTS']:
+        vhost = dict(vhost)
+        name = vhost.pop('NAME', None) or vhost['LOG_DIR']
+        vhost_cfg = dict(cfg, **vhost)
+        # vhosts are analyzed concurrently, every one gets one process
+        vhost_cfg.update(VHOSTS=[], WORKERS=1)
+        vhosts.append((name, vhost_cfg))
+    return vhosts
+
+
+def batch_job(job):
+    """
+    Pool worker, analyze the last log file of vhost
+    :param job: tuple (vhost index, vhost name, configuration,
+                LogFileShortInfo, incremental flag)
+    :return: tuple (vhost index, dict of vhost summary)
+    """
+    idx, name, cfg, log_info, incremental = job
+    summary = {'vhost': name, 'log': log_info.name, 'status': 'failed'}
+    telemetry = Telemetry()
+    start = time.perf_counter()
+    try:
+        report_path = analyze_log(cfg, log_info, incremental, telemetry)
+    except Exception as e:
+        logging.exception("Couldn't analyze {}".format(log_info.name))
+        summary['error'] = str(e)
+    else:
+        summary['status'] = 'done' if report_path else 'empty'
+        summary['report'] = report_path
+
+    summary['wall_time'] = round(time.perf_counter() - start, 3)
+    summary['cpu_time'] = round(sum(metrics['cpu_time'] for metrics
+                                    in telemetry.stages.values()), 3)
+    process_metrics = telemetry.stages.get('process_data', {})
+    summary['distinct_urls'] = process_metrics.get('distinct_urls')
+    return idx, summary
+
+
+def batch(cfg, force=False):
+    """
+    Analyze the last log file of every vhost of VHOSTS with a shared
+    pool of processes. The largest log files are scheduled first, so
+    the longest job doesn't start last. Report template is loaded before
+    the pool is started, so workers don't read it again.
+    :param cfg: configuration
+    :param force: regenerate existing reports
+    :return: list of vhost summaries in order of VHOSTS
+    """
+    summaries = []
+    jobs = []
+    for idx, (name, vhost_cfg) in enumerate(get_vhosts(cfg)):
+        summary = {'vhost': name, 'log': None, 'status': 'no_log'}
+        summaries.append(summary)
+        try:
+            log_info = find_last_log(vhost_cfg['LOG_DIR'])
+        except OSError as e:
+            logging.error("Couldn't find log of {}: {}".format(name, e))
+            summary.update(status='failed', error=str(e))
+            continue
+        if log_info is None:
+            continue
+
+        summary['log'] = log_info.name
+        report_path = get_report_path(vhost_cfg['REPORT_DIR'], log_info)
+        incremental = (vhost_cfg['INCREMENTAL'] and not log_info.is_gzip and
+                       vhost_cfg['SAMPLE_RATE'] is None)
+        if os.path.exists(report_path) and not (incremental or force):
+            summary.update(status='exists', report=report_path)
+            continue
+
+        log_size = os.path.getsize(os.path.join(vhost_cfg['LOG_DIR'],
+                                                log_info.name))
+        jobs.append((log_size,
+                     (idx, name, vhost_cfg, log_info, incremental)))
+
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    if jobs:
+        load_template(get_template_path())
+        workers = min(cfg['BATCH_WORKERS'], len(jobs))
+        with multiprocessing.Pool(workers) as pool:
+            for idx, summary in pool.imap_unordered(
+                    batch_job, [job for _, job in jobs], chunksize=1):
+                summaries[idx] = summary
+
+    for summary in summaries:
+        logging.info("Vhost {vhost}: {status}, log {log}, {time}".format(
+            time='{} s'.format(summary['wall_time'])
+            if 'wall_time' in summary else '-', **summary))
+    failed = [summary for summary in summaries
+              if summary['status'] == 'failed']
+    logging.info("Batch finished: {} vhosts, {} failed"
+                 .format(len(summaries), len(failed)))
+
+    if cfg['BATCH_SUMMARY']:
+        write_file_atomic(cfg['BATCH_SUMMARY'],
+                          json.dumps(summaries, indent=2))
+    return summaries
+
+
+def main(cfg, force=False):
     """
     Find last log file, process it and write report
     :param cfg: configuration
+    :param force: regenerate existing report
     :return: success flag
     """
 
-    log_info = find_last_log(cfg['LOG_DIR'])
+    telemetry = Telemetry()
+    with telemetry.stage('find_last_log'):
+        log_info = find_last_log(cfg['LOG_DIR'])
     if log_info is None:
         return
 
-    report_name = log_info.date.strftime("report-%Y.%m.%d.html")
-    report_path = os.path.join(cfg['REPORT_DIR'], report_name)
-    if os.path.exists(report_path):
+    report_path = get_report_path(cfg['REPORT_DIR'], log_info)
+    incremental = (cfg['INCREMENTAL'] and not log_info.is_gzip and
+                   cfg['SAMPLE_RATE'] is None)
+    if os.path.exists(report_path) and not (incremental or force):
         logging.info("Report exists")
         return
 
-    log_filepath = os.path.join(cfg['LOG_DIR'], log_info.name)
-    log_stream = read_log_file(log_filepath, log_info.is_gzip)
-    data = process_log_stream(log_stream, cfg['ERROR_THRESHOLD'])
-
-    data = process_data(data, cfg['REPORT_SIZE'])
-    write_report(data, report_path)
+    analyze_log(cfg, log_info, incremental, telemetry)
 
 
 def read_config(filepath):
@@ -316,12 +3414,46 @@ if __name__ == "__main__":
     argp.add_argument('--config',
                       default='config.json',
                       help='Set config file')
+    argp.add_argument('--workers',
+                      type=int,
+                      help='Number of processes for parsing plain log')
+    argp.add_argument('--backfill',
+                      action='store_true',
+                      help='Analyze every log file without report')
+    argp.add_argument('--force',
+                      action='store_true',
+                      help='Regenerate report of the last log file if exists')
+    argp.add_argument('--sample',
+                      type=float,
+                      help='Read only this part of log, e.g. 0.01')
+    argp.add_argument('--batch',
+                      action='store_true',
+                      help='Analyze the last log file of every vhost')
+    argp.add_argument('--follow',
+                      action='store_true',
+                      help='Tail log file and rewrite live report')
 
     args = argp.parse_args()
     configuration = read_config(args.config)
+    if args.workers is not None:
+        configuration['WORKERS'] = args.workers
+    if args.sample is not None:
+        configuration['SAMPLE_RATE'] = args.sample
     configure_logging(configuration['LOG_FILE'])
 
     try:
-        main(configuration)
+        if configuration['LOG_FORMAT'] is not None:
+            # invalid format fails before any log is read
+            compile_log_format(configuration['LOG_FORMAT'],
+                               args.follow or
+                               configuration['TIME_BUCKET'] is not None)
+        if args.follow:
+            follow(configuration)
+        elif args.batch:
+            batch(configuration, args.force)
+        elif args.backfill:
+            backfill(configuration)
+        else:
+            main(configuration, args.force)
     except BaseException:
         logging.exception("Caught exception")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Generator of synthetic nginx-access-ui logs
+"""
+import os
+import gzip
+import math
+import bisect
+import random
+import argparse
+from datetime import datetime, timedelta
+
+LOG_LINE_FORMAT = '{ip} {user}  {real_ip} [{time_local}] "{method} {url} ' \
+                  'HTTP/1.1" {status} {size} "{referer}" "{agent}" "-" ' \
+                  '"{request_id}" "{rb_user}" {request_time:.3f}\n'
+
+URL_TEMPLATES = [
+    '/api/v2/banner/{id}',
+    '/api/v2/banner/{id}/statistic/?date_from={date}&date_to={date}',
+    '/api/v2/group/{id}/banners',
+    '/api/v2/slot/{id}/groups',
+    '/api/1/campaigns/?id={id}',
+    '/export/appinstall_raw/{date}/',
+    '/agency/outstanding_payments_summary/{id}',
+]
+
+METHODS = ['GET'] * 8 + ['POST', 'HEAD']
+STATUSES = [200] * 20 + [301, 302, 400, 404, 499, 500]
+USER_AGENTS = [
+    '-',
+    'Configovod',
+    'python-requests/2.13.0',
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'Mozilla/5.0 (Linux; Android 7.0; SM-G930F Build/NRD90M; wv) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 '
+    'Chrome/59.0.3071.125 Mobile Safari/537.36 '
+    '[FB_IAB/FB4A;FBAV/133.0.0.23.68;]',
+]
+MALFORMED_LINES = [
+    '{ip} -  - [{time_local}] "-" 400 0 "-" "-" "-" "-" "-" 0.000\n',
+    '{ip} -  - [{time_local}] "GET {url} HTTP/1.1" 200 1018 "-"\n',
+    '{ip} -  - [{time_local}] "\\x16\\x03\\x01" 400 166 "-" "-" 0.001\n',
+    '\n',
+]
+
+
+class LogGenerator:
+    """
+    Random log lines: urls are chosen by Zipf law from a fixed set,
+    request time of url has log-normal distribution with its own scale,
+    time_local grows evenly over the day
+    """
+
+    def __init__(self, url_count=10000, skew=1.1, malformed_ratio=0.0,
+                 date=None, seed=0):
+        """
+        :param url_count: number of distinct urls
+        :param skew: Zipf exponent, 0 is uniform
+        :param malformed_ratio: part of lines which can't be parsed
+        :param date: date of log, datetime
+        :param seed: random seed
+        """
+        self.rnd = random.Random(seed)
+        self.malformed_ratio = malformed_ratio
+        self.date = date or datetime(2017, 6, 30)
+
+        day = self.date.strftime('%Y-%m-%d')
+        self.urls = []
+        self.url_scales = []
+        for idx in range(url_count):
+            template = URL_TEMPLATES[idx % len(URL_TEMPLATES)]
+            self.urls.append(template.format(id=idx + 1, date=day))
+            self.url_scales.append(self.rnd.uniform(-4.0, 0.0))
+
+        weights = [1.0 / math.pow(rank, skew)
+                   for rank in range(1, url_count + 1)]
+        total = sum(weights)
+        self.cumulative = []
+        acc = 0.0
+        for weight in weights:
+            acc += weight / total
+            self.cumulative.append(acc)
+
+    def choose_url(self):
+        idx = bisect.bisect_left(self.cumulative, self.rnd.random())
+        return min(idx, len(self.urls) - 1)
+
+    def make_line(self, time_local):
+        rnd = self.rnd
+        ip = '{}.{}.{}.{}'.format(rnd.randint(1, 223), rnd.randint(0, 255),
+                                  rnd.randint(0, 255), rnd.randint(1, 254))
+        time_local = time_local.strftime('%d/%b/%Y:%H:%M:%S +0300')
+        url_idx = self.choose_url()
+        url = self.urls[url_idx]
+
+        if rnd.random() < self.malformed_ratio:
+            return rnd.choice(MALFORMED_LINES).format(ip=ip, url=url,
+                                                      time_local=time_local)
+
+        request_time = rnd.lognormvariate(self.url_scales[url_idx], 1.0)
+        return LOG_LINE_FORMAT.format(
+            ip=ip,
+            user=rnd.choice(['-', '3b81f63526fa8', 'f032b48fb33e1e692']),
+            real_ip='-',
+            time_local=time_local,
+            method=rnd.choice(METHODS),
+            url=url,
+            status=rnd.choice(STATUSES),
+            size=rnd.randint(0, 100000),
+            referer='-',
+            agent=rnd.choice(USER_AGENTS),
+            request_id='{}-{}-{}-{}'.format(rnd.randint(10 ** 9, 10 ** 10),
+                                            rnd.randint(10 ** 9, 10 ** 10),
+                                            rnd.randint(1000, 9999),
+                                            rnd.randint(10 ** 6, 10 ** 7)),
+            rb_user='{:x}'.format(rnd.getrandbits(56)),
+            request_time=request_time)
+
+    def lines(self, count):
+        """
+        :param count: number of lines
+        :return: iterator of lines
+        """
+        step = timedelta(days=1) / max(count, 1)
+        for idx in range(count):
+            yield self.make_line(self.date + step * idx)
+
+
+def write_log(log_path, line_count, is_gzip=False, **params):
+    """
+    Write synthetic log file
+    :param log_path: Log file path
+    :param line_count: number of lines
+    :param is_gzip: compress log with gzip
+    :param params: LogGenerator parameters
+    :return: log file path
+    """
+    generator = LogGenerator(**params)
+    open_func = gzip.open if is_gzip else open
+    dirname = os.path.dirname(os.path.abspath(log_path))
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    with open_func(log_path, 'wt', encoding='utf-8') as log_file:
+        for line in generator.lines(line_count):
+            log_file.write(line)
+
+    return log_path
+
+
+def get_log_name(date, is_gzip):
+    """
+    Get log file name in nginx-access-ui.log-YYYYMMDD[.gz] format
+    """
+    name = date.strftime('nginx-access-ui.log-%Y%m%d')
+    return name + '.gz' if is_gzip else name
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Synthetic nginx log generator")
+    argp.add_argument('--log-dir', default='log',
+                      help='Output directory')
+    argp.add_argument('--date', default='20170630',
+                      help='Date of log, YYYYMMDD')
+    argp.add_argument('--lines', type=int, default=1000000,
+                      help='Number of lines')
+    argp.add_argument('--urls', type=int, default=10000,
+                      help='Number of distinct urls')
+    argp.add_argument('--skew', type=float, default=1.1,
+                      help='Zipf exponent of url popularity, 0 is uniform')
+    argp.add_argument('--malformed', type=float, default=0.0,
+                      help='Part of lines which can\'t be parsed')
+    argp.add_argument('--gzip', action='store_true',
+                      help='Compress log with gzip')
+    argp.add_argument('--seed', type=int, default=0,
+                      help='Random seed')
+    args = argp.parse_args()
+
+    date = datetime.strptime(args.date, '%Y%m%d')
+    log_path = os.path.join(args.log_dir, get_log_name(date, args.gzip))
+    write_log(log_path, args.lines, args.gzip, url_count=args.urls,
+              skew=args.skew, malformed_ratio=args.malformed, date=date,
+              seed=args.seed)
+    print(log_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Bounded memory summaries of request times
+"""
+import math
+import heapq
+
+
+class KllSketch:
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty).
+
+    Keeps at most about 3 * k values. Count, sum, min and max are exact,
+    quantiles have normalized rank error about 1.7 / k * 100 percent
+    (k = 200 gives about 2% rank error, i.e. reported median is a value
+    whose rank is between 48% and 52% of sorted times). While count <= k
+    the sketch keeps all values and quantiles are exact: nearest rank
+    order statistics, median of even count is the mean of two middle
+    values like in exact aggregation.
+
+    Compactors use alternating offsets instead of random coins,
+    so results are reproducible between runs.
+    """
+
+    __slots__ = ('k', 'count', 'total', 'min', 'max',
+                 'compactors', 'coins', 'max_size')
+
+    def __init__(self, k=200):
+        self.k = k
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.compactors = [[]]
+        self.coins = 0
+        self.max_size = self.capacity(0)
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(int(math.ceil(self.k * (2.0 / 3.0) ** depth)), 2)
+
+    def size(self):
+        return sum(len(items) for items in self.compactors)
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def _compress(self):
+        for level in range(len(self.compactors)):
+            items = self.compactors[level]
+            if len(items) < self.capacity(level):
+                continue
+
+            if level + 1 == len(self.compactors):
+                self._grow()
+
+            items.sort()
+            last = items.pop() if len(items) % 2 else None
+            offset = (self.coins >> level) & 1
+            self.coins ^= 1 << level
+            self.compactors[level + 1].extend(items[offset::2])
+            del items[:]
+            if last is not None:
+                items.append(last)
+
+            if self.size() < self.max_size:
+                break
+
+    def update(self, value):
+        """
+        Add value to sketch
+        :param value: request time
+        """
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        self.compactors[0].append(value)
+        if len(self.compactors[0]) >= self.capacity(0):
+            self._compress()
+
+    def merge(self, other):
+        """
+        Merge other sketch into this one
+        :param other: KllSketch with the same k
+        :return: self
+        """
+        if other.count == 0:
+            return self
+
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.coins ^= other.coins
+
+        while self.size() >= self.max_size:
+            self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Get approximate quantile
+        :param q: quantile in [0, 1]
+        :return: value
+        """
+        if self.count == 0:
+            return None
+
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        if len(self.compactors) == 1:
+            items = sorted(self.compactors[0])
+            center = len(items) // 2
+            if q == 0.5 and len(items) % 2 == 0:
+                return (items[center - 1] + items[center]) / 2.0
+            return items[max(int(math.ceil(q * len(items))), 1) - 1]
+
+        weighted = sorted((value, 1 << level)
+                          for level, items in enumerate(self.compactors)
+                          for value in items)
+        total_weight = sum(weight for _, weight in weighted)
+        target = q * total_weight
+
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return self.max
+
+
+class SpaceSaving:
+    """
+    Weighted Space-Saving summary (Metwally, Agrawal, El Abbadi).
+
+    Tracks at most `capacity` keys with the largest weights. For every
+    tracked key estimate - error <= true weight <= estimate, error is at
+    most total / capacity, and every key with true weight above
+    total / capacity is tracked. Every tracked key has a value created
+    by make_value, it accumulates only updates since the key is tracked.
+    """
+
+    __slots__ = ('capacity', 'make_value', 'counters', 'heap', 'total')
+
+    def __init__(self, capacity, make_value=list):
+        self.capacity = capacity
+        self.make_value = make_value
+        # key -> [estimate, error, value]
+        self.counters = {}
+        # (estimate, key), may contain outdated entries
+        self.heap = []
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.counters)
+
+    def items(self):
+        """
+        :return: iterator of (key, estimate, error, value)
+        """
+        for key, (estimate, error, value) in self.counters.items():
+            yield key, estimate, error, value
+
+    def min_estimate(self):
+        """
+        Upper bound of weight of any key which is not tracked
+        """
+        if len(self.counters) < self.capacity:
+            return 0.0
+        return min(counter[0] for counter in self.counters.values())
+
+    def _push(self, estimate, key):
+        heapq.heappush(self.heap, (estimate, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(counter[0], key)
+                         for key, counter in self.counters.items()]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while True:
+            estimate, key = heapq.heappop(self.heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == estimate:
+                del self.counters[key]
+                return estimate
+
+    def update(self, key, weight):
+        """
+        Add weight to key
+        :param key: key
+        :param weight: non negative weight
+        :return: value of key
+        """
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        else:
+            error = 0.0
+            if len(self.counters) >= self.capacity:
+                error = self._pop_min()
+            counter = [error + weight, error, self.make_value()]
+            self.counters[key] = counter
+
+        self._push(counter[0], key)
+        return counter[2]
+
+    def merge(self, other, merge_value):
+        """
+        Merge other summary into this one. Values of keys which are only
+        in other are merged into new values, so other isn't shared.
+        :param other: SpaceSaving
+        :param merge_value: function(value, other value) -> merged value,
+                            it must not keep other value
+        :return: self
+        """
+        self_min = self.min_estimate()
+        other_min = other.min_estimate()
+
+        counters = {}
+        for key, (estimate, error, value) in self.counters.items():
+            other_counter = other.counters.get(key)
+            if other_counter is None:
+                counters[key] = [estimate + other_min, error + other_min,
+                                 value]
+            else:
+                counters[key] = [estimate + other_counter[0],
+                                 error + other_counter[1],
+                                 merge_value(value, other_counter[2])]
+
+        for key, (estimate, error, value) in other.counters.items():
+            if key not in counters:
+                counters[key] = [estimate + self_min, error + self_min,
+                                 merge_value(self.make_value(), value)]
+
+        if len(counters) > self.capacity:
+            top = heapq.nlargest(self.capacity, counters.items(),
+                                 key=lambda item: item[1][0])
+            counters = dict(top)
+
+        self.counters = counters
+        self.total += other.total
+        self.heap = [(counter[0], key) for key, counter in counters.items()]
+        heapq.heapify(self.heap)
+        return self
@@ -1,9 +1,44 @@
+import os
+import sys
+import json
+import math
+import gzip
+import random
+import shutil
+import tempfile
 import unittest
 import itertools as it
+from array import array
 from datetime import datetime
 import log_analyzer as logan
 
 
+LOG_LINE_TEMPLATE = '1.169.137.128 -  - [29/Jun/2017:03:50:23 +0300] ' \
+                    '"GET {} HTTP/1.1" 200 1018 "-" "Configovod" "-" ' \
+                    '"1498697422-2118016444-4708-9752774" ' \
+                    '"712e90144abee9" {}\n'
+
+
+def make_log_lines(count, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        if rnd.random() < 0.05:
+            lines.append('broken line\n')
+            continue
+        url = '/api/v2/banner/{}'.format(rnd.randint(1, 50))
+        time = '{:.3f}'.format(rnd.random() * 2)
+        lines.append(LOG_LINE_TEMPLATE.format(url, time))
+    return lines
+
+
+def write_temp_log(lines):
+    fd, log_path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as fp:
+        fp.writelines(lines)
+    return log_path
+
+
 class TestLogAnalyzer(unittest.TestCase):
 
     def test_regex_filename(self):
@@ -81,6 +116,32 @@ class TestLogAnalyzer(unittest.TestCase):
         self.assertEqual(logan.parse_log_line(a2), None)
         self.assertEqual(logan.parse_log_line(a3), None)
 
+    def test_split_log_line(self):
+        """
+        Check fast parser accepts only lines which regex parses the same way
+        """
+
+        line = LOG_LINE_TEMPLATE.format('/api/1', '0.181')
+        self.assertEqual(logan.split_log_line(line),
+                         logan.RequestInfo('/api/1', 0.181))
+
+        lines = [
+            line.replace('0.181', '0.181 x'),
+            line.replace('"GET', '"GET '),
+            line.replace('HTTP/1.1', 'HTTP/1.1" x "'),
+            line.replace('/api/1', '/api/"1'),
+            line.replace('/api/1', '/api\t1'),
+            line.replace('0.181', '0181'),
+            line.replace('" 0.181', '"0.181'),
+            line[line.index('"'):],
+        ]
+        for line in lines:
+            request = logan.split_log_line(line)
+            if request is not None:
+                self.assertEqual(request, logan.parse_log_line_regex(line))
+            self.assertEqual(logan.parse_log_line(line),
+                             logan.parse_log_line_regex(line))
+
     def test_process_log_stream(self):
         stream = [logan.RequestInfo('/v1', 0.1),
                   logan.RequestInfo('/v2', 0.2),
@@ -138,6 +199,929 @@ class TestLogAnalyzer(unittest.TestCase):
         self.assertAlmostEqual(row['time_avg'], 2)
         self.assertAlmostEqual(row['time_sum'], 6)
 
+    def test_split_log_file(self):
+        lines = make_log_lines(100)
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+
+        shards = logan.split_log_file(log_path, 7)
+        self.assertEqual(shards[0][0], 0)
+        self.assertEqual(shards[-1][1], os.path.getsize(log_path))
+
+        line_starts = set(it.accumulate(len(line) for line in lines))
+        line_starts.add(0)
+        for (start, end), (next_start, _) in zip(shards, shards[1:]):
+            self.assertEqual(end, next_start)
+            self.assertIn(next_start, line_starts)
+
+        requests = [request for start, end in shards
+                    for request in logan.read_log_shard(log_path, start, end)]
+        self.assertEqual(requests, [logan.parse_log_line(line)
+                                    for line in lines])
+
+    def test_process_log_file_parallel(self):
+        log_path = write_temp_log(make_log_lines(1000))
+        self.addCleanup(os.remove, log_path)
+
+        stream = logan.read_log_file(log_path, False)
+        expected = logan.process_log_stream(stream, 0.5)
+        parsed = logan.process_log_file_parallel(log_path, 0.5, 3)
+
+        self.assertEqual(parsed.total_count, expected.total_count)
+        self.assertEqual(parsed.total_time, expected.total_time)
+        self.assertEqual(logan.process_data(parsed, 20),
+                         logan.process_data(expected, 20))
+
+    def test_process_log_sketch(self):
+        log_path = write_temp_log(make_log_lines(1000))
+        self.addCleanup(os.remove, log_path)
+
+        stream = logan.read_log_file(log_path, False)
+        expected = logan.process_data(logan.process_log_stream(stream, 0.5),
+                                      10)
+
+        stream = logan.read_log_file(log_path, False)
+        parsed = logan.process_log_stream(stream, 0.5,
+                                          aggregation='sketch', sketch_k=8)
+        data = logan.process_data(parsed, 10)
+
+        self.assertEqual(len(data), len(expected))
+        for row, expected_row in zip(data, expected):
+            self.assertEqual(row['url'], expected_row['url'])
+            self.assertEqual(row['count'], expected_row['count'])
+            self.assertEqual(row['time_max'], expected_row['time_max'])
+            self.assertAlmostEqual(row['time_sum'], expected_row['time_sum'])
+            self.assertAlmostEqual(row['time_med'], expected_row['time_med'],
+                                   delta=0.5)
+            self.assertLessEqual(row['time_med'], row['time_p90'])
+            self.assertLessEqual(row['time_p90'], row['time_p99'])
+            self.assertNotIn('sketch', row)
+
+    def test_process_log_file_incremental(self):
+        lines = make_log_lines(300)
+        log_path = write_temp_log(lines[:100])
+        state_path = log_path + '.state'
+        self.addCleanup(os.remove, log_path)
+        self.addCleanup(os.remove, state_path)
+
+        parsed = logan.process_log_file_incremental(log_path, state_path,
+                                                    0.5, 1)
+        self.assertEqual(parsed.total_count,
+                         logan.process_log_stream(
+                             map(logan.parse_log_line, lines[:100]),
+                             0.5).total_count)
+
+        # the last line is not complete yet
+        with open(log_path, 'a') as fp:
+            fp.writelines(lines[100:200])
+            fp.write(lines[200][:10])
+        logan.process_log_file_incremental(log_path, state_path, 0.5, 2)
+
+        with open(log_path, 'a') as fp:
+            fp.write(lines[200][10:])
+            fp.writelines(lines[201:])
+        parsed = logan.process_log_file_incremental(log_path, state_path,
+                                                    0.5, 1)
+
+        expected = logan.process_log_stream(
+            map(logan.parse_log_line, lines), 0.5)
+        self.assertEqual(parsed.total_count, expected.total_count)
+        self.assertEqual(parsed.total_time, expected.total_time)
+        self.assertEqual(logan.process_data(parsed, 10),
+                         logan.process_data(expected, 10))
+
+        # log file was rotated
+        os.remove(log_path)
+        with open(log_path, 'w') as fp:
+            fp.writelines(lines[:10])
+        state = logan.load_state(state_path)
+        state['inode'] += 1
+        logan.save_state(state, state_path)
+
+        parsed = logan.process_log_file_incremental(log_path, state_path,
+                                                    0.5, 1)
+        self.assertEqual(parsed.total_count,
+                         logan.process_log_stream(
+                             map(logan.parse_log_line, lines[:10]),
+                             0.5).total_count)
+
+    def test_backfill(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        log_dir = os.path.join(root, 'log')
+        report_dir = os.path.join(root, 'reports')
+        os.makedirs(log_dir)
+        os.makedirs(report_dir)
+
+        lines = make_log_lines(100)
+        for name in ['nginx-access-ui.log-20180301',
+                     'nginx-access-ui.log-20180303',
+                     'nginx-access-ui.log-20180304']:
+            with open(os.path.join(log_dir, name), 'w') as fp:
+                fp.writelines(lines)
+        gzip_path = os.path.join(log_dir, 'nginx-access-ui.log-20180302.gz')
+        with gzip.open(gzip_path, 'wt') as fp:
+            fp.writelines(lines)
+        with open(os.path.join(report_dir, 'report-2018.03.03.html'),
+                  'w') as fp:
+            fp.write('old')
+
+        logs = logan.find_unreported_logs(log_dir, report_dir)
+        self.assertEqual([log_info.name for log_info in logs],
+                         ['nginx-access-ui.log-20180301',
+                          'nginx-access-ui.log-20180302.gz',
+                          'nginx-access-ui.log-20180304'])
+
+        cfg = dict(logan.config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                   BACKFILL_WORKERS=2, WORKERS=4)
+        results = logan.backfill(cfg)
+        self.assertTrue(all(success for _, success in results))
+        reports = [name for name in os.listdir(report_dir)
+                   if name.endswith('.html')]
+        self.assertEqual(sorted(reports),
+                         ['report-2018.03.01.html',
+                          'report-2018.03.02.html',
+                          'report-2018.03.03.html',
+                          'report-2018.03.04.html'])
+        with open(os.path.join(report_dir, 'report-2018.03.03.html')) as fp:
+            self.assertEqual(fp.read(), 'old')
+        self.assertEqual(logan.find_unreported_logs(log_dir, report_dir), [])
+
+    def test_batch(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        vhosts = []
+        for name, line_count in (('small', 100), ('large', 1000),
+                                 ('empty', 0), ('old', 100)):
+            log_dir = os.path.join(root, name, 'log')
+            os.makedirs(log_dir)
+            if line_count:
+                with open(os.path.join(log_dir,
+                                       'nginx-access-ui.log-20180301'),
+                          'w') as fp:
+                    fp.writelines(make_log_lines(line_count))
+            vhosts.append({'NAME': name, 'LOG_DIR': log_dir,
+                           'REPORT_DIR': os.path.join(root, name, 'reports')})
+        old_report = os.path.join(root, 'old', 'reports',
+                                  'report-2018.03.01.html')
+        logan.write_file_atomic(old_report, 'old')
+        summary_path = os.path.join(root, 'summary.json')
+
+        cfg = dict(logan.config, VHOSTS=vhosts, BATCH_WORKERS=2,
+                   BATCH_SUMMARY=summary_path)
+        summaries = logan.batch(cfg)
+
+        self.assertEqual([(summary['vhost'], summary['status'])
+                          for summary in summaries],
+                         [('small', 'done'), ('large', 'done'),
+                          ('empty', 'no_log'), ('old', 'exists')])
+        self.assertEqual(summaries[1]['distinct_urls'], 50)
+        for name in ('small', 'large'):
+            self.assertTrue(os.path.exists(os.path.join(
+                root, name, 'reports', 'report-2018.03.01.html')))
+        with open(old_report) as fp:
+            self.assertEqual(fp.read(), 'old')
+        with open(summary_path) as fp:
+            self.assertEqual(json.load(fp), summaries)
+
+    def test_get_vhosts(self):
+        cfg = dict(logan.config, WORKERS=4, VHOSTS=[
+            {'NAME': 'ui', 'LOG_DIR': 'log/ui', 'REPORT_DIR': 'reports/ui',
+             'WORKERS': 8, 'VHOSTS': [{'LOG_DIR': 'x'}], 'REPORT_SIZE': 10},
+            {'LOG_DIR': 'log/api', 'REPORT_DIR': 'reports/api'},
+        ])
+
+        vhosts = logan.get_vhosts(cfg)
+
+        self.assertEqual([name for name, _ in vhosts], ['ui', 'log/api'])
+        for _, vhost_cfg in vhosts:
+            self.assertEqual(vhost_cfg['WORKERS'], 1)
+            self.assertEqual(vhost_cfg['VHOSTS'], [])
+        self.assertEqual(vhosts[0][1]['REPORT_SIZE'], 10)
+        self.assertEqual(vhosts[0][1]['LOG_DIR'], 'log/ui')
+        self.assertEqual(vhosts[1][1]['REPORT_SIZE'], cfg['REPORT_SIZE'])
+
+    def test_url_normalizer(self):
+        normalize = logan.UrlNormalizer().normalize
+
+        urls = [
+            ('/api/v2/banner/7763463', '/api/v2/banner/{id}'),
+            ('/api/v2/banner/7763463/info?x=1&y=2',
+             '/api/v2/banner/{id}/info?{query}'),
+            ('/api/v2/slot/4705/groups', '/api/v2/slot/{id}/groups'),
+            ('/export/8f14e45f-ceea-467f-a0e6-b2a8b3c1d2e4',
+             '/export/{uuid}'),
+            ('/static/712e90144abee9aa27d0', '/static/{hash}'),
+            ('/api/v2/v1234/s2', '/api/v2/v1234/s2'),
+        ]
+        for url, template in urls:
+            self.assertEqual(normalize(url), template)
+
+        normalize = logan.UrlNormalizer([[r'\d+', 'N']], 10).normalize
+        self.assertEqual(normalize('/a1/b22?c=3'), '/aN/bN?c=N')
+
+    def test_url_times(self):
+        stream = [logan.RequestInfo('/a' + str(idx % 2), 0.5)
+                  for idx in range(5)]
+
+        stats = logan.collect_log_stream(stream)
+        self.assertEqual(stats.data, {'/a0': array('d', [0.5] * 3),
+                                      '/a1': array('d', [0.5] * 2)})
+        for url in stats.data:
+            self.assertIs(url, sys.intern('/a' + url[-1]))
+
+    def test_early_abort(self):
+        consumed = []
+
+        def stream():
+            for idx in range(10 * logan.ERROR_CHECK_LINES):
+                consumed.append(idx)
+                yield None if idx % 10 else logan.RequestInfo('/a', 0.1)
+
+        with self.assertRaises(Exception):
+            logan.collect_log_stream(stream(), error_threshold=0.6)
+        self.assertEqual(len(consumed), logan.ERROR_CHECK_LINES)
+
+    def test_malformed_head(self):
+        # 10% of errors, all at the beginning of log
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        log_dir = os.path.join(root, 'log')
+        os.makedirs(log_dir)
+        with open(os.path.join(log_dir, 'nginx-access-ui.log-20180301'),
+                  'w') as fp:
+            fp.writelines(['broken line\n'] * logan.ERROR_CHECK_LINES)
+            fp.writelines(make_log_lines(9 * logan.ERROR_CHECK_LINES))
+        report_dir = os.path.join(root, 'reports')
+
+        self.assertFalse(logan.config['ERROR_EARLY_ABORT'])
+        logan.main(dict(logan.config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                        ERROR_THRESHOLD=0.6))
+        self.assertTrue(os.path.exists(
+            os.path.join(report_dir, 'report-2018.03.01.html')))
+
+        stream = [None] * logan.ERROR_CHECK_LINES + \
+            [logan.RequestInfo('/a', 0.1)] * 9 * logan.ERROR_CHECK_LINES
+        stats = logan.collect_log_stream(stream)
+        self.assertEqual(stats.invalid_count, logan.ERROR_CHECK_LINES)
+        logan.build_parsed_data(stats, 0.6)
+
+    def test_no_early_abort_near_threshold(self):
+        # 61% of errors, above threshold but within confidence bound
+        stream = [None if idx % 100 < 61 else logan.RequestInfo('/a', 0.1)
+                  for idx in range(3 * logan.ERROR_CHECK_LINES)]
+
+        stats = logan.collect_log_stream(stream, error_threshold=0.6)
+        self.assertEqual(stats.total_count, len(stream))
+        with self.assertRaises(Exception):
+            logan.build_parsed_data(stats, 0.6)
+
+        stats = logan.collect_log_stream(stream, error_threshold=0.7)
+        self.assertEqual(stats.total_count, len(stream))
+
+    def test_collect_log_stream_normalized(self):
+        stream = [logan.RequestInfo('/v1/banner/1', 0.1),
+                  logan.RequestInfo('/v1/banner/2?x=1', 0.2),
+                  logan.RequestInfo('/v1/banner/3', 0.3),
+                  logan.RequestInfo('/v2', 0.4),
+                  None]
+
+        stats = logan.collect_log_stream(stream,
+                                         url_rules=logan.DEFAULT_URL_RULES)
+        self.assertEqual(stats.data,
+                         {'/v1/banner/{id}': array('d', [0.1, 0.3]),
+                          '/v1/banner/{id}?{query}': array('d', [0.2]),
+                          '/v2': array('d', [0.4])})
+        self.assertEqual(stats.total_count, 5)
+        self.assertEqual(stats.invalid_count, 1)
+
+    def test_process_log_heavy_hitters(self):
+        rnd = random.Random(3)
+        stream = []
+        for idx in range(5000):
+            if idx % 2:
+                url = '/heavy/{}'.format(rnd.randint(1, 5))
+            else:
+                url = '/light/{}'.format(rnd.randint(1, 1000))
+            stream.append(logan.RequestInfo(url, rnd.random()))
+
+        expected = logan.process_log_stream(stream, 0.5)
+        expected_total_time = expected.total_time
+        expected = logan.process_data(expected, 5)
+
+        parsed = logan.process_log_stream(stream, 0.5, heavy_hitters=20)
+        self.assertEqual(len(parsed.data), 20)
+        self.assertAlmostEqual(parsed.total_time, expected_total_time)
+        self.assertEqual(parsed.total_count, len(stream))
+
+        data = logan.process_data(parsed, 5)
+        self.assertEqual(sorted(row['url'] for row in data),
+                         sorted(row['url'] for row in expected))
+        expected = {row['url']: row for row in expected}
+        for row in data:
+            expected_row = expected[row['url']]
+            self.assertIn('approx', row)
+            self.assertGreaterEqual(row['time_sum'], expected_row['time_sum'])
+            self.assertLessEqual(row['count'], expected_row['count'])
+            if not row['approx']:
+                self.assertEqual(row['count'], expected_row['count'])
+
+    def test_aggregate_cache(self):
+        lines = make_log_lines(500)
+        log_path = write_temp_log(lines)
+        cache_path = log_path + '.agg'
+        self.addCleanup(os.remove, log_path)
+        self.addCleanup(os.remove, cache_path)
+
+        options = {'aggregation': 'exact', 'url_rules': None}
+        stats = logan.collect_log_stream(map(logan.parse_log_line, lines),
+                                         **options)
+        logan.save_aggregate_cache(stats, cache_path, log_path, options)
+        expected = logan.build_parsed_data(stats, 0.5)
+
+        parsed = logan.load_aggregate_cache(cache_path, log_path, 0.5, options)
+        self.assertEqual(parsed.total_count, expected.total_count)
+        self.assertEqual(parsed.total_time, expected.total_time)
+        self.assertEqual(logan.process_data(parsed, 10),
+                         logan.process_data(expected, 10))
+
+        other_options = dict(options, url_rules=logan.DEFAULT_URL_RULES)
+        self.assertIsNone(logan.load_aggregate_cache(cache_path, log_path, 0.5,
+                                                     other_options))
+        with self.assertRaises(Exception):
+            logan.load_aggregate_cache(cache_path, log_path, 0.01, options)
+
+        with open(log_path, 'a') as fp:
+            fp.write(lines[0])
+        self.assertIsNone(logan.load_aggregate_cache(cache_path, log_path, 0.5,
+                                                     options))
+
+    @unittest.skipIf(logan.np is None, 'numpy is not installed')
+    def test_process_log_numpy(self):
+        log_path = write_temp_log(make_log_lines(3000))
+        self.addCleanup(os.remove, log_path)
+
+        stream = logan.read_log_file(log_path, False)
+        expected = logan.process_data(logan.process_log_stream(stream, 0.5),
+                                      20)
+
+        parsed = logan.process_log_file_parallel(log_path, 0.5, 3,
+                                                 engine='numpy')
+        self.assertIsInstance(parsed.data, logan.UrlColumns)
+        data = logan.process_data(parsed, 20)
+
+        self.assertEqual(len(data), len(expected))
+        for row, expected_row in zip(data, expected):
+            for key, value in expected_row.items():
+                self.assertEqual(row[key], value)
+            self.assertLessEqual(row['time_med'], row['time_p90'])
+            self.assertLessEqual(row['time_p95'], row['time_p99'])
+            self.assertLessEqual(row['time_p99'], row['time_max'])
+
+    @unittest.skipIf(logan.np is None, 'numpy is not installed')
+    def test_process_columns_near_equal_sums(self):
+        # plain sum of the first url is 1.1989999999999998, fsum is 1.199
+        lines = [LOG_LINE_TEMPLATE.format('/api/{}'.format(url), time)
+                 for url, time in [(1, '0.255'), (1, '0.449'), (1, '0.495'),
+                                   (2, '1.199'), (3, '0.5'), (4, '1.199')]]
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+
+        for report_size in (1, 2, 3, 10):
+            stream = logan.read_log_file(log_path, False)
+            expected = logan.process_data(
+                logan.process_log_stream(stream, 0.5), report_size)
+            stream = logan.read_log_file(log_path, False)
+            data = logan.process_data(
+                logan.process_log_stream(stream, 0.5, engine='numpy'),
+                report_size)
+            self.assertEqual(len(data), len(expected))
+            for row, expected_row in zip(data, expected):
+                for key, value in expected_row.items():
+                    self.assertEqual(row[key], value)
+            self.assertEqual(data[0]['url'], '/api/1')
+
+    def test_split_log_line_bytes(self):
+        lines = make_log_lines(200) + [
+            LOG_LINE_TEMPLATE.format('/api/\u0444', '0.1'),
+            LOG_LINE_TEMPLATE.format('/api/1', '0.1').replace('\n', '\r\n'),
+            LOG_LINE_TEMPLATE.format('/api/1', '0.1 x'),
+            LOG_LINE_TEMPLATE.format('/api/\xa01', '0.1'),
+        ]
+        for line in lines:
+            self.assertEqual(logan.parse_log_line_bytes(line.encode('utf-8')),
+                             logan.parse_log_line(line))
+            self.assertEqual(logan.parse_log_line_bytes(
+                line.rstrip('\n').encode('utf-8')), logan.parse_log_line(line))
+
+    def test_parse_log_block(self):
+        lines = [
+            LOG_LINE_TEMPLATE.format('/api/1', '0.1'),
+            '\n',
+            LOG_LINE_TEMPLATE.format('/api/\u0444', '0.2'),
+            LOG_LINE_TEMPLATE.format('/api/1', '0.3').replace('\n', '\r\n'),
+            LOG_LINE_TEMPLATE.format('/api/"1', '0.4'),
+            'broken line\n',
+            LOG_LINE_TEMPLATE.format('/api/2', '0.5 x'),
+            LOG_LINE_TEMPLATE.format('/api/3', '0.6').rstrip('\n'),
+        ]
+        block = ''.join(lines).encode('utf-8')
+        self.assertEqual(list(logan.parse_log_block(block)),
+                         [logan.parse_log_line(line) for line in lines])
+
+    def test_read_gzip_blocks(self):
+        lines = make_log_lines(2000)
+        fd, log_path = tempfile.mkstemp()
+        self.addCleanup(os.remove, log_path)
+        # multi-member gzip file, as written by pigz or appended gzip files
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(gzip.compress(''.join(lines[:700]).encode('utf-8')))
+            fp.write(gzip.compress(''.join(lines[700:]).encode('utf-8')))
+
+        expected = list(logan.read_log_file(log_path, True))
+        self.assertEqual(len(expected), len(lines))
+        for block_size in (100, 1 << 20):
+            blocks = logan.read_gzip_blocks(log_path, block_size)
+            requests = [request for block in logan.split_blocks(blocks)
+                        for request in logan.parse_log_block(block)]
+            self.assertEqual(requests, expected)
+
+        self.assertEqual(list(logan.read_log_file(log_path, True, 'zlib')),
+                         expected)
+        if shutil.which('pigz'):
+            self.assertEqual(list(logan.read_log_file(log_path, True,
+                                                      'pigz')), expected)
+
+    def test_read_gzip_truncated(self):
+        lines = make_log_lines(2000)
+        data = gzip.compress(''.join(lines).encode('utf-8'))
+        fd, log_path = tempfile.mkstemp()
+        self.addCleanup(os.remove, log_path)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data[:len(data) // 2])
+
+        for reader in ('text', 'zlib'):
+            with self.assertRaises(EOFError):
+                list(logan.read_log_file(log_path, True, reader))
+        with self.assertRaises(EOFError):
+            logan.find_gzip_members(log_path, 1 << 20)
+
+    def check_gzip_index(self, log_path, lines, span):
+        expected = logan.collect_log_stream(map(logan.parse_log_line, lines))
+        index_path = log_path + '.gzidx'
+        index = logan.get_gzip_index(log_path, index_path, span)
+        self.assertEqual(index['size'], len(''.join(lines)))
+
+        for shard_count in (1, 3, 7):
+            shards = logan.split_gzip_index(index, shard_count)
+            requests = [request for start, end, point in shards
+                        for request in logan.read_gzip_shard(
+                            log_path, index, start, end, point)]
+            self.assertEqual(requests, [logan.parse_log_line(line)
+                                        for line in lines])
+        stats = logan.collect_gzip_shards(log_path, index, 3)
+        self.assertEqual(stats, expected)
+        self.assertIsNotNone(logan.load_gzip_index(index_path, log_path,
+                                                   span))
+        self.assertIsNone(logan.load_gzip_index(index_path, log_path,
+                                                span + 1))
+        return index
+
+    def test_gzip_index_members(self):
+        lines = make_log_lines(3000)
+        data = ''.join(lines).encode('utf-8')
+        fd, log_path = tempfile.mkstemp()
+        self.addCleanup(os.remove, log_path)
+        self.addCleanup(os.remove, log_path + '.gzidx')
+        # members split lines at arbitrary offsets
+        with os.fdopen(fd, 'wb') as fp:
+            for start in range(0, len(data), 10000):
+                fp.write(gzip.compress(data[start:start + 10000]))
+
+        indexed_gzip = logan.indexed_gzip
+        logan.indexed_gzip = None
+        self.addCleanup(setattr, logan, 'indexed_gzip', indexed_gzip)
+        index = self.check_gzip_index(log_path, lines, 20000)
+        self.assertEqual(index['backend'], 'members')
+        self.assertGreater(len(index['points']), 5)
+        self.assertEqual(index['points'][1][1], 20000)
+
+    @unittest.skipIf(logan.indexed_gzip is None,
+                     'indexed_gzip is not installed')
+    def test_gzip_index_zran(self):
+        lines = make_log_lines(20000)
+        fd, log_path = tempfile.mkstemp()
+        self.addCleanup(os.remove, log_path)
+        self.addCleanup(os.remove, log_path + '.gzidx')
+        self.addCleanup(os.remove, log_path + '.gzidx.zran')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(gzip.compress(''.join(lines).encode('utf-8')))
+
+        index = self.check_gzip_index(log_path, lines, 1 << 18)
+        self.assertEqual(index['backend'], 'zran')
+
+    def test_read_log_mmap(self):
+        lines = make_log_lines(500)
+        lines.append('\n')
+        lines.append(LOG_LINE_TEMPLATE.format('/api/\u0444', '0.2'))
+        lines.append(LOG_LINE_TEMPLATE.format('/api/1', '0.3').rstrip('\n'))
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+
+        expected = [logan.parse_log_line(line) for line in lines]
+        for window_size in (1, 1000, 1 << 20):
+            requests = logan.read_log_mmap(log_path, window_size=window_size)
+            self.assertEqual(list(requests), expected)
+        self.assertEqual(list(logan.read_log_file(log_path, False,
+                                                  plain_reader='mmap')),
+                         expected)
+
+        with open(log_path, 'w'):
+            pass
+        self.assertEqual(list(logan.read_log_mmap(log_path)), [])
+
+    def test_log_format_default(self):
+        log_format = logan.compile_log_format(
+            '$remote_addr $remote_user  $http_x_real_ip [$time_local] '
+            '"$request" $status $body_bytes_sent "$http_referer" '
+            '"$http_user_agent" "$http_x_forwarded_for" '
+            '"$http_X_REQUEST_ID" "$http_X_RB_USER" $request_time')
+        lines = make_log_lines(500)
+        lines.append(LOG_LINE_TEMPLATE.format('/api/\u0444', '0.2'))
+
+        for line in lines:
+            self.assertEqual(log_format.parse_line(line),
+                             logan.parse_log_line(line))
+            self.assertEqual(log_format.parse_line_bytes(line.encode()),
+                             logan.parse_log_line(line))
+
+    def test_log_format_custom(self):
+        log_format = '$remote_addr - $remote_user [$time_local] ' \
+                     '"$request" $status $body_bytes_sent ' \
+                     '"$http_referer" "$http_user_agent" rt=$request_time'
+        template = '10.0.0.1 - - [29/Jun/2017:03:50:23 +0300] ' \
+                   '"GET {} HTTP/1.1" 200 1018 "-" "Mozilla/5.0 (X11)" ' \
+                   'rt={}\n'
+        lines = [template.format('/api/{}'.format(idx), '0.{}'.format(idx))
+                 for idx in range(1, 300)]
+        lines += ['broken line\n', template.format('', '0.1'),
+                  template.format('/api/1', '1'),
+                  template.format('/api/\u0444', '0.5')]
+        expected = [logan.RequestInfo('/api/{}'.format(idx),
+                                      float('0.{}'.format(idx)))
+                    for idx in range(1, 300)]
+        expected += [None, None, None, logan.RequestInfo('/api/\u0444', 0.5)]
+
+        compiled = logan.compile_log_format(log_format)
+        self.assertEqual([compiled.parse_line(line) for line in lines],
+                         expected)
+        self.assertEqual([compiled.parse_line_regex(line) for line in lines],
+                         expected)
+
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+        gz_path = log_path + '.gz'
+        with gzip.open(gz_path, 'wt') as fp:
+            fp.writelines(lines)
+        self.addCleanup(os.remove, gz_path)
+
+        for reader in ('text', 'mmap'):
+            self.assertEqual(list(logan.read_log_file(
+                log_path, False, plain_reader=reader,
+                log_format=log_format)), expected)
+        for reader in ('text', 'zlib'):
+            self.assertEqual(list(logan.read_log_file(
+                gz_path, True, gzip_reader=reader,
+                log_format=log_format)), expected)
+
+        stats = logan.collect_log_range(log_path, 0,
+                                        os.path.getsize(log_path), 2,
+                                        log_format=log_format)
+        self.assertEqual(stats.total_count, len(lines))
+        self.assertEqual(stats.invalid_count, 3)
+
+    def test_log_format_errors(self):
+        with self.assertRaises(Exception):
+            logan.LogFormat('$remote_addr "$request"')
+        with self.assertRaises(Exception):
+            logan.LogFormat('$remote_addr $request_time')
+
+        # adjacent variables are parsed by regex only
+        log_format = logan.LogFormat('$request_uri$request_time')
+        self.assertEqual(log_format.parse_line('/a1.5\n'),
+                         logan.RequestInfo('/a', 1.5))
+
+    def test_parse_time_local(self):
+        self.assertEqual(logan.parse_time_local('29/Jun/2017:03:50:23 +0300'),
+                         int(datetime.strptime(
+                             '29/Jun/2017:03:50:23 +0300',
+                             '%d/%b/%Y:%H:%M:%S %z').timestamp()))
+        self.assertEqual(logan.parse_time_local('01/Jan/2018:00:00:00 -0130'),
+                         1514770200)
+        for time_local in (None, '', '29/Jun/2017', '29/Foo/2017:03:50:23 '
+                           '+0300', '29/Jun/2017 03:50:23 +0300'):
+            self.assertIsNone(logan.parse_time_local(time_local))
+
+    def test_parse_log_block_time_local(self):
+        lines = make_log_lines(100) + [
+            LOG_LINE_TEMPLATE.format('/api/1', '0.1').replace('[', '('),
+            LOG_LINE_TEMPLATE.format('/api/\u0444', '0.2'),
+            '1.1.1.1 "GET /api/2 HTTP/1.1" [1] 0.3\n',
+        ]
+        expected = [logan.parse_log_line_time(line) for line in lines]
+        self.assertEqual(expected[0].time_local, '29/Jun/2017:03:50:23 +0300')
+        self.assertIsNone(expected[-1].time_local)
+
+        block = ''.join(lines).encode('utf-8')
+        self.assertEqual(list(logan.parse_log_block(block, time_local=True)),
+                         expected)
+
+        log_format = logan.compile_log_format(
+            '$remote_addr $remote_user  $http_x_real_ip [$time_local] '
+            '"$request" $status $body_bytes_sent "$http_referer" '
+            '"$http_user_agent" "$http_x_forwarded_for" '
+            '"$http_X_REQUEST_ID" "$http_X_RB_USER" $request_time', True)
+        for line in lines[:100]:
+            self.assertEqual(log_format.parse_line(line),
+                             logan.parse_log_line_time(line))
+            self.assertEqual(log_format.parse_line_bytes(line.encode()),
+                             logan.parse_log_line_time(line))
+
+    def test_process_log_timeline(self):
+        template = LOG_LINE_TEMPLATE.replace('03:50:23', '{}')
+        lines = []
+        for minute in range(0, 180, 10):
+            time_local = '{:02}:{:02}:00'.format(minute // 60, minute % 60)
+            lines.append(template.format(time_local, '/api/1', '0.5'))
+            if minute >= 60:
+                lines.append(template.format(time_local, '/api/2', '1.0'))
+        lines.append('broken line\n')
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+
+        expected = None
+        for workers, plain_reader in ((1, 'text'), (1, 'mmap'), (2, 'mmap')):
+            stats = logan.collect_log_file(log_path, False, workers,
+                                           plain_reader=plain_reader,
+                                           time_bucket=3600)
+            data = logan.process_data(logan.build_parsed_data(stats, 0.5),
+                                      10)
+            if expected is None:
+                expected = data
+            self.assertEqual(data, expected)
+
+        rows = {row['url']: row['timeline'] for row in expected}
+        self.assertEqual(rows['/api/1']['step'], 3600)
+        self.assertEqual(rows['/api/1']['size'], 3)
+        self.assertEqual(rows['/api/1']['buckets'],
+                         [[0, 6, 3.0, 0.5, 0.5], [1, 6, 3.0, 0.5, 0.5],
+                          [2, 6, 3.0, 0.5, 0.5]])
+        self.assertEqual(rows['/api/2']['buckets'],
+                         [[1, 6, 6.0, 1.0, 1.0], [2, 6, 6.0, 1.0, 1.0]])
+        self.assertEqual(rows['/api/2']['start'], rows['/api/1']['start'])
+
+    def test_url_timelines_bounded(self):
+        timelines = logan.UrlTimelines(3600, 4)
+        time_local = '29/Jun/2017:03:50:23 +0300'
+        for idx in range(1000):
+            timelines.add('/api/heavy', 1.0, time_local)
+            timelines.add('/api/{}'.format(idx), 0.01, time_local)
+
+        self.assertEqual(len(timelines.urls), 4)
+        start, size = timelines.bounds()
+        self.assertEqual(size, 1)
+        self.assertEqual(timelines.report('/api/heavy', start),
+                         [[0, 1000, 1000.0, 1.0, 1.0]])
+        self.assertEqual(timelines.report('/api/0', start), [])
+
+        other = logan.UrlTimelines(3600, 4)
+        other.add('/api/heavy', 2.0, time_local)
+        timelines.merge(other)
+        self.assertEqual(len(timelines.urls), 4)
+        self.assertEqual(timelines.report('/api/heavy', start)[0][:3],
+                         [0, 1001, 1002.0])
+
+    def test_read_log_sample(self):
+        lines = make_log_lines(1000)
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+        expected = [logan.parse_log_line(line) for line in lines]
+
+        for mode, block_size in (('lines', 1), ('blocks', 1),
+                                 ('blocks', 1000)):
+            sample = logan.LogSample(1.0, mode, block_size)
+            requests = [request for request in logan.read_log_file(
+                log_path, False, sample=sample)
+                if request is not logan.SAMPLE_CLUSTER_END]
+            self.assertEqual(requests, expected)
+
+        sample = logan.LogSample(0.1, seed=1)
+        requests = list(logan.read_log_file(log_path, False, sample=sample))
+        self.assertEqual(sample.population, 1000)
+        self.assertEqual(requests[1::2], [logan.SAMPLE_CLUSTER_END] * 100)
+        offset = expected.index(requests[0])
+        self.assertEqual(requests[::2], expected[offset::10])
+
+        sample = logan.LogSample(0.1, 'blocks', 1000, seed=1)
+        requests = list(logan.read_log_file(log_path, False, sample=sample))
+        self.assertEqual(sample.population,
+                         -(-os.path.getsize(log_path) // 1000))
+        self.assertEqual(requests.count(logan.SAMPLE_CLUSTER_END),
+                         round(sample.population * 0.1))
+
+        with self.assertRaises(Exception):
+            logan.LogSample(0)
+
+    def test_process_log_sample(self):
+        lines = make_log_lines(2000)
+        log_path = write_temp_log(lines)
+        self.addCleanup(os.remove, log_path)
+
+        def process(sample=None):
+            stats = logan.collect_log_file(log_path, False, 1, sample=sample)
+            data = logan.process_data(logan.build_parsed_data(stats, 0.5),
+                                      100)
+            return {row['url']: row for row in data}
+
+        full = process()
+        sampled = process(logan.LogSample(1.0, 'blocks', 4096))
+        for url, row in full.items():
+            self.assertEqual(sampled[url]['count'], row['count'])
+            self.assertEqual(sampled[url]['count_ci'], 0)
+            self.assertAlmostEqual(sampled[url]['time_sum'], row['time_sum'],
+                                   places=2)
+
+        for mode in ('lines', 'blocks'):
+            sampled = process(logan.LogSample(0.25, mode, 4096, seed=1))
+            covered = 0
+            for url, row in sampled.items():
+                if abs(row['count'] - full[url]['count']) <= row['count_ci']:
+                    covered += 1
+            self.assertGreater(covered / len(sampled), 0.8)
+
+        # time sum is scaled before rounding
+        rnd = random.Random(0)
+        log_path = write_temp_log([
+            LOG_LINE_TEMPLATE.format('/api/{}'.format(rnd.randint(1, 5)),
+                                     '{:.6f}'.format(rnd.random()))
+            for _ in range(2000)])
+        self.addCleanup(os.remove, log_path)
+        sample = logan.LogSample(0.3, 'blocks', 4096, seed=1)
+        stats = logan.collect_log_file(log_path, False, 1, sample=sample)
+        scale = stats.sample.population / stats.sample.clusters
+        data = logan.process_data(logan.build_parsed_data(stats, 0.5), 100)
+        for row in data:
+            time_sum = math.fsum(stats.data[row['url']]) * scale
+            self.assertEqual(row['time_sum'], round(time_sum, 3))
+
+    def test_estimate_total(self):
+        self.assertEqual(logan.estimate_total(3, 5, 10, 1), (30, None))
+        estimate, error = logan.estimate_total(4, 8, 4, 2)
+        self.assertEqual((estimate, error), (8, 0))
+        estimate, error = logan.estimate_total(4, 10, 10, 2)
+        self.assertEqual(estimate, 20)
+        self.assertAlmostEqual(error, logan.SAMPLE_Z * 10 * (2 / 2 * 0.8)
+                               ** 0.5)
+
+    def test_write_report_pages(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        report_path = os.path.join(root, 'reports', 'report-2018.03.01.html')
+        data = [{'url': '/api/{}'.format(idx), 'time_sum': 100 - idx}
+                for idx in range(25)]
+
+        logan.write_report(data, report_path, page_size=10)
+
+        def load_jsonp(path, callback):
+            with open(path) as fp:
+                script = fp.read()
+            self.assertTrue(script.startswith(callback + '('))
+            self.assertTrue(script.endswith(');\n'))
+            return json.loads(script[len(callback) + 1:-3])
+
+        pages_dir = os.path.join(root, 'reports', 'report-2018.03.01')
+        index = load_jsonp(os.path.join(pages_dir, 'index.js'),
+                           'reportIndex')
+        self.assertEqual(index, {'rows': 25, 'page_size': 10, 'pages': [
+            'page-00000.js', 'page-00001.js', 'page-00002.js']})
+        rows = []
+        for page in index['pages']:
+            rows.extend(load_jsonp(os.path.join(pages_dir, page),
+                                   'reportPage'))
+        self.assertEqual(rows, data)
+        with open(report_path) as fp:
+            report = fp.read()
+        self.assertIn('var reportPages = "report-2018.03.01";', report)
+        self.assertNotIn('$table_json', report)
+
+        logan.write_report(data[:5], report_path, page_size=10)
+        self.assertEqual(sorted(os.listdir(pages_dir)),
+                         ['index.js', 'page-00000.js'])
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'reports'))),
+                         ['report-2018.03.01', 'report-2018.03.01.html'])
+
+        logan.write_report(data, report_path)
+        with open(report_path) as fp:
+            self.assertIn('var reportPages = null;', fp.read())
+
+    def test_log_follower(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        log_path = os.path.join(root, 'access.log')
+        with open(log_path, 'wb') as fp:
+            fp.write(b'old\n')
+
+        follower = logan.LogFollower(log_path)
+        self.addCleanup(follower.close)
+        self.assertEqual(follower.read(), b'')
+        with open(log_path, 'ab') as fp:
+            fp.write(b'a\nb')
+        self.assertEqual(follower.read(), b'a\n')
+        self.assertEqual(follower.read(), b'')
+
+        # rotation: rest of the old file, then the new file
+        os.rename(log_path, log_path + '.1')
+        with open(log_path + '.1', 'ab') as fp:
+            fp.write(b'c\nd')
+        self.assertEqual(follower.read(), b'bc\n')
+        self.assertEqual(follower.read(), b'')
+        with open(log_path, 'wb') as fp:
+            fp.write(b'e\n')
+        self.assertEqual(follower.read(), b'd\n')
+        self.assertEqual(follower.read(), b'e\n')
+
+        with open(log_path, 'wb') as fp:
+            fp.write(b'f')
+        self.assertEqual(follower.read(), b'')
+        with open(log_path, 'ab') as fp:
+            fp.write(b'\n')
+        self.assertEqual(follower.read(), b'f\n')
+
+    def test_rolling_stats(self):
+        stats = logan.RollingStats([5, 15], 100)
+        now = 1000 * 60 + 30
+        for minute in range(20):
+            timestamp = now - minute * 60
+            stats.add('/api/1', 1.0, timestamp)
+            if minute < 5:
+                stats.add('/api/2', 10.0, timestamp)
+            stats.add_invalid(timestamp)
+
+        stats.expire(now)
+        self.assertEqual(sorted(stats.minutes),
+                         list(range(1000 - 14, 1001)))
+        rows = stats.report(now, 10)
+        self.assertEqual([row['url'] for row in rows], ['/api/2', '/api/1'])
+        self.assertEqual(rows[1]['count_5m'], 5)
+        self.assertEqual(rows[1]['count_15m'], 15)
+        self.assertEqual(rows[1]['time_sum_15m'], 15.0)
+        self.assertEqual(rows[0]['count_5m'], 5)
+        self.assertEqual(rows[0]['time_p95_15m'], 10.0)
+
+        # minutes aren't changed by report
+        self.assertEqual(stats.report(now, 10), rows)
+        self.assertEqual(stats.report(now + 3600, 10), [])
+
+    def test_metrics(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        log_dir = os.path.join(root, 'log')
+        report_dir = os.path.join(root, 'reports')
+        prometheus_path = os.path.join(root, 'textfile', 'analyzer.prom')
+        os.makedirs(log_dir)
+        with open(os.path.join(log_dir, 'nginx-access-ui.log-20180301'),
+                  'w') as fp:
+            fp.writelines(make_log_lines(1000))
+
+        cfg = dict(logan.config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                   METRICS=True, METRICS_PROMETHEUS=prometheus_path)
+        logan.main(cfg)
+
+        with open(os.path.join(report_dir,
+                               'report-2018.03.01.metrics.json')) as fp:
+            metrics = json.load(fp)
+        self.assertEqual(metrics['log'], 'nginx-access-ui.log-20180301')
+        stages = metrics['stages']
+        for stage in ['find_last_log', 'read_log_file', 'process_log_stream',
+                      'process_data', 'write_report']:
+            self.assertIn(stage, stages)
+            self.assertGreaterEqual(stages[stage]['wall_time'], 0)
+            self.assertGreaterEqual(stages[stage]['cpu_time'], 0)
+            self.assertGreater(stages[stage]['rss_high_water'], 0)
+        self.assertEqual(stages['read_log_file']['lines'], 1000)
+        self.assertGreater(stages['read_log_file']['lines_per_sec'], 0)
+        self.assertEqual(stages['process_log_stream']['distinct_urls'], 50)
+
+        with open(prometheus_path) as fp:
+            prometheus = fp.read()
+        self.assertIn('# TYPE log_analyzer_stage_wall_seconds gauge',
+                      prometheus)
+        self.assertIn('# TYPE log_analyzer_stage_rss_high_water_bytes gauge',
+                      prometheus)
+        self.assertIn('log_analyzer_stage_distinct_urls{'
+                      'log="nginx-access-ui.log-20180301",'
+                      'stage="process_log_stream"} 50', prometheus)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+import log_analyzer as logan
+from log_generator import LogGenerator, write_log
+from bench_log_analyzer import compare_results
+
+
+class TestLogGenerator(unittest.TestCase):
+
+    def test_lines_are_parsed(self):
+        lines = list(LogGenerator(url_count=100).lines(1000))
+
+        self.assertEqual(len(lines), 1000)
+        for line in lines:
+            self.assertEqual(logan.parse_log_line(line),
+                             logan.parse_log_line_regex(line))
+            self.assertIsNotNone(logan.parse_log_line(line))
+
+    def test_malformed_ratio(self):
+        lines = LogGenerator(url_count=100, malformed_ratio=0.2).lines(5000)
+        invalid = sum(logan.parse_log_line(line) is None for line in lines)
+
+        self.assertAlmostEqual(invalid / 5000.0, 0.2, delta=0.03)
+
+    def test_skew(self):
+        lines = LogGenerator(url_count=1000, skew=1.2).lines(5000)
+        counts = Counter(logan.parse_log_line(line).url for line in lines)
+        top = counts.most_common(1)[0][1]
+
+        self.assertLessEqual(len(counts), 1000)
+        self.assertGreater(top, 5000 / 20)
+
+    def test_repeatable(self):
+        first = list(LogGenerator(seed=3).lines(100))
+        second = list(LogGenerator(seed=3).lines(100))
+
+        self.assertEqual(first, second)
+
+    def test_write_gzip(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, 'log', 'test.gz')
+            write_log(log_path, 100, is_gzip=True, url_count=10)
+            with gzip.open(log_path, 'rt') as log_file:
+                self.assertEqual(len(log_file.readlines()), 100)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_compare_results(self):
+        results = {'read': 1.2, 'process': 1.0, 'new': 0.5}
+        baseline = {'read': 1.0, 'process': 1.0}
+
+        comparison = compare_results(results, baseline, 0.1)
+
+        self.assertEqual(comparison, [
+            ('new', 0.5, None, None, False),
+            ('process', 1.0, 1.0, 1.0, False),
+            ('read', 1.2, 1.0, 1.2, True),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import bisect
+import random
+import unittest
+from collections import defaultdict
+from sketches import KllSketch, SpaceSaving
+
+
+class TestKllSketch(unittest.TestCase):
+
+    def assertRankError(self, sketch, sorted_values, max_error):
+        for q in (0.1, 0.5, 0.9, 0.95, 0.99):
+            value = sketch.quantile(q)
+            rank = bisect.bisect_left(sorted_values, value)
+            self.assertLess(abs(rank / len(sorted_values) - q), max_error)
+
+    def test_small_sketch_is_exact(self):
+        sketch = KllSketch(100)
+        for value in [5, 1, 4, 2, 3]:
+            sketch.update(value)
+
+        self.assertEqual(sketch.count, 5)
+        self.assertEqual(sketch.total, 15)
+        self.assertEqual(sketch.min, 1)
+        self.assertEqual(sketch.max, 5)
+        self.assertEqual(sketch.quantile(0.5), 3)
+
+    def test_small_sketch_even_count(self):
+        sketch = KllSketch(100)
+        for value in [4, 1, 3, 2]:
+            sketch.update(value)
+
+        self.assertEqual(sketch.quantile(0.5), 2.5)
+        self.assertEqual(sketch.quantile(0.25), 1)
+        self.assertEqual(sketch.quantile(0.9), 4)
+
+        sketch = KllSketch(100)
+        sketch.update(1)
+        sketch.update(2)
+        self.assertEqual(sketch.quantile(0.5), 1.5)
+
+    def test_quantiles(self):
+        rnd = random.Random(1)
+        values = [rnd.expovariate(3) for _ in range(50000)]
+
+        sketch = KllSketch(200)
+        for value in values:
+            sketch.update(value)
+
+        self.assertLess(sketch.size(), 3 * 200)
+        self.assertEqual(sketch.count, len(values))
+        self.assertEqual(sketch.max, max(values))
+        self.assertRankError(sketch, sorted(values), 0.02)
+
+    def test_merge(self):
+        rnd = random.Random(2)
+        values = sorted(rnd.random() for _ in range(50000))
+
+        sketches = [KllSketch(200) for _ in range(5)]
+        for idx, value in enumerate(values):
+            sketches[idx % 5].update(value)
+
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.merge(other)
+
+        self.assertLess(sketch.size(), 3 * 200)
+        self.assertEqual(sketch.count, len(values))
+        self.assertEqual(sketch.min, values[0])
+        self.assertRankError(sketch, values, 0.02)
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def make_stream(self, seed):
+        rnd = random.Random(seed)
+        return [(int(rnd.paretovariate(1.2)), rnd.random())
+                for _ in range(20000)]
+
+    def assertBounds(self, summary, stream):
+        weights = defaultdict(float)
+        for key, weight in stream:
+            weights[key] += weight
+
+        total = sum(weights.values())
+        self.assertAlmostEqual(summary.total, total)
+        self.assertLessEqual(len(summary), summary.capacity)
+
+        tracked = {}
+        for key, estimate, error, value in summary.items():
+            tracked[key] = estimate
+            self.assertLessEqual(error, total / summary.capacity + 1e-9)
+            self.assertLessEqual(estimate - error, weights[key] + 1e-9)
+            self.assertGreaterEqual(estimate, weights[key] - 1e-9)
+
+        for key, weight in weights.items():
+            if weight > total / summary.capacity:
+                self.assertIn(key, tracked)
+
+    def test_update(self):
+        stream = self.make_stream(1)
+        summary = SpaceSaving(50)
+        for key, weight in stream:
+            summary.update(key, weight).append(weight)
+
+        self.assertBounds(summary, stream)
+        self.assertLessEqual(len(summary.heap), 4 * 50)
+
+        for key, estimate, error, value in summary.items():
+            if error == 0:
+                self.assertAlmostEqual(sum(value), estimate)
+
+    def test_merge(self):
+        streams = [self.make_stream(seed) for seed in range(3)]
+        summaries = []
+        for stream in streams:
+            summary = SpaceSaving(50)
+            for key, weight in stream:
+                summary.update(key, weight).append(weight)
+            summaries.append(summary)
+
+        summary = summaries[0]
+        for other in summaries[1:]:
+            summary.merge(other, lambda value, other: value + other)
+
+        self.assertBounds(summary, [item for stream in streams
+                                    for item in stream])
+
+
+    def test_merge_copies_other_values(self):
+        summary = SpaceSaving(10, KllSketch)
+        other = SpaceSaving(10, KllSketch)
+        summary.update('a', 1.0).update(1.0)
+        other.update('a', 2.0).update(2.0)
+        other.update('b', 3.0).update(3.0)
+
+        summary.merge(other, KllSketch.merge)
+        for key, _, _, sketch in summary.items():
+            sketch.update(10.0)
+
+        self.assertEqual(summary.counters['a'][2].count, 3)
+        self.assertEqual(summary.counters['b'][2].count, 2)
+        self.assertEqual(other.counters['a'][2].count, 1)
+        self.assertEqual(other.counters['b'][2].count, 1)
+        self.assertEqual(other.counters['b'][2].max, 3.0)
+
+if __name__ == '__main__':
+    unittest.main()